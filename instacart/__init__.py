@@ -0,0 +1,6 @@
+'''
+Reusable helpers for the Instacart orders analysis.
+
+Submodules are imported explicitly (``from instacart import profile``) so that
+light-weight entry points do not pay for pandas/matplotlib on import.
+'''
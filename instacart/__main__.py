@@ -0,0 +1,5 @@
+import sys
+
+from instacart.cli import main
+
+sys.exit(main())
@@ -0,0 +1,127 @@
+'''
+Named analyses from the notebook, each returning a plain frame.
+
+``ANALYSES`` maps the command-line name of an analysis to its function,
+``COLUMNS`` to the columns it reads from each table and ``NEEDS`` to those
+tables, so callers load only what is required (see ``plan``).
+'''
+
+
+def _with_names(counts, df_products, value_name):
+    '''Turn a product_id-indexed count series into a named frame.'''
+    counts = counts.rename(value_name).rename_axis('product_id').reset_index()
+    names = df_products[['product_id', 'product_name']]
+    return counts.merge(names, on='product_id', how='left')[['product_id', 'product_name', value_name]]
+
+
+def orders_by_hour(tables, n=None):
+    '''Number of orders per order_hour_of_day.'''
+    counts = tables['instacart_orders']['order_hour_of_day'].value_counts().sort_index()
+    return counts.rename('orders').rename_axis('order_hour_of_day').reset_index()
+
+
+def orders_by_dow(tables, n=None):
+    '''Number of orders per order_dow.'''
+    counts = tables['instacart_orders']['order_dow'].value_counts().sort_index()
+    return counts.rename('orders').rename_axis('order_dow').reset_index()
+
+
+def top_products(tables, n=20):
+    '''The `n` products that appear on the most order lines.'''
+    counts = tables['order_products']['product_id'].value_counts().head(n)
+    return _with_names(counts, tables['products'], 'freq')
+
+
+def top_reordered(tables, n=20):
+    '''The `n` products reordered most frequently.'''
+    op = tables['order_products']
+    counts = op.loc[op['reordered'] == 1, 'product_id'].value_counts().head(n)
+    return _with_names(counts, tables['products'], 'freq')
+
+
+def top_first_in_cart(tables, n=20):
+    '''The `n` products most often put in the cart first.'''
+    op = tables['order_products']
+    counts = op.loc[op['add_to_cart_order'] == 1, 'product_id'].value_counts().head(n)
+    return _with_names(counts, tables['products'], 'freq')
+
+
+def order_sizes(tables, n=None):
+    '''Number of orders per basket size.'''
+    sizes = tables['order_products'].groupby('order_id').size()
+    counts = sizes.value_counts().sort_index()
+    return counts.rename('orders').rename_axis('items').reset_index()
+
+
+def product_reorder_proportions(tables, n=None, support=False):
+    '''
+    Share of each product's order lines that are reorders, in percent.
+    support = also return each product's number of order lines (`support`)
+    '''
+    op = tables['order_products']
+    stats = op.groupby('product_id')['reordered'].agg(['mean', 'size'])
+    result = _with_names(stats['mean'].mul(100), tables['products'], 'proportion_product_reorders')
+    if support:
+        result['support'] = stats['size'].to_numpy()
+    return result
+
+
+def user_reorder_proportions(tables, n=None, budget=None, spill_dir=None, support=False):
+    '''
+    Share of each user's order lines that are reorders, in percent.
+    budget = bytes the order line/order join may take before it spills to
+        disk (see budget.merge_groupby); order_products may then also be an
+        iterable of chunks
+    support = also return each user's number of order lines (`support`)
+    '''
+    from instacart.budget import merge_groupby
+    op = tables['order_products']
+    if hasattr(op, 'columns'):
+        op = op[['order_id', 'reordered']]
+    else:
+        op = (chunk[['order_id', 'reordered']] for chunk in op)
+    aggs = {'proportion_user_reorders': ('reordered', 'mean')}
+    if support:
+        aggs['support'] = ('reordered', 'size')
+    stats = merge_groupby(op, tables['instacart_orders'][['order_id', 'user_id']].drop_duplicates(),
+                          'order_id', 'user_id', aggs, budget=budget, spill_dir=spill_dir)
+    stats['proportion_user_reorders'] *= 100
+    return stats.reset_index()
+
+
+ANALYSES = {'hour-of-day': orders_by_hour,
+            'day-of-week': orders_by_dow,
+            'top-products': top_products,
+            'top-reordered': top_reordered,
+            'first-in-cart': top_first_in_cart,
+            'order-sizes': order_sizes,
+            'product-reorders': product_reorder_proportions,
+            'user-reorders': user_reorder_proportions}
+
+# columns each analysis reads, per table; order_id is kept on the orders
+# table so that duplicated orders can still be dropped
+COLUMNS = {'hour-of-day': {'instacart_orders': ['order_id', 'order_hour_of_day']},
+           'day-of-week': {'instacart_orders': ['order_id', 'order_dow']},
+           'top-products': {'order_products': ['product_id'],
+                            'products': ['product_id', 'product_name']},
+           'top-reordered': {'order_products': ['product_id', 'reordered'],
+                             'products': ['product_id', 'product_name']},
+           'first-in-cart': {'order_products': ['product_id', 'add_to_cart_order'],
+                             'products': ['product_id', 'product_name']},
+           'order-sizes': {'order_products': ['order_id']},
+           'product-reorders': {'order_products': ['product_id', 'reordered'],
+                                'products': ['product_id', 'product_name']},
+           'user-reorders': {'order_products': ['order_id', 'reordered'],
+                             'instacart_orders': ['order_id', 'user_id']}}
+
+NEEDS = {name: list(tables) for name, tables in COLUMNS.items()}
+
+# analyses that join order lines with orders and accept a memory budget
+SPILLABLE = {'user-reorders'}
+
+
+def run(name, tables, n=20, budget=None, spill_dir=None):
+    '''Run analysis `name` over `tables`; `budget` applies to the SPILLABLE ones.'''
+    if name in SPILLABLE:
+        return ANALYSES[name](tables, n, budget=budget, spill_dir=spill_dir)
+    return ANALYSES[name](tables, n)
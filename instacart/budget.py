@@ -0,0 +1,219 @@
+'''
+Joins and groupbys under a memory budget.
+
+The notebook materialises ``df_merge``/``df_merge1``/``df_merge2`` (every
+order line joined with its order) only to group it again. ``merge_groupby``
+computes ``left.merge(right, on=on).groupby(by).agg(...)`` directly: the size
+of the join is known exactly from the key counts before it is built, and when
+it would exceed the budget (or an input only arrives in chunks) both inputs
+are hash-partitioned by the join key into files on disk, each partition is
+joined on its own, and the joined rows are hash-partitioned again by the
+group key, so every group is aggregated from one partition.
+
+Each row carries its position in its input, and every group partition is put
+back in the order of the in-memory join (left row, then right row) before it
+is aggregated, so the aggregates, floating-point sums included, are the same
+as those of the in-memory path. Spilling is reported on the
+``instacart.budget`` logger.
+'''
+import logging
+import math
+import os
+import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+CHUNK_ROWS = 1_000_000
+# more partitions than this only multiplies files
+MAX_PARTITIONS = 512
+
+
+def parse_size(text):
+    '''Bytes from '512M', '4G', '1.5G' or a plain number of bytes.'''
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'not a size: {text!r}')
+    return int(float(match.group(1)) * _UNITS[match.group(2).upper()])
+
+
+def _format_size(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            return f'{n:.0f} {unit}'
+        n /= 1024
+    return f'{n:.1f} TiB'
+
+
+def frame_nbytes(df):
+    '''Memory footprint of a frame, strings included.'''
+    return int(df.memory_usage(deep=True, index=False).sum())
+
+
+def join_rows(left_keys, right_keys):
+    '''Exact number of rows of an inner join, from the key counts.'''
+    lc = pd.Series(left_keys).value_counts()
+    rc = pd.Series(right_keys).value_counts()
+    return int((lc * rc.reindex(lc.index, fill_value=0)).sum())
+
+
+def estimate_join_bytes(left, right, on):
+    '''Memory of left.merge(right, on=on) from its exact row count and the row widths.'''
+    rows = join_rows(left[on], right[on])
+    width = frame_nbytes(left) / max(len(left), 1)
+    width += frame_nbytes(right.drop(columns=[on])) / max(len(right), 1)
+    return int(rows * width)
+
+
+def _chunks(data, chunk_rows=CHUNK_ROWS):
+    '''Chunks of a frame, or the chunks of an iterable as they come.'''
+    if isinstance(data, pd.DataFrame):
+        for start in range(0, max(len(data), 1), chunk_rows):
+            yield data.iloc[start:start + chunk_rows]
+    else:
+        yield from data
+
+
+class _Spill:
+    '''Frames hash-partitioned into pickles in a directory, read back in write order.'''
+
+    def __init__(self, directory, partitions, tag):
+        self.directory = directory
+        self.partitions = partitions
+        self.tag = tag
+        self.files = [[] for _ in range(partitions)]
+        self.nbytes = 0
+
+    def add(self, df, keys):
+        which = pd.util.hash_pandas_object(df[keys], index=False).to_numpy() % np.uint64(self.partitions)
+        for p in np.unique(which):
+            path = os.path.join(self.directory, f'{self.tag}_{p}_{len(self.files[p])}.pkl')
+            df[which == p].to_pickle(path)
+            self.nbytes += os.path.getsize(path)
+            self.files[p].append(path)
+
+    def read(self, p):
+        '''Partition `p` as one frame, or None if nothing was written to it.'''
+        if not self.files[p]:
+            return None
+        parts = [pd.read_pickle(path) for path in self.files[p]]
+        for path in self.files[p]:
+            os.remove(path)
+        self.files[p] = []
+        return pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0].reset_index(drop=True)
+
+
+def _no_rows(by, aggs):
+    '''The aggregate of no rows at all, for an input that yielded no chunk.'''
+    columns = list(dict.fromkeys(by + [column for column, _ in aggs.values()]))
+    return pd.DataFrame(columns=columns, dtype=np.float64).groupby(by).agg(**aggs)
+
+
+def _numbered(data, column, chunk_rows):
+    '''Chunks of `data` with their global row positions in `column`.'''
+    start = 0
+    for chunk in _chunks(data, chunk_rows):
+        yield chunk.assign(**{column: np.arange(start, start + len(chunk), dtype=np.int64)})
+        start += len(chunk)
+
+
+def merge_groupby(left, right, on, by, aggs, budget=None, spill_dir=None,
+                  partitions=None, chunk_rows=CHUNK_ROWS):
+    '''
+    ``left.merge(right, on=on).groupby(by).agg(**aggs)`` (inner join) without
+    holding a join larger than `budget` bytes in memory.
+    left, right = frames, or iterables of chunks (which always spill)
+    aggs = named aggregations, e.g. {'proportion': ('reordered', 'mean')}
+    partitions = number of partitions when spilling (default from the estimate)
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    streamed = not isinstance(left, pd.DataFrame) or not isinstance(right, pd.DataFrame)
+    if budget is None and not streamed:
+        return left.merge(right, on=on).groupby(by).agg(**aggs)
+    if not streamed:
+        estimate = estimate_join_bytes(left, right, on)
+        if estimate <= budget:
+            return left.merge(right, on=on).groupby(by).agg(**aggs)
+        reason = f'join on {on!r} estimated at {_format_size(estimate)}, over the {_format_size(budget)} budget'
+    else:
+        estimate = None
+        reason = 'input given in chunks'
+    if partitions is None:
+        partitions = min(MAX_PARTITIONS, max(2, math.ceil(2 * estimate / budget))) if estimate and budget else 16
+    log.info('merge_groupby by %s: %s; spilling to %d partitions', by, reason, partitions)
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        empty = []
+        spills = []
+        for data, tag in ((left, 'left'), (right, 'right')):
+            spill = _Spill(tmp, partitions, tag)
+            head = None
+            for chunk in _numbered(data, f'_{tag}_row', chunk_rows):
+                head = chunk.iloc[:0] if head is None else head
+                spill.add(chunk, [on])
+            empty.append(head)
+            spills.append(spill)
+        lefts, rights = spills
+        log.info('merge_groupby: spilled %s of input', _format_size(lefts.nbytes + rights.nbytes))
+        joined = _Spill(tmp, partitions, 'joined')
+        for p in range(partitions):
+            lp, rp = lefts.read(p), rights.read(p)
+            if lp is None or rp is None:
+                continue
+            part = lp.merge(rp, on=on)
+            if len(part):
+                joined.add(part, by)
+        log.info('merge_groupby: spilled %s of joined rows', _format_size(joined.nbytes))
+        results = []
+        for p in range(partitions):
+            part = joined.read(p)
+            if part is None:
+                continue
+            # the row order of the in-memory join: left rows, then right rows
+            part = part.sort_values(['_left_row', '_right_row'], kind='stable', ignore_index=True)
+            results.append(part.drop(columns=['_left_row', '_right_row']).groupby(by).agg(**aggs))
+    if not results:
+        if empty[0] is None or empty[1] is None:
+            return _no_rows(by, aggs)
+        empty = empty[0].merge(empty[1], on=on).drop(columns=['_left_row', '_right_row'])
+        return empty.groupby(by).agg(**aggs)
+    return pd.concat(results).sort_index()
+
+
+def groupby_agg(data, by, aggs, budget=None, spill_dir=None, partitions=None, chunk_rows=CHUNK_ROWS):
+    '''
+    ``data.groupby(by).agg(**aggs)`` where `data` is a frame or an iterable of
+    chunks; chunks, or a frame over `budget` bytes, are hash-partitioned by
+    the group key on disk and aggregated one partition at a time.
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    if isinstance(data, pd.DataFrame):
+        size = frame_nbytes(data)
+        if budget is None or size <= budget:
+            return data.groupby(by).agg(**aggs)
+        reason = f'input of {_format_size(size)} over the {_format_size(budget)} budget'
+        partitions = partitions or min(MAX_PARTITIONS, max(2, math.ceil(2 * size / budget)))
+    else:
+        reason = 'input given in chunks'
+        partitions = partitions or 16
+    log.info('groupby_agg by %s: %s; spilling to %d partitions', by, reason, partitions)
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        spill = _Spill(tmp, partitions, 'rows')
+        empty = None
+        for chunk in _chunks(data, chunk_rows):
+            empty = chunk.iloc[:0] if empty is None else empty
+            spill.add(chunk, by)
+        log.info('groupby_agg: spilled %s', _format_size(spill.nbytes))
+        results = []
+        for p in range(partitions):
+            part = spill.read(p)
+            if part is not None:
+                results.append(part.groupby(by).agg(**aggs))
+    if results:
+        return pd.concat(results).sort_index()
+    return _no_rows(by, aggs) if empty is None else empty.groupby(by).agg(**aggs)
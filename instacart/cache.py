@@ -0,0 +1,227 @@
+'''
+Memoization of ad-hoc query results keyed on expression and data version.
+
+The notebook's ``df.query(...)``, ``groupby(...).agg(...)`` and
+``value_counts()`` expressions are recomputed from the raw frames each time a
+cell is rerun. ``QueryCache`` stores their results in memory and optionally
+on disk, evicting least recently used entries once a byte budget is reached.
+Because the key includes the data version, a changed table never hits a
+stale entry. A frame loaded by ``data.read_table`` is versioned by its
+file's size and mtime, so a repeated query costs a stat, not a pass over the
+data, until the frame is changed in place; hashing the contents of other
+frames is opt-in (``hash_contents``).
+Results are returned as copies, so callers may modify them freely.
+'''
+import ast
+import hashlib
+import io
+import os
+import pickle
+import sys
+import tokenize
+from collections import OrderedDict
+
+import pandas as pd
+
+from instacart.data import source_version, table_version
+
+
+def normalize_expression(expr):
+    '''
+    Canonical form of an expression so that spacing and quote style
+    do not create separate cache entries.
+    '''
+    tokens = []
+    for tok in tokenize.generate_tokens(io.StringIO(expr.strip()).readline):
+        if tok.type in (tokenize.NEWLINE, tokenize.NL, tokenize.ENDMARKER,
+                        tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT):
+            continue
+        if tok.type == tokenize.STRING:
+            try:
+                tokens.append(repr(ast.literal_eval(tok.string)))
+                continue
+            except (ValueError, SyntaxError):
+                pass
+        tokens.append(tok.string)
+    return ' '.join(tokens)
+
+
+def _nbytes(value):
+    '''Approximate memory footprint of a cached value.'''
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+    return sys.getsizeof(value)
+
+
+def _detach(value):
+    '''A copy of a pandas result, so the cached object is never handed out.'''
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return value.copy()
+    return value
+
+
+class QueryCache:
+    '''
+    Two-level LRU cache for query results.
+    max_bytes = in-memory budget
+    cache_dir = optional directory for the on-disk level
+    disk_max_bytes = on-disk budget
+    hash_contents = version frames that read_table did not load by a hash
+        of their contents (a full pass per lookup) instead of refusing them
+    '''
+
+    def __init__(self, max_bytes=512 * 2**20, cache_dir=None, disk_max_bytes=4 * 2**30,
+                 hash_contents=False):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hash_contents = hash_contents
+        self._entries = OrderedDict()
+        self._versions = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def stats(self):
+        '''Hit/miss counters and current size.'''
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'nbytes': self.nbytes}
+
+    def clear(self):
+        '''Drop all in-memory and on-disk entries.'''
+        self._entries.clear()
+        self._versions.clear()
+        self.nbytes = 0
+        if self.cache_dir is not None:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _path(self, key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.pkl')
+
+    def _put_memory(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.nbytes -= old_size
+            self.evictions += 1
+
+    def _drop(self, key):
+        if key in self._entries:
+            _, size = self._entries.pop(key)
+            self.nbytes -= size
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _put_disk(self, key, value):
+        path = self._path(key)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        files = [os.path.join(self.cache_dir, n) for n in os.listdir(self.cache_dir)
+                 if n.endswith('.pkl')]
+        files = sorted(files, key=os.path.getmtime)
+        total = sum(os.path.getsize(p) for p in files)
+        while total > self.disk_max_bytes and files:
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+            self.evictions += 1
+
+    def get_or_compute(self, expr, version, compute):
+        '''
+        Return the cached result of `expr` at data `version`,
+        calling compute() on a miss.
+        '''
+        expr = normalize_expression(expr)
+        key = (expr, version)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return _detach(self._entries[key][0])
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    value = pickle.load(f)
+                os.utime(path)
+                self.disk_hits += 1
+                self._versions[expr] = version
+                self._put_memory(key, value, _nbytes(value))
+                return _detach(value)
+        self.misses += 1
+        # an older version of the same expression is stale from now on
+        old = self._versions.get(expr)
+        if old is not None and old != version:
+            self._drop((expr, old))
+        value = compute()
+        self._versions[expr] = version
+        self._put_memory(key, value, _nbytes(value))
+        if self.cache_dir is not None:
+            self._put_disk(key, value)
+        return _detach(value)
+
+    def version(self, df):
+        '''
+        Data version of `df`: its file's version (and columns) when read_table
+        loaded it and it is unchanged, else a content hash if hash_contents
+        is set.
+        '''
+        version = source_version(df)
+        if version is not None:
+            # frames read with different usecols share a file
+            return f'{version}:{",".join(map(str, df.columns))}'
+        if self.hash_contents:
+            return table_version(df)
+        raise ValueError('frame has no file version (not loaded by read_table, or changed since); '
+                         'pass version= or create the cache with hash_contents=True')
+
+    def query(self, df, expr, version=None, **kwargs):
+        '''
+        Cached ``df.query(expr)``.
+        Pass ``@`` variables through local_dict; their values are part of the key.
+        '''
+        if version is None:
+            version = self.version(df)
+        key = f'query({normalize_expression(expr)!r})'
+        if kwargs.get('local_dict'):
+            digest = hashlib.blake2b(pickle.dumps(sorted(kwargs['local_dict'].items())),
+                                     digest_size=16).hexdigest()
+            key += f' locals {digest}'
+        return self.get_or_compute(key, version,
+                                   lambda: df.query(expr, **kwargs))
+
+    def value_counts(self, df, column, version=None, **kwargs):
+        '''Cached ``df[column].value_counts(**kwargs)``.'''
+        if version is None:
+            version = self.version(df)
+        expr = f'value_counts({column!r}, {sorted(kwargs.items())!r})'
+        return self.get_or_compute(expr, version,
+                                   lambda: df[column].value_counts(**kwargs))
+
+    def groupby_agg(self, df, by, version=None, **aggs):
+        '''Cached ``df.groupby(by).agg(**aggs)`` with named aggregations.'''
+        if version is None:
+            version = self.version(df)
+        expr = f'groupby({by!r}).agg({sorted(aggs.items())!r})'
+        return self.get_or_compute(expr, version,
+                                   lambda: df.groupby(by).agg(**aggs))
@@ -0,0 +1,138 @@
+'''
+Cart-position statistics per product, aisle and department.
+
+The notebook fills the missing ``add_to_cart_order`` values (baskets over 64
+items) with 999, which corrupts any position statistic. Here a missing
+position is known to be one of 65..basket_size, so each such line gets the
+expected position ``(65 + size) / 2``, is never counted as first or top-3,
+and counts as last with weight ``1 / (size - 64)``. Values above the basket
+size (the 999 sentinel) are treated as missing too.
+
+All statistics are sums and a sparse position histogram per key, so chunks
+can be folded in one by one (streaming) and quantiles read off the merged
+histogram exactly.
+'''
+import numpy as np
+import pandas as pd
+
+from instacart.data import read_table
+
+# add_to_cart_order is only recorded for the first 64 items of a basket
+RECORDED_POSITIONS = 64
+
+LEVELS = ('product_id', 'aisle_id', 'department_id')
+
+_SUMS = ['lines', 'sum_position', 'sum_relative', 'first', 'top3', 'last']
+
+
+def line_positions(df_order_products, sizes):
+    '''
+    Per-line position fields.
+    sizes = basket size per order_id (Series)
+    '''
+    size = sizes.reindex(df_order_products['order_id'].to_numpy()).to_numpy(dtype=np.float64)
+    pos = df_order_products['add_to_cart_order'].to_numpy(dtype=np.float64)
+    missing = np.isnan(pos) | (pos > size)
+    hidden = np.maximum(size - RECORDED_POSITIONS, 1)
+    pos = np.where(missing, (RECORDED_POSITIONS + 1 + size) / 2, pos)
+    last = np.where(missing, 1 / hidden, (pos == size).astype(np.float64))
+    return pd.DataFrame({'product_id': df_order_products['product_id'].to_numpy(),
+                         'position': pos,
+                         'relative': pos / size,
+                         'first': (pos == 1).astype(np.float64),
+                         'top3': (pos <= 3).astype(np.float64),
+                         'last': last})
+
+
+class CartPositionStats:
+    '''
+    Mergeable cart-position accumulator.
+    df_products = maps product_id to aisle_id and department_id
+    '''
+
+    def __init__(self, df_products, levels=LEVELS):
+        self.levels = list(levels)
+        self.lookup = df_products.set_index('product_id')[['aisle_id', 'department_id']]
+        self.sums = {level: None for level in self.levels}
+        self.hist = {level: None for level in self.levels}
+
+    def update(self, df_order_products, sizes):
+        '''
+        Fold in a chunk of order lines.
+        sizes = basket size per order_id for every order in the chunk
+        '''
+        lines = line_positions(df_order_products, sizes)
+        for col in ('aisle_id', 'department_id'):
+            if col in self.levels:
+                lines[col] = self.lookup[col].reindex(lines['product_id'].to_numpy()).to_numpy()
+        lines['lines'] = 1.0
+        lines['sum_position'] = lines['position']
+        lines['sum_relative'] = lines['relative']
+        # positions are whole or half numbers; store the histogram in half units
+        lines['half'] = np.rint(lines['position'] * 2).astype(np.int64)
+        for level in self.levels:
+            sums = lines.groupby(level)[_SUMS].sum()
+            hist = lines.groupby([level, 'half']).size()
+            self.sums[level] = sums if self.sums[level] is None else \
+                self.sums[level].add(sums, fill_value=0)
+            self.hist[level] = hist if self.hist[level] is None else \
+                self.hist[level].add(hist, fill_value=0)
+        return self
+
+    def merge(self, other):
+        '''Combine with an accumulator built over other chunks.'''
+        for level in self.levels:
+            for attr in ('sums', 'hist'):
+                mine, theirs = getattr(self, attr)[level], getattr(other, attr)[level]
+                getattr(self, attr)[level] = theirs if mine is None else \
+                    mine if theirs is None else mine.add(theirs, fill_value=0)
+        return self
+
+    def result(self, level='product_id', quantiles=(0.25, 0.5, 0.75)):
+        '''Distribution of cart positions per key of `level`.'''
+        sums = self.sums[level]
+        out = pd.DataFrame({'lines': sums['lines'].astype(np.int64),
+                            'mean_position': sums['sum_position'] / sums['lines'],
+                            'mean_relative_position': sums['sum_relative'] / sums['lines'],
+                            'share_first': sums['first'] / sums['lines'],
+                            'share_top3': sums['top3'] / sums['lines'],
+                            'share_last': sums['last'] / sums['lines']})
+        hist = self.hist[level].sort_index()
+        keys = hist.index.get_level_values(0)
+        cum = hist.groupby(level=0).cumsum().to_numpy()
+        total = sums['lines'].reindex(keys).to_numpy()
+        values = hist.index.get_level_values(1).to_numpy() / 2
+        for q in quantiles:
+            # smallest position whose cumulative share reaches q
+            hit = cum >= q * total - 1e-9
+            first_hit = pd.Series(values[hit], index=keys[hit]).groupby(level=0).first()
+            name = 'median_position' if q == 0.5 else f'p{int(round(q * 100))}_position'
+            out[name] = first_hit
+        return out
+
+
+def basket_sizes(order_ids):
+    '''Number of lines per order_id.'''
+    return pd.Series(order_ids).value_counts()
+
+
+def cart_position_stats(df_order_products, df_products, levels=LEVELS):
+    '''Cart-position distributions for every level in one grouped pass.'''
+    stats = CartPositionStats(df_products, levels)
+    stats.update(df_order_products, basket_sizes(df_order_products['order_id'].to_numpy()))
+    return {level: stats.result(level) for level in levels}
+
+
+def cart_position_stats_csv(data_dir, df_products, chunksize=5_000_000, levels=LEVELS):
+    '''
+    Streaming variant over order_products.csv: a first pass counts basket
+    sizes from order_id alone, a second folds in the lines chunk by chunk.
+    '''
+    sizes = None
+    for chunk in read_table('order_products', data_dir, usecols=['order_id'], chunksize=chunksize):
+        counts = basket_sizes(chunk['order_id'].to_numpy())
+        sizes = counts if sizes is None else sizes.add(counts, fill_value=0)
+    stats = CartPositionStats(df_products, levels)
+    for chunk in read_table('order_products', data_dir, chunksize=chunksize):
+        stats.update(chunk, sizes)
+    return {level: stats.result(level) for level in levels}
@@ -0,0 +1,105 @@
+'''
+The notebook's cleaning steps as reusable, vectorized functions.
+
+Product names are dictionary-encoded: ``product_name``, ``product_name_lower``
+and ``product_name_lower_2`` are categoricals over one shared dictionary, so
+merging them onto every order line copies small integer codes rather than
+strings. Use ``decode_names`` only when presenting results.
+'''
+import pandas as pd
+
+day_of_week = {0: 'sunday',
+               1: 'monday',
+               2: 'tuesday',
+               3: 'wednesday',
+               4: 'thursday',
+               5: 'friday',
+               6: 'saturday'}
+
+NAME_COLUMNS = ['product_name', 'product_name_lower', 'product_name_lower_2']
+
+
+def normalize_names(names):
+    '''
+    Vectorized normalize_lower/normalize_other from the notebook.
+    Returns (lower, strict) series; missing names stay missing.
+    '''
+    lower = names.str.lower()
+    # lower -> strip -> collapse spaces -> drop hyphens -> drop spaces
+    strict = lower.str.replace('-', '', regex=False).str.replace(r'\s+', '', regex=True)
+    return lower, strict
+
+
+def clean_orders(df_instacart_orders):
+    '''
+    Drop duplicated orders and add the categorical day_of_week column.
+    The duplicates are whole-row copies, so deduplicating on order_id gives the
+    same result and still works when only some columns were loaded.
+    '''
+    if 'order_id' in df_instacart_orders.columns:
+        df = df_instacart_orders.drop_duplicates('order_id').reset_index(drop=True)
+    else:
+        df = df_instacart_orders.drop_duplicates().reset_index(drop=True)
+    if 'order_dow' in df.columns:
+        df['day_of_week'] = df['order_dow'].map(day_of_week).astype('category')
+    return df
+
+
+def encode_names(df, columns=NAME_COLUMNS, extra=('Unknown',)):
+    '''
+    Dictionary-encode the name columns of `df` in place with one shared
+    dictionary; `extra` values are added to the dictionary up front.
+    '''
+    columns = [c for c in columns if c in df.columns]
+    values = pd.concat([df[c].astype(object) for c in columns]).dropna()
+    categories = pd.Index(values.unique()).union(pd.Index(list(extra)))
+    for c in columns:
+        df[c] = pd.Categorical(df[c], categories=categories)
+    return df
+
+
+def decode_names(df, columns=NAME_COLUMNS):
+    '''Copy of `df` with the encoded name columns turned back into strings.'''
+    decoded = {c: df[c].astype(object) for c in columns
+               if c in df.columns and isinstance(df[c].dtype, pd.CategoricalDtype)}
+    return df.assign(**decoded) if decoded else df
+
+
+def clean_products(df_products):
+    '''Add normalized name columns, encode the names and label missing ones 'Unknown'.'''
+    df = df_products.copy()
+    if 'product_name' not in df.columns:
+        return df
+    names = df['product_name'].astype(object)
+    df['product_name_lower'], df['product_name_lower_2'] = normalize_names(names)
+    encode_names(df)
+    df['product_name'] = df['product_name'].fillna('Unknown')
+    return df
+
+
+def clean_order_products(df_order_products, fill_cart_order=999):
+    '''
+    Fill missing add_to_cart_order (baskets over 64 items) as the notebook does.
+    fill_cart_order = sentinel value; None keeps the missing values
+    '''
+    df = df_order_products.copy()
+    if fill_cart_order is not None and 'add_to_cart_order' in df.columns:
+        df['add_to_cart_order'] = df['add_to_cart_order'].fillna(fill_cart_order).astype('int')
+    return df
+
+
+def clean_tables(tables, fill_cart_order=999):
+    '''Apply every cleaning step to the tables present in `tables`.'''
+    cleaned = dict(tables)
+    if 'instacart_orders' in tables:
+        cleaned['instacart_orders'] = clean_orders(tables['instacart_orders'])
+    if 'products' in tables:
+        cleaned['products'] = clean_products(tables['products'])
+    if 'order_products' in tables:
+        cleaned['order_products'] = clean_order_products(tables['order_products'], fill_cart_order)
+    if 'aisles' in tables and 'aisle' in tables['aisles'].columns:
+        cleaned['aisles'] = tables['aisles'].assign(aisle=tables['aisles']['aisle'].astype('category'))
+    if 'departments' in tables and 'department' in tables['departments'].columns:
+        cleaned['departments'] = tables['departments'].assign(
+            department=tables['departments']['department'].astype('category'))
+    return cleaned
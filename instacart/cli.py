@@ -0,0 +1,616 @@
+'''
+Command-line entry point: ``python -m instacart <command> ...``.
+
+Only argparse and the standard library are imported up front; pandas and
+matplotlib are imported inside the commands that need them, so quick
+commands such as ``status`` start fast enough to call from cron.
+'''
+import argparse
+import json
+import os
+import sys
+
+from instacart.analysis import ANALYSES, SPILLABLE
+from instacart.paths import DATA_DIR, FILES, file_version, table_path
+
+FORMATS = ['csv', 'json', 'parquet', 'pickle']
+
+
+def _write_frame(df, path, fmt):
+    '''Write `df` to `path` (stdout for csv/json when path is None).'''
+    if path is None:
+        if fmt not in ('csv', 'json'):
+            raise SystemExit(f'--format {fmt} needs an --output path')
+        if fmt == 'csv':
+            df.to_csv(sys.stdout, index=False)
+        else:
+            sys.stdout.write(df.to_json(orient='records') + '\n')
+        return
+    if fmt == 'csv':
+        df.to_csv(path, index=False)
+    elif fmt == 'json':
+        df.to_json(path, orient='records')
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_pickle(path)
+
+
+def _load(args, names):
+    from instacart.data import load_tables
+    return load_tables(args.data_dir, names, workers=args.read_workers)
+
+
+def cmd_status(args):
+    '''Print size and version of every input file.'''
+    status = {}
+    missing = False
+    for name in FILES:
+        path = table_path(name, args.data_dir)
+        if os.path.exists(path):
+            status[name] = {'path': path,
+                            'bytes': os.path.getsize(path),
+                            'version': file_version(path)}
+        else:
+            status[name] = {'path': path, 'bytes': None, 'version': None}
+            missing = True
+    print(json.dumps(status, indent=2))
+    return 1 if missing else 0
+
+
+def cmd_convert(args):
+    '''Read the csv exports with the typed schema and write them as `--format`.'''
+    os.makedirs(args.output, exist_ok=True)
+    tables = _load(args, args.tables or list(FILES))
+    for name, df in tables.items():
+        path = os.path.join(args.output, f'{name}.{args.format}')
+        _write_frame(df, path, args.format)
+        print(f'wrote {path} ({len(df)} rows)')
+    return 0
+
+
+def cmd_clean(args):
+    '''Apply the notebook's cleaning steps and write the cleaned tables.'''
+    from instacart.clean import clean_tables
+    os.makedirs(args.output, exist_ok=True)
+    tables = clean_tables(_load(args, args.tables or list(FILES)))
+    for name, df in tables.items():
+        path = os.path.join(args.output, f'{name}.{args.format}')
+        _write_frame(df, path, args.format)
+        print(f'wrote {path} ({len(df)} rows)')
+    return 0
+
+
+def cmd_report(args):
+    '''Print the column profile and cleaning invariants of every table.'''
+    from instacart.profile import check_invariants, profile_tables
+    tables = _load(args, args.tables or list(FILES))
+    profiles = profile_tables(tables)
+    invariants = check_invariants(tables, profiles)
+    if args.format == 'json':
+        report = {name: {'rows': p.rows,
+                         'duplicated': p.duplicated,
+                         'key_duplicates': {','.join(k): v for k, v in p.key_duplicates.items()},
+                         'columns': json.loads(p.columns.reset_index().to_json(orient='records'))}
+                  for name, p in profiles.items()}
+        report['invariants'] = json.loads(invariants.to_json(orient='records'))
+        print(json.dumps(report, indent=2))
+    else:
+        for name, p in profiles.items():
+            print(f'== {name}: {p.rows} rows, {p.duplicated} duplicated rows')
+            for key, dups in p.key_duplicates.items():
+                print(f'   duplicated {key}: {dups}')
+            print(p.columns.to_string())
+            print()
+        print(invariants.to_string(index=False))
+    return 0 if invariants['ok'].all() else 1
+
+
+def _budget(args):
+    '''The --memory-budget in bytes (None if unset); spilling is then logged.'''
+    if args.memory_budget is None:
+        return None
+    import logging
+    from instacart.budget import parse_size
+    logging.basicConfig(level=logging.INFO, format='%(name)s: %(message)s')
+    return parse_size(args.memory_budget)
+
+
+def cmd_analysis(args):
+    '''Run one named analysis (or its estimate from a user sample) and write its result.'''
+    from instacart.analysis import run
+    from instacart.clean import clean_tables
+    from instacart.plan import load_for, loaded_bytes, plan
+    if args.sample is None:
+        budget = _budget(args)
+        columns = plan([args.command])
+        if (budget is not None and args.command in SPILLABLE
+                and (loaded_bytes('order_products', columns['order_products'], args.data_dir) or budget) > budget):
+            # the order lines alone would not fit: stream them instead of loading them whole
+            from instacart.budget import CHUNK_ROWS
+            from instacart.data import read_table
+            tables = clean_tables(load_for([args.command], args.data_dir, args.read_workers,
+                                           skip=['order_products']))
+            tables['order_products'] = read_table('order_products', args.data_dir,
+                                                  usecols=columns['order_products'], chunksize=CHUNK_ROWS)
+        else:
+            tables = clean_tables(load_for([args.command], args.data_dir, args.read_workers))
+        result = run(args.command, tables, args.n, budget=budget, spill_dir=args.spill_dir)
+        _write_frame(result, args.output, args.format)
+        return 0
+    from instacart import sample
+    drawn = sample.load([args.command], args.sample, args.seed, args.data_dir, args.read_workers)
+    _write_frame(sample.estimate(args.command, drawn, args.n, args.alpha), args.output, args.format)
+    return 0
+
+
+def cmd_rank(args):
+    '''Rank entities by a numeric metric, keeping those with enough support.'''
+    from instacart.clean import clean_tables
+    from instacart.plan import load_for
+    from instacart.rank import METRICS, format_percent, rank_metric
+    tables = clean_tables(load_for([args.metric], args.data_dir, args.read_workers))
+    kwargs = {'budget': _budget(args), 'spill_dir': args.spill_dir} if args.metric in SPILLABLE else {}
+    result = rank_metric(args.metric, tables, args.k, bottom=args.bottom,
+                         min_support=args.min_support, **kwargs)
+    if args.format != 'text':
+        _write_frame(result, args.output, args.format)
+        return 0
+    _, metric, percent = METRICS[args.metric]
+    if percent:
+        result = format_percent(result, [metric])
+    text = result.to_string(index=False)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+def cmd_plan(args):
+    '''Show the columns the given analyses load and the bytes that avoids.'''
+    from instacart.plan import bytes_avoided
+    print(json.dumps(bytes_avoided(args.analyses, args.data_dir), indent=2))
+    return 0
+
+
+def cmd_render(args):
+    '''Render the notebook's charts as image files.'''
+    from instacart import plots
+    from instacart.analysis import top_first_in_cart, top_products, top_reordered
+    from instacart.clean import clean_tables
+    os.makedirs(args.output, exist_ok=True)
+    from instacart.plan import load_for
+    tables = clean_tables(load_for(['hour-of-day', 'day-of-week', 'top-products',
+                                    'top-reordered', 'first-in-cart'], args.data_dir, args.read_workers))
+
+    def out(name):
+        return os.path.join(args.output, f'{name}.{args.image_format}')
+    plots.plot_hour_of_day(tables, out('timeofhourpeopleshop'))
+    plots.plot_day_of_week(tables, out('dayofweekpeopleshopmost'))
+    plots.plot_top_products(top_products(tables, 20), out('top20itemsfirst'))
+    plots.plot_top_reordered(top_reordered(tables, 20), out('top20reordereditems'))
+    plots.plot_first_in_cart(top_first_in_cart(tables, 20), out('top20firstincart'))
+    print(f'wrote charts to {args.output}')
+    return 0
+
+
+def cmd_recommend(args):
+    '''Write the top-k reorder recommendations for every user.'''
+    from instacart.recommend import recommend
+    tables = _load(args, ['instacart_orders', 'order_products'])
+    recommend(tables, k=args.k, output=args.output, chunk_users=args.chunk_users,
+              workers=args.workers)
+    print(f'wrote {args.output}')
+    return 0
+
+
+def cmd_diff(args):
+    '''Print inserted/deleted/modified counts between two export directories.'''
+    from instacart.diff import diff_snapshots
+    diffs = diff_snapshots(args.old, args.new, names=args.tables, partitions=args.partitions)
+    report = {}
+    for name, d in diffs.items():
+        report[name] = d.summary()
+        if args.keys:
+            for kind in ('inserted', 'deleted', 'modified'):
+                report[name][kind + '_keys'] = json.loads(getattr(d, kind).to_json(orient='records'))
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+def cmd_search(args):
+    '''Look up products by name, most popular first.'''
+    from instacart.search import ProductIndex, product_popularity
+    if args.index and os.path.exists(args.index):
+        index = ProductIndex.load(args.index)
+    else:
+        tables = _load(args, ['products', 'order_products'])
+        index = ProductIndex.build(tables['products'], product_popularity(tables['order_products']))
+        if args.index:
+            index.save(args.index)
+    results = index.search(' '.join(args.query), args.n, prefix=not args.whole_words, fuzzy=not args.exact)
+    for product_id, name, popularity in results:
+        print(f'{product_id}\t{name}\t{popularity}')
+    return 0 if results else 1
+
+
+def cmd_neighbors(args):
+    '''Find users with similar purchases, for given users or for everyone.'''
+    import numpy as np
+    from instacart.neighbors import NeighborIndex, PurchaseVectors, exact_top_k, neighbors_frame, recall
+    if args.index and os.path.exists(args.index):
+        index = NeighborIndex.load(args.index)
+    else:
+        tables = _load(args, ['instacart_orders', 'order_products'])
+        index = NeighborIndex.build(PurchaseVectors.build(tables, args.weighting), dim=args.dim)
+        if args.index:
+            index.save(args.index)
+    vectors = index.vectors
+    if args.verify:
+        rng = np.random.default_rng(args.seed)
+        queries = rng.choice(len(vectors), min(args.verify, len(vectors)), replace=False)
+        approximate, _ = index.batch_search(queries, args.k, args.nprobe, args.rerank)
+        exact, _ = exact_top_k(vectors, args.k, queries)
+        print(json.dumps({'users': len(queries), 'k': args.k, 'nprobe': args.nprobe,
+                          'rerank': args.rerank or 50 * args.k, 'recall': recall(approximate, exact)}, indent=2))
+        return 0
+    if args.users:
+        queries = vectors.rows_of(args.users)
+        queries = queries[queries >= 0]
+    elif args.all:
+        queries = np.arange(len(vectors))
+    else:
+        raise SystemExit('give user ids or --all')
+    if args.exact:
+        rows, scores = exact_top_k(vectors, args.k, queries)
+    elif args.all:
+        rows, scores = index.all_pairs(args.k, args.nprobe, args.rerank, workers=args.workers)
+    else:
+        rows, scores = index.batch_search(queries, args.k, args.nprobe, args.rerank)
+    _write_frame(neighbors_frame(vectors, queries, rows, scores), args.output, args.format)
+    return 0
+
+
+def cmd_segment(args):
+    '''Cluster users into behavioural segments and write labels and profiles.'''
+    from instacart import segment
+    from instacart.budget import CHUNK_ROWS
+    from instacart.clean import clean_tables
+    from instacart.data import read_table
+    from instacart.plan import load_for
+    tables = clean_tables(load_for([], args.data_dir, args.read_workers,
+                                   extra={'instacart_orders': segment.ORDER_COLUMNS}))
+    # order lines are reduced to per-order counts as they are read
+    per_order = segment.order_lines(read_table('order_products', args.data_dir,
+                                               usecols=['order_id', 'reordered'], chunksize=CHUNK_ROWS))
+    orders = segment.prepare_orders(tables, per_order)
+
+    def chunks():
+        return segment.feature_chunks(orders, args.chunk_users)
+    if args.model and os.path.exists(args.model):
+        model = segment.Segmenter.load(args.model)
+    else:
+        model = segment.Segmenter(args.k, args.batch_size, args.epochs, seed=args.seed).fit(chunks)
+        if args.model:
+            model.save(args.model)
+    _, profiles = model.label(chunks, args.output)
+    if args.profiles:
+        profiles.to_csv(args.profiles, index=False)
+    else:
+        print(profiles.to_string(index=False))
+    return 0
+
+
+def cmd_percentiles(args):
+    '''Percentiles of basket size or days between orders from quantile sketches.'''
+    filters = {column: value for column, value in (('order_dow', args.dow), ('order_hour_of_day', args.hour),
+                                                   ('weeks_ago', args.weeks_ago), ('segment', args.segment),
+                                                   ('department_id', args.department)) if value is not None}
+    from instacart.sketch import build_cubes, find_cube, unsupported
+    if unsupported(filters):
+        raise SystemExit(unsupported(filters))
+    if args.aggregates:
+        from instacart.service import Aggregates
+        cubes = Aggregates.load(args.aggregates).quantiles
+        if cubes is None:
+            raise SystemExit(f'{args.aggregates} holds no quantile sketches; publish it again')
+    else:
+        import pandas as pd
+        from instacart.clean import clean_tables
+        tables = clean_tables(_load(args, ['instacart_orders', 'order_products', 'products']))
+        segments = None
+        if args.segments:
+            segments = pd.read_csv(args.segments).set_index('user_id')['segment']
+        cubes = build_cubes(tables, segments)
+    try:
+        result = find_cube(cubes, filters).quantiles(args.measure, args.q, **filters)
+    except KeyError as e:
+        raise SystemExit(e.args[0]) from None
+    _write_frame(result, args.output, args.format)
+    return 0
+
+
+def cmd_serve(args):
+    '''Serve the aggregates over HTTP, reloading when a new data version appears.'''
+    from instacart.service import data_dir_source, published_source, serve
+    source = published_source(args.aggregates) if args.aggregates else data_dir_source(args.data_dir)
+    try:
+        serve(source, args.host, args.port, poll_interval=args.poll)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_publish(args):
+    '''Build the service aggregates and publish them atomically to a file.'''
+    from instacart.service import data_dir_source
+    _, load = data_dir_source(args.data_dir)
+    load().save(args.output)
+    print(f'published {args.output}')
+    return 0
+
+
+def cmd_forecast(args):
+    '''Forecast order and item volumes per dow x hour x department slot.'''
+    from instacart.clean import clean_tables
+    from instacart.forecast import backtest, forecast_slots, peak_slots
+    tables = clean_tables(_load(args, ['instacart_orders', 'order_products', 'products', 'departments']))
+    names = sorted(tables['departments']['department'].dropna().astype(str).unique())
+    if args.department != 'all' and args.department not in names:
+        raise SystemExit(f'unknown department {args.department!r}; choose from: all, ' + ', '.join(names))
+    if args.backtest:
+        print(json.dumps(backtest(tables, args.backtest, args.weeks, args.half_life, args.alpha), indent=2))
+        return 0
+    result = forecast_slots(tables, args.horizon, args.weeks, args.half_life, args.alpha)
+    if args.peaks:
+        result = peak_slots(result, args.peaks, department=args.department)
+    elif args.department != 'all':
+        result = result[result['department'] == args.department]
+    _write_frame(result, args.output, args.format)
+    return 0
+
+
+def _address(text):
+    '''(host, port) from 'host:port'.'''
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def _publish(snapshot, path):
+    '''Print a snapshot, or replace `path` with it atomically.'''
+    if path is None:
+        print(json.dumps(snapshot), flush=True)
+        return
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, path)
+
+
+def cmd_live(args):
+    '''Keep live counters over an order feed and publish snapshots.'''
+    import threading
+    import time
+    from instacart.stream import LiveCounters, follow, serve
+    counters = LiveCounters(k=args.k, half_life=args.half_life, capacity=args.capacity)
+    if args.once:
+        for line in follow(args.file, tail=False):
+            counters.ingest_line(line)
+        _publish(counters.snapshot(), args.output)
+        return 0
+    stop = threading.Event()
+    if args.listen:
+        server = serve(counters, *_address(args.listen))
+        print('listening on {}:{}'.format(*server.server_address), file=sys.stderr)
+    else:
+        def consume():
+            for line in follow(args.file, stop=stop):
+                counters.ingest_line(line)
+        threading.Thread(target=consume, daemon=True).start()
+    try:
+        while True:
+            time.sleep(args.every)
+            _publish(counters.snapshot(), args.output)
+    except KeyboardInterrupt:
+        stop.set()
+    return 0
+
+
+def cmd_feed(args):
+    '''Replay the exported orders as a live feed (stand-in producer).'''
+    from instacart.stream import replay
+    tables = _load(args, ['instacart_orders', 'order_products'])
+    if args.connect:
+        import socket
+        with socket.create_connection(_address(args.connect)) as sock:
+            sent = replay(tables, sock.sendall, args.rate, args.duplicates, args.limit)
+    else:
+        with open(args.output, 'ab') as f:
+            def write(line):
+                f.write(line)
+                f.flush()
+            sent = replay(tables, write, args.rate, args.duplicates, args.limit)
+    print(f'sent {sent} orders', file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='instacart',
+                                     description='Instacart orders analysis')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help=f'directory holding the csv exports (default {DATA_DIR})')
+    parser.add_argument('--read-workers', type=int, default=1,
+                        help='processes used to parse each csv (0: all cores)')
+    parser.add_argument('--memory-budget', metavar='SIZE',
+                        help='e.g. 4G; joins larger than this spill to disk in partitions')
+    parser.add_argument('--spill-dir', help='directory for spilled partitions (default: system temp)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('status', help='show size and version of the input files')
+    p.set_defaults(func=cmd_status)
+
+    for name, func, help_ in [('convert', cmd_convert, 'convert the csv exports to another format'),
+                              ('clean', cmd_clean, 'write cleaned tables')]:
+        p = sub.add_parser(name, help=help_)
+        p.add_argument('-o', '--output', required=True, help='output directory')
+        p.add_argument('--format', choices=FORMATS, default='parquet')
+        p.add_argument('--tables', nargs='+', choices=list(FILES))
+        p.set_defaults(func=func)
+
+    p = sub.add_parser('report', help='profile the tables and check invariants')
+    p.add_argument('--format', choices=['text', 'json'], default='text')
+    p.add_argument('--tables', nargs='+', choices=list(FILES))
+    p.set_defaults(func=cmd_report)
+
+    for name in ANALYSES:
+        p = sub.add_parser(name, help=ANALYSES[name].__doc__.strip().splitlines()[0])
+        p.add_argument('-n', type=int, default=20, help='number of rows for top-n analyses')
+        p.add_argument('-o', '--output', help='output file (stdout if omitted)')
+        p.add_argument('--format', choices=FORMATS, default='csv')
+        p.add_argument('--sample', type=float, metavar='FRACTION',
+                       help='estimate from a stratified sample of this fraction of users')
+        p.add_argument('--seed', type=int, default=0, help='seed of the user sample')
+        p.add_argument('--alpha', type=float, default=0.05, help='1 - confidence level of the bounds')
+        p.set_defaults(func=cmd_analysis)
+
+    p = sub.add_parser('rank', help='top/bottom-K entities by a numeric metric with minimum support')
+    p.add_argument('metric', choices=['product-reorders', 'user-reorders'])
+    p.add_argument('-k', type=int, default=10, help='number of entities')
+    p.add_argument('--bottom', action='store_true', help='lowest values first')
+    p.add_argument('--min-support', type=int, default=10,
+                   help='fewest order lines an entity needs to be ranked')
+    p.add_argument('-o', '--output', help='output file (stdout if omitted)')
+    p.add_argument('--format', choices=['text'] + FORMATS, default='text')
+    p.set_defaults(func=cmd_rank)
+
+    p = sub.add_parser('plan', help='show the columns analyses load and the bytes avoided')
+    p.add_argument('analyses', nargs='+', choices=list(ANALYSES))
+    p.set_defaults(func=cmd_plan)
+
+    p = sub.add_parser('recommend', help='score next-basket reorders for every user')
+    p.add_argument('-k', type=int, default=10, help='products per user')
+    p.add_argument('-o', '--output', required=True, help='output csv file')
+    p.add_argument('--chunk-users', type=int, default=50_000)
+    p.add_argument('--workers', type=int, help='worker processes (default: all cores)')
+    p.set_defaults(func=cmd_recommend)
+
+    p = sub.add_parser('diff', help='compare two export directories by row hashes')
+    p.add_argument('old', help='directory of the previous export')
+    p.add_argument('new', help='directory of the new export')
+    p.add_argument('--tables', nargs='+', choices=list(FILES))
+    p.add_argument('--partitions', type=int, default=1,
+                   help='on-disk hash partitions for exports larger than memory')
+    p.add_argument('--keys', action='store_true', help='list the changed keys too')
+    p.set_defaults(func=cmd_diff)
+
+    p = sub.add_parser('search', help='find products by name, most popular first')
+    p.add_argument('query', nargs='+')
+    p.add_argument('-n', type=int, default=10, help='number of results')
+    p.add_argument('--index', help='saved index (.npz); built from the data and saved there if missing')
+    p.add_argument('--whole-words', action='store_true', help='no prefix match on the last term')
+    p.add_argument('--exact', action='store_true', help='no fuzzy match for misspelt terms')
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser('neighbors', help='users with the most similar purchase histories')
+    p.add_argument('users', nargs='*', type=int, help='user ids to look up')
+    p.add_argument('--all', action='store_true', help='neighbours of every user (nightly batch)')
+    p.add_argument('-k', type=int, default=10, help='neighbours per user')
+    p.add_argument('--exact', action='store_true', help='exact blocked search instead of the index')
+    p.add_argument('--verify', type=int, metavar='N', help='report the recall of the index on N sampled users')
+    p.add_argument('--seed', type=int, default=0, help='seed of the --verify sample')
+    p.add_argument('--nprobe', type=int, default=8, help='inverted lists searched per user')
+    p.add_argument('--rerank', type=int, help='candidates scored exactly per user (default 50 * k)')
+    p.add_argument('--workers', type=int, help='worker processes for --all (default: all cores)')
+    p.add_argument('--index', help='saved index (.npz); built from the data and saved there if missing')
+    p.add_argument('--weighting', choices=['bm25', 'tfidf'], default='bm25')
+    p.add_argument('--dim', type=int, default=64, help='embedding dimensions of the index')
+    p.add_argument('-o', '--output', help='output file (stdout if omitted)')
+    p.add_argument('--format', choices=FORMATS, default='csv')
+    p.set_defaults(func=cmd_neighbors)
+
+    p = sub.add_parser('segment', help='cluster users into behavioural segments')
+    p.add_argument('-k', type=int, default=6, help='number of segments')
+    p.add_argument('-o', '--output', required=True, help='csv of user_id, segment (written chunk by chunk)')
+    p.add_argument('--profiles', help='csv of per-segment profiles (printed if omitted)')
+    p.add_argument('--model', help='saved model (.npz); fitted and saved there if missing')
+    p.add_argument('--chunk-users', type=int, default=500_000, help='users per feature chunk')
+    p.add_argument('--batch-size', type=int, default=4096, help='users per k-means update')
+    p.add_argument('--epochs', type=int, default=3, help='passes over the users')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=cmd_segment)
+
+    p = sub.add_parser('percentiles', help='basket size or reorder interval percentiles from sketches')
+    p.add_argument('measure', choices=['basket_size', 'days_since_prior_order'])
+    p.add_argument('-q', type=float, nargs='+', default=[0.5, 0.9, 0.99], help='quantiles in 0..1')
+    p.add_argument('--dow', help='days of week, e.g. 0 or 0-1')
+    p.add_argument('--hour', help='hours of day, e.g. 8-11,17')
+    p.add_argument('--weeks-ago', help='weeks before the snapshot date, e.g. 0-3')
+    p.add_argument('--department', help='department_id')
+    p.add_argument('--segment', help='segment(s) of --segments')
+    p.add_argument('--segments', help='csv of user_id, segment written by the segment command')
+    p.add_argument('--aggregates', help='read the sketches from a file written by publish')
+    p.add_argument('-o', '--output', help='output file (stdout if omitted)')
+    p.add_argument('--format', choices=FORMATS, default='csv')
+    p.set_defaults(func=cmd_percentiles)
+
+    p = sub.add_parser('serve', help='serve the aggregates as JSON over HTTP')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8000)
+    p.add_argument('--aggregates', help='file written by publish (default: build from --data-dir)')
+    p.add_argument('--poll', type=float, default=5.0, help='seconds between data version checks')
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser('publish', help='build the service aggregates into a file')
+    p.add_argument('-o', '--output', required=True)
+    p.set_defaults(func=cmd_publish)
+
+    p = sub.add_parser('live', help='live counters over an order feed file or socket')
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help='append-only feed file to tail')
+    source.add_argument('--listen', metavar='HOST:PORT', help='accept producers on this address')
+    p.add_argument('--every', type=float, default=5.0, help='seconds between snapshots')
+    p.add_argument('-o', '--output', help='snapshot file to keep replacing (stdout if omitted)')
+    p.add_argument('--once', action='store_true', help='read the --file to its end, print one snapshot')
+    p.add_argument('-k', type=int, default=20, help='products in the top-K lists')
+    p.add_argument('--half-life', type=float, default=3600.0, help='decay of the top-K counts, seconds')
+    p.add_argument('--capacity', type=int, help='counters behind each top-K list (default 50 * k); '
+                                                 'the count error is at most total / capacity')
+    p.set_defaults(func=cmd_live)
+
+    p = sub.add_parser('feed', help='replay the exports as an order feed (for testing)')
+    target = p.add_mutually_exclusive_group(required=True)
+    target.add_argument('-o', '--output', help='feed file to append to')
+    target.add_argument('--connect', metavar='HOST:PORT', help='send to a live --listen address')
+    p.add_argument('--rate', type=float, help='orders per second (default: as fast as possible)')
+    p.add_argument('--duplicates', type=float, default=0.01, help='share of orders sent twice')
+    p.add_argument('--limit', type=int, help='stop after this many orders')
+    p.set_defaults(func=cmd_feed)
+
+    p = sub.add_parser('forecast', help='forecast orders and items per dow x hour x department slot')
+    p.add_argument('--horizon', type=int, default=4, help='weeks ahead')
+    p.add_argument('--weeks', type=int, default=26, help='weeks of history fitted')
+    p.add_argument('--half-life', type=float, default=8.0, help='weeks after which history counts half')
+    p.add_argument('--alpha', type=float, default=0.05, help='1 - coverage of the prediction intervals')
+    p.add_argument('--department', default='all', help='department name (default: all departments together)')
+    p.add_argument('--peaks', type=int, metavar='N', help='only the N busiest slots of next week')
+    p.add_argument('--backtest', type=int, metavar='WEEKS',
+                   help='score forecasts of the last WEEKS weeks instead of forecasting')
+    p.add_argument('-o', '--output', help='output file (stdout if omitted)')
+    p.add_argument('--format', choices=FORMATS, default='csv')
+    p.set_defaults(func=cmd_forecast)
+
+    p = sub.add_parser('render', help='render the charts as image files')
+    p.add_argument('-o', '--output', default='.', help='output directory')
+    p.add_argument('--image-format', choices=['png', 'svg', 'pdf'], default='png')
+    p.set_defaults(func=cmd_render)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.func is cmd_live and args.once and args.file is None:
+        parser.error('live --once reads a --file to its end; it cannot be used with --listen')
+    return args.func(args)
@@ -0,0 +1,211 @@
+'''
+Cohort retention: how many users of each cohort reach order 2, 3, ..., N,
+and the median days between orders at each step.
+
+"First-order period" cohorts count periods of ``period_days`` on one global
+day axis, relative to a reference day fixed when the matrix is built (the
+end of the build snapshot): cohort 0 first ordered within the last period
+before it, cohort -1 the period before that, and users first seen in later
+updates get cohorts 1, 2, ... Orders carrying a ``date`` column (days on
+any fixed axis) are placed by it. The export has no dates, so otherwise
+they are reconstructed as in ``forecast.order_dates``, relative to the
+latest date so far; in updates a returning user's orders follow their last
+known date by ``days_since_prior_order``. Cohorts can also be the dow or
+hour of the user's first order.
+
+``activity`` counts the users of each cohort still ordering 0, 1, 2, ...
+periods after their first. It needs observed dates: a reconstructed last
+order says nothing about when a user stopped, so such users are censored
+(left out) rather than counted as active at the end.
+
+State is one compact row per user (cohort, orders so far, first and last
+order date, whether the last date was observed) plus a histogram of integer
+``days_since_prior_order`` per (cohort, order_number), so new orders update
+the matrix incrementally, existing users keep their cohort and medians stay
+exact.
+'''
+import numpy as np
+import pandas as pd
+
+from instacart.forecast import order_dates
+from instacart.timeline import segment_starts, user_timeline
+
+COHORTS = ('period', 'dow', 'hour')
+
+
+def _dated_timeline(orders, last_date, end):
+    '''
+    Timeline of `orders` (sorted by user, order_number) with a global `date`,
+    the batch's end date and whether the dates were observed.
+    last_date = Series of the last known order date by user_id
+    end = latest date seen so far, for a batch with no returning users
+    '''
+    timeline = user_timeline(orders)
+    if 'date' in orders.columns:
+        dates = orders.drop_duplicates('order_id').set_index('order_id')['date']
+        date = dates.reindex(timeline['order_id'].to_numpy()).to_numpy(np.float64)
+        timeline['date'] = date.astype(np.int32)
+        return timeline, int(date.max()), True
+    users = timeline['user_id'].to_numpy()
+    starts = segment_starts(users)
+    idx = np.flatnonzero(starts)
+    lengths = np.diff(np.append(idx, len(users)))
+    day = timeline['day'].to_numpy(np.int64)
+    # a returning user's first order here follows their last known one
+    gap = np.nan_to_num(timeline['days_since_prior_order'].to_numpy(np.float64)[idx])
+    prev = last_date.reindex(users[idx]).to_numpy(np.float64) + gap
+    date = np.repeat(prev, lengths) + day
+    returning = ~np.isnan(date)
+    if returning.any():
+        end = max(end, int(date[returning].max()))
+    if not returning.all():
+        # new users are dated as in forecast.order_dates, before the batch's end
+        new = timeline.loc[~returning, 'order_id'].to_numpy()
+        fresh = order_dates(orders[orders['order_id'].isin(new)]).set_index('order_id')['date']
+        date[~returning] = end + fresh.reindex(new).to_numpy()
+    timeline['date'] = date.astype(np.int32)
+    return timeline, end, False
+
+
+def _user_cohorts(timeline, by, period_days, reference):
+    '''Cohort code per user from a dated timeline (sorted by user, order_number).'''
+    first = timeline.drop_duplicates('user_id', keep='first').set_index('user_id')
+    if by == 'dow':
+        return first['order_dow'].astype(np.int16)
+    if by == 'hour':
+        return first['order_hour_of_day'].astype(np.int16)
+    if by == 'period':
+        return (-((reference - first['date']) // period_days)).astype(np.int16)
+    raise ValueError(f'cohort must be one of {COHORTS}')
+
+
+def _days_histogram(orders, cohorts):
+    '''Counts per (cohort, order_number, days) of non-first orders.'''
+    orders = orders[orders['order_number'] > 1]
+    orders = orders[orders['days_since_prior_order'].notna()]
+    frame = pd.DataFrame({'cohort': cohorts.reindex(orders['user_id'].to_numpy()).to_numpy(),
+                          'order_number': orders['order_number'].to_numpy(np.int16),
+                          'days': np.rint(orders['days_since_prior_order'].to_numpy()).astype(np.int16)})
+    return frame.groupby(['cohort', 'order_number', 'days']).size()
+
+
+class CohortRetention:
+    '''
+    Retention matrix by cohort and order_number, updatable with new orders.
+    by = 'period' (reconstructed first-order period), 'dow' or 'hour'
+    '''
+
+    def __init__(self, by='period', period_days=7):
+        if by not in COHORTS:
+            raise ValueError(f'cohort must be one of {COHORTS}')
+        self.by = by
+        self.period_days = period_days
+        # day of the global axis that ends cohort 0; fixed by the first batch
+        self.reference = None
+        self.end = 0
+        self.users = pd.DataFrame({'cohort': pd.Series(dtype=np.int16),
+                                   'orders': pd.Series(dtype=np.int16),
+                                   'first_date': pd.Series(dtype=np.int32),
+                                   'last_date': pd.Series(dtype=np.int32),
+                                   'observed': pd.Series(dtype=bool)})
+        self.days = pd.Series(dtype=np.int64)
+
+    @classmethod
+    def build(cls, df_instacart_orders, by='period', period_days=7):
+        '''Build from the full orders table; its end becomes the reference day.'''
+        self = cls(by, period_days)
+        self.update(df_instacart_orders)
+        return self
+
+    def update(self, df_new_orders):
+        '''
+        Fold in new orders. Orders at or below a user's known order count are
+        ignored, so replaying a batch is harmless. Known users keep their
+        cohort; users seen for the first time get theirs from these orders,
+        against the reference day of the build.
+        '''
+        orders = df_new_orders.drop_duplicates('order_id')
+        known = self.users['orders'].reindex(orders['user_id'].to_numpy()).fillna(0).to_numpy()
+        orders = orders[orders['order_number'].to_numpy() > known]
+        if orders.empty:
+            return self
+        timeline, end, observed = _dated_timeline(orders, self.users['last_date'], self.end)
+        if self.reference is None:
+            self.reference = end
+        self.end = max(self.end, end)
+        is_new = ~timeline['user_id'].isin(self.users.index)
+        new_cohorts = _user_cohorts(timeline[is_new], self.by, self.period_days, self.reference)
+        first = timeline[is_new].drop_duplicates('user_id', keep='first').set_index('user_id')
+        last = timeline.drop_duplicates('user_id', keep='last').set_index('user_id')
+        users = self.users.reindex(self.users.index.union(last.index))
+        users.loc[new_cohorts.index, 'cohort'] = new_cohorts
+        users.loc[first.index, 'first_date'] = first['date']
+        users['orders'] = np.maximum(users['orders'].fillna(0), last['order_number'].reindex(users.index).fillna(0))
+        users.loc[last.index, 'last_date'] = last['date']
+        users.loc[last.index, 'observed'] = observed
+        self.users = users.astype({'cohort': np.int16, 'orders': np.int16, 'first_date': np.int32,
+                                   'last_date': np.int32, 'observed': bool})
+        hist = _days_histogram(timeline, self.users['cohort'])
+        self.days = hist if self.days.empty else self.days.add(hist, fill_value=0).astype(np.int64)
+        return self
+
+    def retention(self, normalize=False, max_orders=None):
+        '''
+        Users per cohort (rows) reaching each order_number (columns).
+        normalize = divide by cohort size
+        '''
+        counts = pd.crosstab(self.users['cohort'], self.users['orders'])
+        counts = counts.reindex(columns=range(1, int(counts.columns.max()) + 1), fill_value=0)
+        reached = counts.iloc[:, ::-1].cumsum(axis=1).iloc[:, ::-1]
+        if max_orders is not None:
+            reached = reached.loc[:, :max_orders]
+        reached.columns.name = 'order_number'
+        if normalize:
+            return reached.div(reached[1], axis=0)
+        return reached
+
+    def activity(self, normalize=False, max_periods=None):
+        '''
+        Users per cohort (rows) whose last order is at least 0, 1, 2, ...
+        periods of period_days after their first (columns), among those
+        followed that long; periods are counted on the cohort grid and end
+        at the latest date seen. Users whose last date was reconstructed are
+        censored.
+        normalize = divide by the users of the cohort followed that long
+        '''
+        users = self.users[self.users['observed']]
+        if users.empty:
+            raise ValueError('activity needs orders with a date column')
+
+        def period(date):
+            return -((self.reference - date) // self.period_days)
+
+        start = period(users['first_date'])
+        last = (period(users['last_date']) - start).to_numpy()
+        followed = (period(self.end) - start).to_numpy()
+        columns = pd.RangeIndex(int(followed.max()) + 1 if max_periods is None else max_periods + 1,
+                                name='periods')
+        cohort = users['cohort'].to_numpy()
+        active = pd.DataFrame({k: pd.Series(last >= k).groupby(cohort).sum() for k in columns})
+        seen = pd.DataFrame({k: pd.Series(followed >= k).groupby(cohort).sum() for k in columns})
+        active.columns.name = seen.columns.name = 'periods'
+        active.index.name = seen.index.name = 'cohort'
+        active = active.where(seen > 0)
+        return active / seen.where(seen > 0) if normalize else active
+
+    def median_days(self, max_orders=None):
+        '''
+        Median days_since_prior_order per cohort (rows) and order_number
+        (columns); the lower median when a cell has an even count.
+        '''
+        hist = self.days.sort_index()
+        cum = hist.groupby(level=[0, 1]).cumsum()
+        total = hist.groupby(level=[0, 1]).sum()
+        half = total.reindex(hist.index.droplevel(2)).to_numpy() / 2
+        hit = cum.to_numpy() >= half
+        medians = pd.Series(hist.index.get_level_values(2)[hit], index=hist.index.droplevel(2)[hit])
+        medians = medians.groupby(level=[0, 1]).first()
+        table = medians.unstack('order_number')
+        if max_orders is not None:
+            table = table.loc[:, :max_orders]
+        return table
@@ -0,0 +1,150 @@
+'''
+Loading helpers for the ';'-separated Instacart exports.
+
+The notebook reads every file with a hard-coded ``/datasets/...`` path and
+pandas' default dtypes; these helpers take the directory as a parameter and
+use compact dtypes so the same frames take far less memory.
+'''
+import hashlib
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from instacart.paths import DATA_DIR, FILES, SEP, compression, file_version, table_path  # noqa: F401
+
+# compact dtypes for every source column (float where the column has NaN)
+SCHEMA = {'instacart_orders': {'order_id': 'int32',
+                               'user_id': 'int32',
+                               'order_number': 'int16',
+                               'order_dow': 'int8',
+                               'order_hour_of_day': 'int8',
+                               'days_since_prior_order': 'float32'},
+          'products': {'product_id': 'int32',
+                       'product_name': 'object',
+                       'aisle_id': 'int16',
+                       'department_id': 'int8'},
+          'aisles': {'aisle_id': 'int16',
+                     'aisle': 'object'},
+          'departments': {'department_id': 'int8',
+                          'department': 'object'},
+          'order_products': {'order_id': 'int32',
+                             'product_id': 'int32',
+                             'add_to_cart_order': 'float32',
+                             'reordered': 'int8'}}
+
+# rows per chunk when a single process filters a table while reading it
+KEEP_CHUNK_ROWS = 2**22
+
+
+def read_table(name, data_dir=DATA_DIR, usecols=None, workers=1, keep=None, **kwargs):
+    '''
+    Read one table with the typed schema; gzip and zstd exports are read
+    directly from the compressed file.
+    usecols = optional subset of columns to parse
+    workers = processes for the byte-range parallel reader (None or 0: all cores)
+    keep = optional (column, ids): only rows whose `column` is in `ids` are
+        kept, filtered block by block as the file is parsed
+    '''
+    dtype = SCHEMA[name]
+    if usecols is not None:
+        dtype = {c: dtype[c] for c in usecols}
+    path = table_path(name, data_dir)
+    kind = compression(path)
+    version = file_version(path)
+    if keep is not None:
+        from instacart.reader import row_filter
+        keep = row_filter(*keep)
+    if workers != 1 and not kwargs:
+        from instacart.reader import read_csv_parallel, read_csv_stream
+        reader = read_csv_stream if kind else read_csv_parallel
+        df = reader(path, dtype=dtype, usecols=usecols, workers=workers, keep=keep)
+    elif keep is not None:
+        from instacart.reader import keep_rows
+        if kwargs:
+            raise ValueError('keep cannot be combined with other read_csv options')
+        chunks = pd.read_csv(path, sep=SEP, usecols=usecols, dtype=dtype,
+                             compression=kind, chunksize=KEEP_CHUNK_ROWS)
+        parts = [keep_rows(chunk, keep) for chunk in chunks]
+        df = (pd.concat(parts, ignore_index=True) if parts else
+              pd.read_csv(path, sep=SEP, usecols=usecols, dtype=dtype, compression=kind, nrows=0))
+    else:
+        # pandas decompresses gzip/zstd as a stream; no temporary file is written
+        df = pd.read_csv(path, sep=SEP, usecols=usecols, dtype=dtype,
+                         compression=kind, **kwargs)
+    if isinstance(df, pd.DataFrame) and keep is None:
+        # a filtered read is not the file's content
+        _remember_version(df, version)
+    return df
+
+
+# file versions of the frames read_table returned, by frame identity; a frame
+# derived from one (filtered, cleaned, copied) is a new object and has none
+_FILE_VERSIONS = {}
+
+
+def _copy_on_write():
+    return int(pd.__version__.split('.')[0]) >= 3 or pd.options.mode.copy_on_write is True
+
+
+def _arrays(df):
+    '''Identity of the columns and arrays behind `df`.'''
+    return tuple(df.columns), tuple(id(values) for values in df._mgr.arrays)
+
+
+def _remember_version(df, version):
+    if not _copy_on_write():
+        # an in-place write would change the data under the same arrays
+        return
+    key = id(df)
+    # the shallow copy shares the arrays, so under Copy-on-Write any write to
+    # `df` (setting values, adding or dropping columns, inplace=True methods)
+    # first replaces the arrays it touches; holding it also keeps the old
+    # arrays' ids from being reused
+    _FILE_VERSIONS[key] = (version, df.copy(deep=False), _arrays(df))
+    weakref.finalize(df, _FILE_VERSIONS.pop, key, None)
+
+
+def source_version(df):
+    '''
+    file_version of the file `df` was read from by read_table, or None,
+    also once `df` has been changed in place since it was read.
+    '''
+    entry = _FILE_VERSIONS.get(id(df))
+    if entry is None:
+        return None
+    version, _, arrays = entry
+    if _arrays(df) != arrays:
+        # edited: the file no longer describes it
+        _FILE_VERSIONS[id(df)] = (None, None, None)
+        return None
+    return version
+
+
+def load_tables(data_dir=DATA_DIR, names=None, workers=1):
+    '''Read the tables in `names` (default: all five) into a dict of frames.'''
+    if names is None:
+        names = list(FILES)
+    return {name: read_table(name, data_dir, workers=workers) for name in names}
+
+
+def table_version(df):
+    '''
+    Return a content fingerprint of a frame.
+    Any change to values, column names or dtypes gives a new version.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr([(c, str(t)) for c, t in df.dtypes.items()]).encode())
+    h.update(np.int64(len(df)).tobytes())
+    if len(df):
+        h.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def tables_version(tables):
+    '''Return a single fingerprint for a dict of frames.'''
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(tables):
+        h.update(name.encode())
+        h.update(table_version(tables[name]).encode())
+    return h.hexdigest()
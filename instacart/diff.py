@@ -0,0 +1,140 @@
+'''
+What changed between two exports of the same tables.
+
+Each version is read in chunks and reduced to two arrays per table: an int64
+key (order_id, order_id+product_id, product_id, ...) and a 64-bit hash of the
+remaining columns. With ``partitions > 1`` the arrays are hash-partitioned by
+key into files on disk while reading, and partitions are compared one at a
+time, so neither version has to fit in memory. Comparing sorted keys gives
+the inserted, deleted and modified keys; ``select_rows`` pulls the matching
+rows out of the new version for incremental updates downstream (for example
+``CohortRetention.update``).
+'''
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from instacart.data import read_table
+
+KEYS = {'instacart_orders': ['order_id'],
+        'order_products': ['order_id', 'product_id'],
+        'products': ['product_id'],
+        'aisles': ['aisle_id'],
+        'departments': ['department_id']}
+
+
+def encode_keys(df, key_columns):
+    '''One int64 per row from up to two non-negative integer key columns.'''
+    first = df[key_columns[0]].to_numpy().astype(np.int64)
+    if len(key_columns) == 1:
+        return first
+    return (first << 32) | df[key_columns[1]].to_numpy().astype(np.int64)
+
+
+def decode_keys(keys, key_columns):
+    '''Inverse of encode_keys, as a frame of key columns.'''
+    if len(key_columns) == 1:
+        return pd.DataFrame({key_columns[0]: keys})
+    return pd.DataFrame({key_columns[0]: keys >> 32, key_columns[1]: keys & 0xFFFFFFFF})
+
+
+def row_hashes(df, key_columns):
+    '''(keys, hashes) of a chunk; the hash covers every non-key column.'''
+    values = df[[c for c in df.columns if c not in key_columns]]
+    if values.shape[1]:
+        hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    else:
+        hashes = np.zeros(len(df), dtype=np.uint64)
+    return encode_keys(df, key_columns), hashes
+
+
+def diff_arrays(old_keys, old_hashes, new_keys, new_hashes):
+    '''
+    Inserted, deleted and modified keys between two (keys, hashes) sets.
+    A key repeated within a version counts once, with its first row.
+    '''
+    old_keys, idx = np.unique(old_keys, return_index=True)
+    old_hashes = old_hashes[idx]
+    new_keys, idx = np.unique(new_keys, return_index=True)
+    new_hashes = new_hashes[idx]
+    common, i_old, i_new = np.intersect1d(old_keys, new_keys, assume_unique=True, return_indices=True)
+    inserted = np.setdiff1d(new_keys, common, assume_unique=True)
+    deleted = np.setdiff1d(old_keys, common, assume_unique=True)
+    modified = common[old_hashes[i_old] != new_hashes[i_new]]
+    return inserted, deleted, modified
+
+
+class TableDiff:
+    '''Inserted, deleted and modified keys of one table.'''
+
+    def __init__(self, name, key_columns, inserted, deleted, modified):
+        self.name = name
+        self.key_columns = key_columns
+        self.inserted = decode_keys(inserted, key_columns)
+        self.deleted = decode_keys(deleted, key_columns)
+        self.modified = decode_keys(modified, key_columns)
+
+    def summary(self):
+        return {'inserted': len(self.inserted),
+                'deleted': len(self.deleted),
+                'modified': len(self.modified)}
+
+    def __repr__(self):
+        return f'TableDiff({self.name!r}, {self.summary()})'
+
+
+def _hash_version(name, data_dir, key_columns, chunksize, partitions, spill_dir, tag):
+    '''Per-partition (keys, hashes); spilled to .npy files when partitioned.'''
+    parts = [[] for _ in range(partitions)]
+    for c, chunk in enumerate(read_table(name, data_dir, chunksize=chunksize)):
+        keys, hashes = row_hashes(chunk, key_columns)
+        if partitions == 1:
+            parts[0].append((keys, hashes))
+            continue
+        which = keys % partitions
+        for p in range(partitions):
+            mask = which == p
+            path = os.path.join(spill_dir, f'{tag}_{p}_{c}.npy')
+            np.save(path, np.stack([keys[mask], hashes[mask].view(np.int64)]))
+            parts[p].append(path)
+    return parts
+
+
+def _load_part(items):
+    if not items:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64)
+    if isinstance(items[0], str):
+        arrays = [np.load(path) for path in items]
+        for path in items:
+            os.remove(path)
+        return (np.concatenate([a[0] for a in arrays]),
+                np.concatenate([a[1] for a in arrays]).view(np.uint64))
+    return np.concatenate([k for k, _ in items]), np.concatenate([h for _, h in items])
+
+
+def diff_table(name, old_dir, new_dir, chunksize=5_000_000, partitions=1, spill_dir=None):
+    '''
+    Diff one table between the exports in `old_dir` and `new_dir`.
+    partitions = number of on-disk hash partitions (1 keeps everything in memory)
+    '''
+    key_columns = KEYS[name]
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        old = _hash_version(name, old_dir, key_columns, chunksize, partitions, tmp, 'old')
+        new = _hash_version(name, new_dir, key_columns, chunksize, partitions, tmp, 'new')
+        results = [diff_arrays(*_load_part(old[p]), *_load_part(new[p])) for p in range(partitions)]
+    inserted, deleted, modified = (np.sort(np.concatenate([r[i] for r in results])) for i in range(3))
+    return TableDiff(name, key_columns, inserted, deleted, modified)
+
+
+def diff_snapshots(old_dir, new_dir, names=None, **kwargs):
+    '''Diff every table (or those in `names`) between two export directories.'''
+    return {name: diff_table(name, old_dir, new_dir, **kwargs) for name in (names or KEYS)}
+
+
+def select_rows(df, keys):
+    '''Rows of `df` whose key columns appear in the `keys` frame.'''
+    key_columns = list(keys.columns)
+    wanted = encode_keys(keys, key_columns)
+    return df[np.isin(encode_keys(df, key_columns), wanted)]
@@ -0,0 +1,190 @@
+'''
+Demand forecasts per delivery slot: day of week x hour x department.
+
+Dates are days before the snapshot date (day 0), the same for every user.
+Orders carrying a ``date`` column are placed by it. The export has no dates,
+so otherwise each user's timeline ends some time before the snapshot: the
+elapsed time since a user's last order is drawn from that user's own gaps
+(uniform over a length-biased gap, as at a random moment of a renewal
+process). Putting every last order on day 0 instead would empty the weeks
+just before it and turn the history into a ramp. Each slot gets a weekly
+series of orders (orders holding at least one item of the department; "all"
+counts every order) and of items (order lines).
+
+Every slot series is modelled as its own weekly baseline plus a linear
+trend, fitted by weighted least squares with exponentially decaying weights
+on older weeks. All slots share the same design, so the fit is a handful of
+matrix-vector products over a (slots x weeks) array, with no per-slot model
+objects. Prediction intervals combine the residual variance (at least the
+Poisson variance of the forecast count) with the uncertainty of the fitted
+level and trend.
+'''
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from instacart.clean import day_of_week
+from instacart.timeline import user_timeline
+
+# department code of the all-departments slots
+ALL = 0
+
+
+def order_dates(df_instacart_orders):
+    '''
+    Orders with a `date`: days relative to the snapshot date (0, the latest
+    date; earlier days are negative). Taken from a `date` column when there
+    is one, else reconstructed from the user timelines.
+    '''
+    timeline = user_timeline(df_instacart_orders)
+    if 'date' in df_instacart_orders.columns:
+        dates = df_instacart_orders.drop_duplicates('order_id').set_index('order_id')['date']
+        date = dates.reindex(timeline['order_id'].to_numpy()).to_numpy(np.int64)
+        return timeline.assign(date=(date - date.max(initial=0)).astype(np.int32))
+    user = timeline['user_id']
+    span = timeline.groupby(user, sort=False)['day'].transform('max')
+    gap = timeline['days_since_prior_order'].astype(np.float64).where(timeline['order_number'] > 1)
+    # mean length of the gap a random moment falls in: E[X^2] / E[X]
+    biased = ((gap ** 2).groupby(user, sort=False).transform('mean')
+              / gap.groupby(user, sort=False).transform('mean'))
+    biased = biased.fillna(biased.median()).fillna(0)
+    # a fixed uniform draw per user, so the same orders always get the same dates
+    u = pd.util.hash_pandas_object(user, index=False).to_numpy() / np.float64(2 ** 64)
+    elapsed = np.floor(u * (biased.to_numpy() + 1))
+    return timeline.assign(date=(timeline['day'] - span - elapsed).astype(np.int32))
+
+
+class SlotSeries:
+    '''
+    Weekly order and item counts per slot.
+    keys = order_dow, order_hour_of_day, department_id (0 = all) per slot
+    orders, items = (slots x weeks) arrays, oldest week first
+    '''
+
+    def __init__(self, keys, orders, items):
+        self.keys = keys
+        self.orders = orders
+        self.items = items
+
+    @classmethod
+    def build(cls, tables, weeks=26):
+        '''Count the `weeks` weeks before the snapshot date, the week ending on it last.'''
+        dated = order_dates(tables['instacart_orders'])
+        weeks_ago = (-dated['date'].to_numpy()) // 7
+        keep = weeks_ago < weeks
+        dated, week = dated[keep], weeks - 1 - weeks_ago[keep]
+        slot = dated['order_dow'].to_numpy(np.int64) * 24 + dated['order_hour_of_day'].to_numpy(np.int64)
+
+        departments = np.sort(tables['products']['department_id'].dropna().unique()).astype(np.int64)
+        n_dept = len(departments) + 1
+        op = tables['order_products']
+        row = pd.Index(dated['order_id']).get_indexer(op['order_id'])
+        products = tables['products'].drop_duplicates('product_id').set_index('product_id')['department_id']
+        dept = products.reindex(op['product_id'].to_numpy()).to_numpy()
+        known = (row >= 0) & ~np.isnan(dept.astype(np.float64))
+        row, dept = row[known], np.searchsorted(departments, dept[known].astype(np.int64)) + 1
+
+        size = 7 * 24 * n_dept * weeks
+
+        def counts(slots, depts, weeks_):
+            return np.bincount((slots * n_dept + depts) * weeks + weeks_, minlength=size)
+
+        items = counts(slot[row], dept, week[row]) + counts(slot[row], np.full(len(row), ALL), week[row])
+        pairs = np.unique(row.astype(np.int64) * n_dept + dept)
+        order_rows, order_depts = pairs // n_dept, pairs % n_dept
+        orders = (counts(slot[order_rows], order_depts, week[order_rows])
+                  + counts(slot, np.full(len(slot), ALL), week))
+
+        grid = np.arange(7 * 24 * n_dept)
+        keys = pd.DataFrame({'order_dow': grid // (24 * n_dept),
+                             'order_hour_of_day': grid // n_dept % 24,
+                             'department_id': np.r_[ALL, departments][grid % n_dept]})
+        shape = (len(grid), weeks)
+        return cls(keys, orders.reshape(shape).astype(np.float64), items.reshape(shape).astype(np.float64))
+
+
+class TrendModel:
+    '''
+    Baseline plus linear trend for every row of a (series x weeks) array,
+    fitted at once by weighted least squares.
+    half_life = weeks after which a week's weight halves (None: equal weights)
+    '''
+
+    def __init__(self, half_life=8.0):
+        self.half_life = half_life
+
+    def fit(self, y):
+        n = y.shape[1]
+        if n < 3:
+            raise ValueError('need at least 3 weeks of history')
+        t = np.arange(n, dtype=np.float64)
+        w = np.ones(n) if self.half_life is None else 0.5 ** ((n - 1 - t) / self.half_life)
+        sw = w.sum()
+        self.t_mean = (w * t).sum() / sw
+        dt = t - self.t_mean
+        sxx = (w * dt * dt).sum()
+        self.level = y @ w / sw
+        self.slope = (y @ (w * dt)) / sxx
+        resid = y - self.level[:, None] - self.slope[:, None] * dt
+        n_eff = sw ** 2 / (w ** 2).sum()
+        self.sigma2 = (resid ** 2 @ w) / sw * n_eff / max(n_eff - 2, 1)
+        # variance factors of the fitted level and slope, the same for every series
+        self._a = (w ** 2).sum() / sw ** 2
+        self._b = (w ** 2 * dt ** 2).sum() / sxx ** 2
+        self._c = (w ** 2 * dt).sum() / (sw * sxx)
+        self.n = n
+        return self
+
+    def forecast(self, horizon=4, alpha=0.05):
+        '''(mean, lower, upper) arrays of shape (series x horizon).'''
+        h = self.n - 1 + np.arange(1, horizon + 1) - self.t_mean
+        mean = np.maximum(self.level[:, None] + self.slope[:, None] * h, 0)
+        noise = np.maximum(self.sigma2[:, None], mean)
+        fit_var = self.sigma2[:, None] * (self._a + 2 * h * self._c + h ** 2 * self._b)
+        z = NormalDist().inv_cdf(1 - alpha / 2)
+        spread = z * np.sqrt(noise + fit_var)
+        return mean, np.maximum(mean - spread, 0), mean + spread
+
+
+def forecast_slots(tables, horizon=4, weeks=26, half_life=8.0, alpha=0.05):
+    '''
+    Order and item forecasts with prediction intervals for every
+    dow x hour x department slot over the next `horizon` weeks.
+    '''
+    series = SlotSeries.build(tables, weeks)
+    frames = {}
+    for measure in ('orders', 'items'):
+        mean, lower, upper = TrendModel(half_life).fit(getattr(series, measure)).forecast(horizon, alpha)
+        frames[measure] = mean.ravel()
+        frames[f'{measure}_lower'] = lower.ravel()
+        frames[f'{measure}_upper'] = upper.ravel()
+    keys = series.keys.loc[series.keys.index.repeat(horizon)].reset_index(drop=True)
+    keys.insert(1, 'day_of_week', keys['order_dow'].map(day_of_week))
+    names = tables['departments'].set_index('department_id')['department'].astype(object)
+    keys['department'] = keys['department_id'].map(names).where(keys['department_id'] != ALL, 'all')
+    keys['week_ahead'] = np.tile(np.arange(1, horizon + 1), len(series.keys))
+    return pd.concat([keys, pd.DataFrame(frames)], axis=1)
+
+
+def peak_slots(forecast, n=10, measure='orders', department='all', week_ahead=1):
+    '''The `n` slots with the highest forecast `measure` for one department and week.'''
+    rows = forecast[(forecast['department'] == department) & (forecast['week_ahead'] == week_ahead)]
+    return rows.sort_values(measure, ascending=False, kind='stable').head(n).reset_index(drop=True)
+
+
+def backtest(tables, holdout=4, weeks=26, half_life=8.0, alpha=0.05, measure='orders'):
+    '''
+    Fit on all but the last `holdout` weeks and score the forecasts of those
+    weeks: mean absolute error of the model and of the baseline (the plain
+    slot average over the fitted weeks), and the share of actuals inside the
+    prediction intervals.
+    '''
+    y = getattr(SlotSeries.build(tables, weeks), measure)
+    train, test = y[:, :-holdout], y[:, -holdout:]
+    mean, lower, upper = TrendModel(half_life).fit(train).forecast(holdout, alpha)
+    baseline = train.mean(axis=1, keepdims=True)
+    return {'mae': float(np.abs(mean - test).mean()),
+            'mae_baseline': float(np.abs(baseline - test).mean()),
+            'coverage': float(((test >= lower) & (test <= upper)).mean()),
+            'slots': int(y.shape[0])}
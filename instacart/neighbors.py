@@ -0,0 +1,414 @@
+'''
+Users similar to a user: nearest neighbours over purchase vectors.
+
+Every user is a sparse vector over products: the number of their orders
+holding the product, weighted by BM25 (or TF-IDF) so that staples bought by
+everyone count for little, and scaled to unit length, so the dot product of
+two users is their cosine similarity. The vectors are CSR arrays built with
+numpy alone.
+
+``exact_top_k`` scores blocks of query users against every user, a chunk of
+rows at a time, keeping a running top-K per query; it is the reference for
+checking the approximate index. ``NeighborIndex`` is an inverted-file index:
+users are embedded in a few dozen dimensions by a randomized truncated SVD of
+the weighted matrix and grouped around spherical k-means centroids; a query
+scores the users of the lists nearest to it in the embedding, and the best
+candidates are re-scored exactly on the sparse vectors. ``all_pairs`` and
+``batch_search`` run the queries list by list in blocks of fixed size, so
+users of one list share their candidates, the dense scoring is one matrix
+product per block and memory does not grow with the number of queries.
+'''
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+WEIGHTINGS = ('bm25', 'tfidf')
+
+
+def _ranges(starts, lengths):
+    '''Concatenation of arange(s, s + n) for every (s, n).'''
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total = int(lengths.sum())
+    if not total:
+        return np.array([], dtype=np.int64)
+    offsets = np.repeat(np.asarray(starts, dtype=np.int64) - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+    return offsets + np.arange(total, dtype=np.int64)
+
+
+def _row_sums(values, indptr_rows):
+    '''
+    Sums of `values` (last axis, e.g. width x nnz) over the CSR row
+    boundaries `indptr_rows`; reducing along the contiguous axis is what
+    keeps reduceat fast.
+    '''
+    lengths = np.diff(indptr_rows)
+    out = np.zeros(values.shape[:-1] + (len(lengths),), dtype=values.dtype)
+    filled = lengths > 0
+    if filled.any():
+        out[..., filled] = np.add.reduceat(values, indptr_rows[:-1][filled] - indptr_rows[0], axis=-1)
+    return out
+
+
+def _chunks(indptr, width, chunk_nnz):
+    '''Ranges of CSR rows holding about chunk_nnz / width nonzeros each.'''
+    step = max(chunk_nnz // max(width, 1), 1)
+    bounds = np.searchsorted(indptr, np.arange(0, indptr[-1], step), side='right') - 1
+    bounds = np.unique(np.r_[bounds, len(indptr) - 1])
+    return zip(bounds[:-1], bounds[1:])
+
+
+class PurchaseVectors:
+    '''
+    Unit-length weighted purchase vectors, one CSR row per user.
+    user_ids = user of each row, ascending
+    indptr, indices, data = CSR rows over product_id columns
+    '''
+
+    def __init__(self, user_ids, indptr, indices, data, n_products):
+        self.user_ids = user_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.n_products = n_products
+        self._csc = None
+
+    @classmethod
+    def build(cls, tables, weighting='bm25', k1=1.2, b=0.75):
+        '''
+        Vectors from order_products joined to the orders' user_id.
+        weighting = 'bm25' (k1, b as in Okapi BM25, basket history as the
+            document) or 'tfidf' (log-scaled counts, smoothed idf)
+        '''
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f'weighting must be one of {WEIGHTINGS}')
+        orders = tables['instacart_orders'].drop_duplicates('order_id')
+        op = tables['order_products']
+        row = pd.Index(orders['order_id']).get_indexer(op['order_id'])
+        known = row >= 0
+        users = orders['user_id'].to_numpy(np.int64)[row[known]]
+        products = op['product_id'].to_numpy(np.int64)[known]
+        user_ids, codes = np.unique(users, return_inverse=True)
+        n_products = int(products.max()) + 1 if len(products) else 0
+        keys, counts = np.unique(codes.astype(np.int64) * n_products + products, return_counts=True)
+        rows = keys // n_products
+        indices = (keys % n_products).astype(np.int32)
+        indptr = np.r_[0, np.cumsum(np.bincount(rows, minlength=len(user_ids)))].astype(np.int64)
+
+        n = len(user_ids)
+        df = np.bincount(indices, minlength=n_products)[indices]
+        tf = counts.astype(np.float64)
+        if weighting == 'bm25':
+            length = np.bincount(rows, weights=tf, minlength=n)
+            norm = k1 * (1 - b + b * length / length.mean())
+            data = tf * (k1 + 1) / (tf + norm[rows]) * np.log1p((n - df + 0.5) / (df + 0.5))
+        else:
+            data = (1 + np.log(tf)) * (np.log((1 + n) / (1 + df)) + 1)
+        lengths = np.sqrt(np.bincount(rows, weights=data * data, minlength=n))
+        data = (data / np.where(lengths > 0, lengths, 1)[rows]).astype(np.float32)
+        return cls(user_ids, indptr, indices, data, n_products)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def rows_of(self, user_ids):
+        '''Row positions of `user_ids` (-1 for users without purchases).'''
+        return pd.Index(self.user_ids).get_indexer(np.asarray(user_ids, dtype=np.int64))
+
+    def dense(self, rows):
+        '''The vectors of `rows` as a dense (rows x products) array.'''
+        out = np.zeros((len(rows), self.n_products), dtype=np.float32)
+        lengths = self.indptr[np.asarray(rows) + 1] - self.indptr[rows]
+        nz = _ranges(self.indptr[rows], lengths)
+        out[np.repeat(np.arange(len(rows)), lengths), self.indices[nz]] = self.data[nz]
+        return out
+
+    def dot(self, m, chunk_nnz=1 << 24):
+        '''X @ m for a dense (products x width) array m.'''
+        mt = np.ascontiguousarray(m.T, dtype=np.float32)
+        out = np.empty((len(self), m.shape[1]), dtype=np.float32)
+        for lo, hi in _chunks(self.indptr, m.shape[1], chunk_nnz):
+            a, b = self.indptr[lo], self.indptr[hi]
+            out[lo:hi] = _row_sums(mt[:, self.indices[a:b]] * self.data[a:b], self.indptr[lo:hi + 1]).T
+        return out
+
+    def _columns(self):
+        '''Rows and data in column order, with the column boundaries (CSC).'''
+        if self._csc is None:
+            order = np.argsort(self.indices, kind='stable')
+            rows = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.indptr))[order]
+            indptr = np.r_[0, np.cumsum(np.bincount(self.indices, minlength=self.n_products))]
+            self._csc = indptr, rows, self.data[order]
+        return self._csc
+
+    def tdot(self, m, chunk_nnz=1 << 24):
+        '''X.T @ m for a dense (users x width) array m.'''
+        indptr, rows, data = self._columns()
+        mt = np.ascontiguousarray(m.T, dtype=np.float32)
+        out = np.empty((self.n_products, m.shape[1]), dtype=np.float32)
+        for lo, hi in _chunks(indptr, m.shape[1], chunk_nnz):
+            a, b = indptr[lo], indptr[hi]
+            out[lo:hi] = _row_sums(mt[:, rows[a:b]] * data[a:b], indptr[lo:hi + 1]).T
+        return out
+
+    def pair_scores(self, queries, dense_queries, candidates):
+        '''Exact similarity of each (queries[i], candidates[i]) pair; queries index dense_queries.'''
+        lengths = self.indptr[candidates + 1] - self.indptr[candidates]
+        nz = _ranges(self.indptr[candidates], lengths)
+        values = dense_queries[np.repeat(queries, lengths), self.indices[nz]] * self.data[nz]
+        return _row_sums(values, np.r_[0, np.cumsum(lengths)])
+
+    def embed(self, dim=64, power=1, oversample=10, seed=0):
+        '''Unit-length rows of a randomized rank-`dim` SVD projection of the vectors.'''
+        rng = np.random.default_rng(seed)
+        width = min(dim + oversample, self.n_products)
+        y = self.dot(rng.standard_normal((self.n_products, width)).astype(np.float32))
+        for _ in range(power):
+            q, _ = np.linalg.qr(y)
+            y = self.dot(self.tdot(q))
+        q, _ = np.linalg.qr(y)
+        _, _, vt = np.linalg.svd(self.tdot(q).T, full_matrices=False)
+        embedding = self.dot(np.ascontiguousarray(vt[:dim].T))
+        norms = np.linalg.norm(embedding, axis=1, keepdims=True)
+        return embedding / np.where(norms > 0, norms, 1)
+
+
+def _merge_top(best_scores, best_rows, scores, rows, k):
+    '''Running top-k per query row: merge new (scores, rows) columns into the best so far.'''
+    scores = np.hstack([best_scores, scores])
+    rows = np.hstack([best_rows, rows])
+    if scores.shape[1] > k:
+        keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        rows = np.take_along_axis(rows, keep, axis=1)
+    return scores, rows
+
+
+def _finish(scores, rows, k):
+    '''Sort each query's neighbours (best first, ties by row) and pad to k with -1.'''
+    order = np.lexsort((rows, -scores), axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+    rows = np.take_along_axis(rows, order, axis=1)
+    if scores.shape[1] < k:
+        pad = k - scores.shape[1]
+        scores = np.pad(scores, ((0, 0), (0, pad)), constant_values=-np.inf)
+        rows = np.pad(rows, ((0, 0), (0, pad)), constant_values=-1)
+    rows = np.where(np.isfinite(scores), rows, -1)
+    return rows, np.where(np.isfinite(scores), scores, np.nan).astype(np.float32)
+
+
+def exact_top_k(vectors, k=10, queries=None, block=256, chunk_nnz=1 << 24):
+    '''
+    The exact `k` most similar users of every row in `queries` (default all),
+    itself excluded, as (rows, similarities) arrays of shape (queries x k).
+    '''
+    queries = np.arange(len(vectors)) if queries is None else np.asarray(queries, dtype=np.int64)
+    out_rows = np.empty((len(queries), k), dtype=np.int64)
+    out_scores = np.empty((len(queries), k), dtype=np.float32)
+    for start in range(0, len(queries), block):
+        qb = queries[start:start + block]
+        dense = vectors.dense(qb)
+        best_scores = np.empty((len(qb), 0), dtype=np.float32)
+        best_rows = np.empty((len(qb), 0), dtype=np.int64)
+        for lo, hi in _chunks(vectors.indptr, len(qb), chunk_nnz):
+            a, b = vectors.indptr[lo], vectors.indptr[hi]
+            scores = _row_sums(dense[:, vectors.indices[a:b]] * vectors.data[a:b], vectors.indptr[lo:hi + 1])
+            inside = (qb >= lo) & (qb < hi)
+            scores[np.flatnonzero(inside), qb[inside] - lo] = -np.inf
+            rows = np.broadcast_to(np.arange(lo, hi), scores.shape)
+            best_scores, best_rows = _merge_top(best_scores, best_rows, scores, rows, k)
+        rows, scores = _finish(best_scores, best_rows, k)
+        out_rows[start:start + block], out_scores[start:start + block] = rows, scores
+    return out_rows, out_scores
+
+
+def _spherical_kmeans(x, n_clusters, iterations, rng):
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)]
+    for _ in range(iterations):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # an empty cluster keeps its centroid
+        centroids = np.where(norms > 0, sums / np.where(norms > 0, norms, 1), centroids)
+    return centroids
+
+
+def _nearest_centroid(x, centroids, chunk_rows=1 << 16):
+    '''Index of the most similar centroid of every row of `x`, a chunk of rows at a time.'''
+    nearest = np.empty(len(x), dtype=np.int64)
+    for lo in range(0, len(x), chunk_rows):
+        nearest[lo:lo + chunk_rows] = np.argmax(x[lo:lo + chunk_rows] @ centroids.T, axis=1)
+    return nearest
+
+
+class NeighborIndex:
+    '''
+    Approximate nearest-neighbour index over PurchaseVectors.
+    embedding = unit rows of a truncated SVD projection, one per user
+    centroids, list_indptr, list_rows = inverted lists of users by nearest centroid
+    '''
+
+    def __init__(self, vectors, embedding, centroids, list_indptr, list_rows):
+        self.vectors = vectors
+        self.embedding = embedding
+        self.centroids = centroids
+        self.list_indptr = list_indptr
+        self.list_rows = list_rows
+
+    @classmethod
+    def build(cls, vectors, dim=64, lists=None, iterations=10, train_size=256, seed=0, chunk_rows=1 << 16):
+        '''
+        Embed `vectors` in `dim` dimensions and split them into `lists`
+        inverted lists (default 4 * sqrt(users)); the centroids are fitted on
+        at most `train_size` users per list.
+        '''
+        rng = np.random.default_rng(seed)
+        embedding = vectors.embed(dim, seed=seed)
+        n = len(vectors)
+        lists = min(lists or max(1, int(round(4 * math.sqrt(n)))), n)
+        train = embedding[rng.choice(n, min(n, train_size * lists), replace=False)]
+        centroids = _spherical_kmeans(train, lists, iterations, rng)
+        assign = _nearest_centroid(embedding, centroids, chunk_rows)
+        list_rows = np.argsort(assign, kind='stable')
+        list_indptr = np.r_[0, np.cumsum(np.bincount(assign, minlength=lists))]
+        return cls(vectors, embedding, centroids, list_indptr, list_rows)
+
+    def search(self, queries, k=10, nprobe=8, rerank=None):
+        '''
+        Approximate `k` most similar users of the rows `queries`, itself
+        excluded, as (rows, similarities) arrays like exact_top_k. Candidates
+        come from the `nprobe` lists nearest each query; the `rerank` best by
+        embedding (default 50 * k) are scored exactly; a longer
+        shortlist raises recall more than probing more lists.
+        '''
+        queries = np.asarray(queries, dtype=np.int64)
+        rerank = rerank or 50 * k
+        nprobe = min(nprobe, len(self.centroids))
+        q_embedding = self.embedding[queries]
+        centroid_scores = q_embedding @ self.centroids.T
+        probes = np.unique(np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe])
+        starts = self.list_indptr[probes]
+        candidates = self.list_rows[_ranges(starts, self.list_indptr[probes + 1] - starts)]
+        scores = q_embedding @ self.embedding[candidates].T
+        scores[queries[:, None] == candidates[None, :]] = -np.inf
+        if scores.shape[1] > rerank:
+            keep = np.argpartition(-scores, rerank - 1, axis=1)[:, :rerank]
+        else:
+            keep = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        shortlisted = np.isfinite(np.take_along_axis(scores, keep, axis=1))
+        pair_query = np.broadcast_to(np.arange(len(queries))[:, None], keep.shape)[shortlisted]
+        pair_rows = candidates[keep][shortlisted]
+        exact = np.full(keep.shape, -np.inf, dtype=np.float32)
+        exact[shortlisted] = self.vectors.pair_scores(pair_query, self.vectors.dense(queries), pair_rows)
+        rows = candidates[keep]
+        best_scores, best_rows = _merge_top(np.empty((len(queries), 0), dtype=np.float32),
+                                            np.empty((len(queries), 0), dtype=np.int64), exact, rows, k)
+        return _finish(best_scores, best_rows, k)
+
+    def batch_search(self, queries, k=10, nprobe=8, rerank=None, block=256):
+        '''
+        search for any number of `queries`, in the same (rows, similarities)
+        form: they are grouped by their nearest list and searched in blocks
+        of at most `block`, so memory is that of one block however many
+        queries there are.
+        '''
+        queries = np.asarray(queries, dtype=np.int64)
+        out_rows = np.empty((len(queries), k), dtype=np.int64)
+        out_scores = np.empty((len(queries), k), dtype=np.float32)
+        nearest = _nearest_centroid(self.embedding[queries], self.centroids)
+        order = np.argsort(nearest, kind='stable')
+        bounds = np.r_[0, np.cumsum(np.bincount(nearest, minlength=len(self.centroids)))]
+        for lst in range(len(self.centroids)):
+            positions = order[bounds[lst]:bounds[lst + 1]]
+            for start in range(0, len(positions), block):
+                pb = positions[start:start + block]
+                out_rows[pb], out_scores[pb] = self.search(queries[pb], k, nprobe, rerank)
+        return out_rows, out_scores
+
+    def _list_queries(self, first, last, block):
+        '''Blocks of the users of lists first..last-1, each list searched on its own.'''
+        for lst in range(first, last):
+            members = self.list_rows[self.list_indptr[lst]:self.list_indptr[lst + 1]]
+            for start in range(0, len(members), block):
+                yield members[start:start + block]
+
+    def all_pairs(self, k=10, nprobe=8, rerank=None, block=256, workers=1, lists_per_task=16):
+        '''
+        Approximate top-`k` neighbours of every user, searched list by list.
+        workers = process count (1 searches in-process, None all cores)
+        '''
+        n = len(self.vectors)
+        out_rows = np.empty((n, k), dtype=np.int64)
+        out_scores = np.empty((n, k), dtype=np.float32)
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            for qb in self._list_queries(0, len(self.centroids), block):
+                out_rows[qb], out_scores[qb] = self.search(qb, k, nprobe, rerank)
+            return out_rows, out_scores
+        tasks = [(lo, min(lo + lists_per_task, len(self.centroids)))
+                 for lo in range(0, len(self.centroids), lists_per_task)]
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            futures = [pool.submit(_search_lists, lo, hi, k, nprobe, rerank, block) for lo, hi in tasks]
+            for f in futures:
+                for qb, rows, scores in f.result():
+                    out_rows[qb], out_scores[qb] = rows, scores
+        return out_rows, out_scores
+
+    def similar_users(self, user_id, k=10, nprobe=8, rerank=None):
+        '''Frame of the users most similar to `user_id` (empty if they bought nothing).'''
+        row = self.vectors.rows_of([user_id])
+        if row[0] < 0:
+            return neighbors_frame(self.vectors, row[:0], np.empty((0, k), np.int64), np.empty((0, k)))
+        rows, scores = self.search(row, k, nprobe, rerank)
+        return neighbors_frame(self.vectors, row, rows, scores)
+
+    def save(self, path):
+        '''Write the index, vectors included, to `path` (.npz format, whatever its name).'''
+        v = self.vectors
+        # through a file object, so that numpy does not append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez(f, user_ids=v.user_ids, indptr=v.indptr, indices=v.indices, data=v.data,
+                     n_products=v.n_products, embedding=self.embedding, centroids=self.centroids,
+                     list_indptr=self.list_indptr, list_rows=self.list_rows)
+
+    @classmethod
+    def load(cls, path):
+        '''Read an index written by save.'''
+        d = np.load(path)
+        vectors = PurchaseVectors(d['user_ids'], d['indptr'], d['indices'], d['data'], int(d['n_products']))
+        return cls(vectors, d['embedding'], d['centroids'], d['list_indptr'], d['list_rows'])
+
+
+_WORKER = {}
+
+
+def _init_worker(index):
+    _WORKER['index'] = index
+
+
+def _search_lists(first, last, k, nprobe, rerank, block):
+    index = _WORKER['index']
+    return [(qb,) + index.search(qb, k, nprobe, rerank) for qb in index._list_queries(first, last, block)]
+
+
+def neighbors_frame(vectors, queries, rows, scores):
+    '''Long frame user_id, rank, neighbor_id, similarity from search results.'''
+    k = rows.shape[1]
+    found = rows.ravel() >= 0
+    return pd.DataFrame({'user_id': np.repeat(vectors.user_ids[queries], k)[found],
+                         'rank': np.tile(np.arange(1, k + 1), len(queries))[found],
+                         'neighbor_id': vectors.user_ids[rows.ravel()[found]],
+                         'similarity': scores.ravel()[found]})
+
+
+def recall(approximate, exact):
+    '''Share of the exact neighbours (rows arrays, -1 padded) found by the approximate search.'''
+    hits = total = 0
+    for a, e in zip(approximate, exact):
+        e = e[e >= 0]
+        hits += np.isin(e, a).sum()
+        total += len(e)
+    return hits / total if total else 1.0
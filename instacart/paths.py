@@ -0,0 +1,55 @@
+'''
+Locations of the Instacart exports.
+
+Kept free of pandas/numpy so that quick command-line checks can stat the
+inputs without paying for the heavy imports.
+'''
+import hashlib
+import os
+
+# default location used by the notebook
+DATA_DIR = '/datasets'
+
+# table name -> file name
+FILES = {'instacart_orders': 'instacart_orders.csv',
+         'products': 'products.csv',
+         'aisles': 'aisles.csv',
+         'departments': 'departments.csv',
+         'order_products': 'order_products.csv'}
+
+SEP = ';'
+
+
+# compressed exports are found next to (or instead of) the plain csv
+COMPRESSED_SUFFIXES = ('.gz', '.zst', '.zstd')
+
+
+def table_path(name, data_dir=DATA_DIR):
+    '''
+    Return the csv path of table `name` inside `data_dir`; a compressed
+    export (.csv.gz, .csv.zst) is used when the plain csv is absent.
+    '''
+    path = os.path.join(data_dir, FILES[name])
+    if not os.path.exists(path):
+        for suffix in COMPRESSED_SUFFIXES:
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+
+def compression(path):
+    ''''gzip', 'zstd' or None, from the file's magic bytes.'''
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return None
+
+
+def file_version(path):
+    '''Return a cheap fingerprint of a file from its path, size and mtime.'''
+    st = os.stat(path)
+    return hashlib.blake2b(f'{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'.encode(),
+                           digest_size=16).hexdigest()
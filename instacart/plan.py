@@ -0,0 +1,128 @@
+'''
+Projection pushdown: load only the columns the requested analyses read.
+
+Most analyses touch two or three columns, yet the notebook loads every column
+of every table and carries them through its merges. ``plan`` unions the
+column needs of the requested analyses (``analysis.COLUMNS``), ``load_for``
+passes them to the readers as ``usecols`` and ``bytes_avoided`` estimates how
+much csv text and memory that saved.
+'''
+import os
+
+from instacart.analysis import COLUMNS
+from instacart.paths import DATA_DIR, SEP, compression, table_path
+
+# bytes per value of each column once parsed (see data.SCHEMA); strings are
+# counted by their text length instead
+_ITEMSIZE = {'int8': 1, 'int16': 2, 'int32': 4, 'int64': 8, 'float32': 4, 'float64': 8}
+
+SAMPLE_LINES = 10_000
+
+
+def plan(analyses, extra=None):
+    '''
+    {table: columns in file order} needed by `analyses`.
+    extra = further {table: columns} to load, e.g. sample.COLUMNS
+    '''
+    from instacart.data import SCHEMA
+    needed = {table: set(cols) for table, cols in (extra or {}).items()}
+    for name in analyses:
+        if name not in COLUMNS:
+            raise ValueError(f'unknown analysis {name!r}')
+        for table, cols in COLUMNS[name].items():
+            needed.setdefault(table, set()).update(cols)
+    return {table: [c for c in SCHEMA[table] if c in cols] for table, cols in needed.items()}
+
+
+def _column_widths(path, sample_lines=SAMPLE_LINES):
+    '''Header, mean text width per column and mean line width from the first lines.'''
+    if compression(path):
+        from instacart.reader import open_stream
+        f = open_stream(path)
+    else:
+        f = open(path, 'rb')
+    with f:
+        header = f.readline().decode('utf-8').rstrip('\r\n').split(SEP)
+        totals = [0] * len(header)
+        lines = 0
+        width = 0
+        for raw in f:
+            fields = raw.decode('utf-8').rstrip('\r\n').split(SEP)
+            for i, field in enumerate(fields[:len(header)]):
+                totals[i] += len(field) + 1
+            width += len(raw)
+            lines += 1
+            if lines >= sample_lines:
+                break
+    lines = max(lines, 1)
+    return header, [t / lines for t in totals], width / lines
+
+
+def _uncompressed_size(path):
+    '''Size of the csv text: the file size, the gzip trailer, or None if unknown.'''
+    kind = compression(path)
+    if kind is None:
+        return os.path.getsize(path)
+    if kind == 'gzip':
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return int.from_bytes(f.read(4), 'little')  # modulo 4 GiB
+    return None
+
+
+def _memory(table, columns, header, widths, rows):
+    '''Estimated bytes of `columns` of `table` once parsed.'''
+    from instacart.data import SCHEMA
+    return int(sum(rows * _ITEMSIZE.get(SCHEMA[table].get(c), w)
+                   for c, w in zip(header, widths) if c in columns))
+
+
+def loaded_bytes(table, columns, data_dir=DATA_DIR):
+    '''Estimated memory of loading `columns` of `table`, or None if unknown (zstd).'''
+    path = table_path(table, data_dir)
+    header, widths, line_width = _column_widths(path)
+    text_size = _uncompressed_size(path)
+    if text_size is None:
+        return None
+    return _memory(table, columns, header, widths, text_size / line_width)
+
+
+def bytes_avoided(analyses, data_dir=DATA_DIR):
+    '''
+    Estimate per table of the csv bytes that a projected load does not
+    convert and the memory it does not allocate, compared with loading every
+    column of every table.
+    File bytes of compressed inputs are prorated by column width.
+    '''
+    from instacart.data import FILES
+    needed = plan(analyses)
+    report = {}
+    for table in FILES:
+        path = table_path(table, data_dir)
+        if not os.path.exists(path):
+            continue
+        header, widths, line_width = _column_widths(path)
+        size = os.path.getsize(path)
+        text_size = _uncompressed_size(path)
+        cols = needed.get(table, [])
+        text_kept = sum(w for c, w in zip(header, widths) if c in cols) / sum(widths) if cols else 0.0
+        memory_avoided = None
+        if text_size is not None:
+            skipped = [c for c in header if c not in cols]
+            memory_avoided = _memory(table, skipped, header, widths, text_size / line_width)
+        report[table] = {'columns_loaded': cols,
+                         'columns_skipped': [c for c in header if c not in cols],
+                         'file_bytes': size,
+                         'file_bytes_avoided': int(size * (1 - text_kept)),
+                         'memory_bytes_avoided': memory_avoided}
+    report['total'] = {'file_bytes_avoided': sum(r['file_bytes_avoided'] for r in report.values()),
+                       'memory_bytes_avoided': sum(r['memory_bytes_avoided'] or 0
+                                                   for r in report.values())}
+    return report
+
+
+def load_for(analyses, data_dir=DATA_DIR, workers=1, extra=None, skip=()):
+    '''Load only the tables and columns `analyses` (and `extra`) need, except those in `skip`.'''
+    from instacart.data import read_table
+    return {table: read_table(table, data_dir, usecols=cols, workers=workers)
+            for table, cols in plan(analyses, extra).items() if table not in skip}
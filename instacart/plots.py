@@ -0,0 +1,68 @@
+'''
+The notebook's charts, written to image files instead of shown inline.
+'''
+import matplotlib
+
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt  # noqa: E402
+
+from instacart.clean import day_of_week, decode_names  # noqa: E402
+
+
+def plot_hour_of_day(tables, path):
+    '''Time Of Day People Grocery Shop.'''
+    tables['instacart_orders']['order_hour_of_day'].value_counts().plot(kind='bar',
+                                                                        rot=0,
+                                                                        xlabel='Hour Of Day',
+                                                                        ylabel='Fequency',
+                                                                        title='Time Of Day People Grocery Shop',
+                                                                        figsize=[10, 5],
+                                                                        grid=True,
+                                                                        color='purple')
+    plt.savefig(path, bbox_inches='tight')
+    plt.close()
+
+
+def plot_day_of_week(tables, path):
+    '''Day Of Week People Grocery Shop.'''
+    dow = tables['instacart_orders']['order_dow'].map(day_of_week)
+    dow.value_counts().plot(kind='bar',
+                            rot=0,
+                            xlabel='Day Of Week',
+                            ylabel='Fequency',
+                            title='Day Of Week People Grocery Shop',
+                            figsize=[10, 5],
+                            grid=True,
+                            color='red')
+    plt.savefig(path, bbox_inches='tight')
+    plt.close()
+
+
+def _plot_top(frame, path, title):
+    frame = decode_names(frame)
+    frame = frame.assign(label=frame['product_name'] + ' (' + frame['product_id'].astype(str) + ')')
+    frame.set_index('label')['freq'].sort_values().plot(kind='barh',
+                                                        figsize=[8, 12],
+                                                        grid=True,
+                                                        ylabel='Product Name & ID',
+                                                        title=title,
+                                                        legend=False)
+    plt.xlabel('Frequency')
+    plt.savefig(path, bbox_inches='tight')
+    plt.close()
+
+
+def plot_top_products(frame, path):
+    '''Top 20 Popular Products from analysis.top_products.'''
+    _plot_top(frame, path, 'Top 20 Popular Products')
+
+
+def plot_top_reordered(frame, path):
+    '''Top 20 reordered products from analysis.top_reordered.'''
+    _plot_top(frame, path, 'Top 20 Reordered Products')
+
+
+def plot_first_in_cart(frame, path):
+    '''Top 20 Products Put In Carts First from analysis.top_first_in_cart.'''
+    _plot_top(frame, path, 'Top 20 Products Put In Carts First')
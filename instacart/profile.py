@@ -0,0 +1,155 @@
+'''
+One-pass profiling of the Instacart tables.
+
+The cleaning section of the notebook calls ``.info()``, ``.isna().sum()``,
+``.duplicated().sum()``, ``.min()``/``.max()``, ``.unique()`` and
+``.nunique()`` on the same frames over and over, each one a full scan.
+Here every column is factorized once; null counts, distinct values, min/max
+and row/key duplicates are all read off those codes.
+'''
+import numpy as np
+import pandas as pd
+
+from instacart.data import table_version
+
+# keys whose duplicates the notebook checks by hand
+DEFAULT_KEYS = {'instacart_orders': [('order_id',)],
+                'products': [('product_id',)],
+                'aisles': [('aisle_id',)],
+                'departments': [('department_id',)],
+                'order_products': [('order_id', 'product_id')]}
+
+# keep the distinct values of low-cardinality columns (order_dow, hours, ...)
+MAX_UNIQUES = 100
+
+_CACHE = {}
+
+
+class TableProfile:
+    '''Column statistics and duplicate counts of one table.'''
+
+    def __init__(self, rows, duplicated, columns, uniques, key_duplicates):
+        self.rows = rows
+        self.duplicated = duplicated
+        self.columns = columns
+        self.uniques = uniques
+        self.key_duplicates = key_duplicates
+
+    def __repr__(self):
+        return (f'TableProfile(rows={self.rows}, duplicated={self.duplicated}, '
+                f'key_duplicates={self.key_duplicates})')
+
+
+def _combine_codes(codes_list, sizes, n):
+    '''Combine per-column codes into one compact row key (-1 codes are NaN).'''
+    key = np.zeros(n, dtype=np.int64)
+    for codes, size in zip(codes_list, sizes):
+        key = key * (size + 1) + (codes.astype(np.int64) + 1)
+        # re-factorize so the key stays below n and never overflows
+        key, uniq = pd.factorize(key)
+        key = key.astype(np.int64)
+    return key
+
+
+def _count_duplicates(codes, sizes, cols, n):
+    '''Number of rows that repeat an earlier row on `cols`.'''
+    if n == 0:
+        return 0
+    key = _combine_codes([codes[c] for c in cols], [sizes[c] for c in cols], n)
+    return int(n - (key.max() + 1))
+
+
+def profile_table(df, keys=()):
+    '''
+    Profile every column of `df` in a single factorize pass.
+    keys = column tuples to check for duplicated combinations
+    '''
+    n = len(df)
+    codes = {}
+    sizes = {}
+    stats = []
+    uniques = {}
+    for col in df.columns:
+        s = df[col]
+        c, u = pd.factorize(s, sort=True)
+        codes[col] = c
+        sizes[col] = len(u)
+        nulls = int((c == -1).sum())
+        stats.append({'column': col,
+                      'dtype': str(s.dtype),
+                      'non_null': n - nulls,
+                      'nulls': nulls,
+                      'nunique': len(u),
+                      'min': u[0] if len(u) else np.nan,
+                      'max': u[-1] if len(u) else np.nan,
+                      'memory': int(s.memory_usage(index=False))})
+        if len(u) <= MAX_UNIQUES:
+            uniques[col] = np.asarray(u)
+    columns = pd.DataFrame(stats).set_index('column')
+    duplicated = _count_duplicates(codes, sizes, list(df.columns), n)
+    key_duplicates = {k: _count_duplicates(codes, sizes, list(k), n)
+                      for k in keys if all(c in codes for c in k)}
+    return TableProfile(n, duplicated, columns, uniques, key_duplicates)
+
+
+def profile_tables(tables, versions=None):
+    '''
+    Profile a dict of frames, reusing cached results for unchanged data.
+    versions = optional {name: version}; computed with table_version otherwise
+    '''
+    profiles = {}
+    for name, df in tables.items():
+        if versions is not None and name in versions:
+            version = versions[name]
+        else:
+            version = table_version(df)
+        keys = tuple(DEFAULT_KEYS.get(name, ()))
+        cache_key = (name, version, keys)
+        if cache_key not in _CACHE:
+            _CACHE[cache_key] = profile_table(df, keys)
+        profiles[name] = _CACHE[cache_key]
+    return profiles
+
+
+def clear_profile_cache():
+    '''Drop every cached profile.'''
+    _CACHE.clear()
+
+
+def check_invariants(tables, profiles=None, strict=False):
+    '''
+    Validate the invariants the notebook checks by hand:
+    - days_since_prior_order is NaN exactly on first orders
+    - add_to_cart_order is missing only in baskets over 64 items
+    - no duplicate (order_id, product_id) pairs
+    Returns a frame of violation counts; raises ValueError if strict.
+    '''
+    rows = []
+    orders = tables.get('instacart_orders')
+    if orders is not None:
+        nan_days = orders['days_since_prior_order'].isna().to_numpy()
+        first = (orders['order_number'] == 1).to_numpy()
+        rows.append(('days_since_prior_order NaN only on first orders',
+                     int((nan_days & ~first).sum())))
+        rows.append(('first orders have NaN days_since_prior_order',
+                     int((first & ~nan_days).sum())))
+    order_products = tables.get('order_products')
+    if order_products is not None:
+        missing = order_products['add_to_cart_order'].isna().to_numpy()
+        codes, _ = pd.factorize(order_products['order_id'])
+        basket_size = np.bincount(codes)[codes] if len(codes) else codes
+        rows.append(('add_to_cart_order missing only in baskets over 64 items',
+                     int((missing & (basket_size <= 64)).sum())))
+        key = ('order_id', 'product_id')
+        if profiles is not None and 'order_products' in profiles \
+                and key in profiles['order_products'].key_duplicates:
+            dups = profiles['order_products'].key_duplicates[key]
+        else:
+            dups = int(order_products.duplicated(subset=list(key)).sum())
+        rows.append(('no duplicate (order_id, product_id) pairs', dups))
+    result = pd.DataFrame(rows, columns=['invariant', 'violations'])
+    result['ok'] = result['violations'] == 0
+    if strict and not result['ok'].all():
+        failed = result.loc[~result['ok'], 'invariant'].tolist()
+        raise ValueError(f'Invariants violated: {failed}')
+    return result
@@ -0,0 +1,67 @@
+'''
+Top/bottom-K rankings of numeric metrics with a minimum support.
+
+The notebook turns the reorder proportions into strings ("95.24%") before
+sorting them, so its top/bottom-10 lists are in lexicographic order, and
+entities seen on a single order line crowd both ends at 100% and 0%. Here
+metrics stay numeric, entities below ``min_support`` (order lines behind the
+metric) are left out, and only the K selected rows are sorted: ``top_k``
+partitions the values in O(n) with ``np.partition`` and sorts the K
+survivors, giving exactly the rows of a full stable sort. ``format_percent``
+turns proportions into text at display time only.
+'''
+import numpy as np
+
+from instacart.analysis import product_reorder_proportions, user_reorder_proportions
+
+
+def top_k(values, k, largest=True):
+    '''
+    Positions of the `k` largest (or smallest) values, best first; ties keep
+    their order of appearance and NaN never ranks, as in a stable sort.
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    key = -values if largest else values
+    valid = np.flatnonzero(~np.isnan(key))
+    if k <= 0 or not len(valid):
+        return np.array([], dtype=np.int64)
+    key_valid = key[valid]
+    if k < len(valid):
+        kth = np.partition(key_valid, k - 1)[k - 1]
+        better = np.flatnonzero(key_valid < kth)
+        ties = np.flatnonzero(key_valid == kth)[:k - len(better)]
+        chosen = valid[np.concatenate([better, ties])]
+    else:
+        chosen = valid
+    return chosen[np.lexsort((chosen, key[chosen]))]
+
+
+def rank(df, metric, k=10, bottom=False, support='support', min_support=1):
+    '''
+    The `k` rows of `df` with the highest `metric` (lowest with `bottom`),
+    among those whose `support` column is at least `min_support`.
+    '''
+    if support is not None and min_support > 1:
+        df = df[df[support].to_numpy() >= min_support]
+    positions = top_k(df[metric].to_numpy(np.float64), k, largest=not bottom)
+    return df.iloc[positions].reset_index(drop=True)
+
+
+# rankable metrics: analysis function (called with support=True), metric
+# column, whether it is a percentage
+METRICS = {'product-reorders': (product_reorder_proportions, 'proportion_product_reorders', True),
+           'user-reorders': (user_reorder_proportions, 'proportion_user_reorders', True)}
+
+
+def rank_metric(name, tables, k=10, bottom=False, min_support=10, **kwargs):
+    '''Top (or bottom) `k` entities of metric `name` with at least `min_support` order lines.'''
+    func, metric, _ = METRICS[name]
+    return rank(func(tables, support=True, **kwargs), metric, k, bottom=bottom, min_support=min_support)
+
+
+def format_percent(df, columns, decimals=2):
+    '''A copy of `df` with `columns` (percentages) as text, e.g. "95.24%".'''
+    df = df.copy()
+    for column in columns:
+        df[column] = df[column].map(lambda x: f'{x:.{decimals}f}%')
+    return df
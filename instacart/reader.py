@@ -0,0 +1,250 @@
+'''
+Multi-process reader for the large ';'-separated exports.
+
+The file is split into byte ranges whose boundaries are moved forward to the
+next line break, so every range holds whole rows. Worker processes parse
+their range with the typed schema and the pieces are concatenated in file
+order, so the result equals a single ``pd.read_csv`` call. The exports have
+no quoted fields spanning lines, which is what makes newline alignment safe.
+
+Compressed exports (gzip, zstd) cannot be split by byte offset, so
+``read_csv_stream`` decompresses them as a stream in a background thread
+(zlib and zstd release the GIL) and hands line-aligned blocks to the parsers
+while the next block is being decompressed. Nothing is written to disk.
+'''
+import gzip
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instacart.paths import SEP, compression
+
+CHUNK_BYTES = 64 * 2**20
+
+
+def _header(path):
+    '''Column names and the byte offset where the data starts.'''
+    with open(path, 'rb') as f:
+        line = f.readline()
+        return line.decode('utf-8').rstrip('\r\n').split(SEP), f.tell()
+
+
+def byte_ranges(path, start, chunk_bytes=CHUNK_BYTES):
+    '''(start, end) pairs covering the file from `start`, aligned on line breaks.'''
+    size = os.path.getsize(path)
+    bounds = [start]
+    with open(path, 'rb') as f:
+        pos = start + chunk_bytes
+        while pos < size:
+            f.seek(pos)
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            bounds.append(pos)
+            pos += chunk_bytes
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def row_filter(column, ids):
+    '''
+    keep filter for the readers: rows whose `column` is in `ids`. Dense ids
+    become a boolean lookup table indexed by value, others a sorted array.
+    '''
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(ids) and 0 <= ids[0] and ids[-1] < 64 * len(ids) + 2**24:
+        table = np.zeros(ids[-1] + 1, dtype=bool)
+        table[ids] = True
+        return column, table
+    return column, ids
+
+
+def keep_rows(df, keep):
+    '''Rows of `df` passing keep = row_filter(...); `df` itself if keep is None.'''
+    if keep is None:
+        return df
+    column, ids = keep
+    values = df[column].to_numpy()
+    if ids.dtype == bool:
+        inside = (values >= 0) & (values < len(ids))
+        mask = inside.copy()
+        mask[inside] = ids[values[inside]]
+    elif len(ids):
+        mask = ids[np.minimum(np.searchsorted(ids, values), len(ids) - 1)] == values
+    else:
+        mask = np.zeros(len(values), dtype=bool)
+    return df[mask]
+
+
+def _parse_range(job):
+    path, start, end, names, usecols, dtype, sep, keep = job
+    with open(path, 'rb') as f:
+        f.seek(start)
+        buf = f.read(end - start)
+    return keep_rows(pd.read_csv(io.BytesIO(buf), sep=sep, header=None, names=names,
+                                 usecols=usecols, dtype=dtype), keep)
+
+
+def read_csv_parallel(path, dtype=None, usecols=None, sep=SEP, workers=None,
+                      chunk_bytes=CHUNK_BYTES, as_columns=False, keep=None):
+    '''
+    Parse `path` in parallel byte ranges.
+    as_columns = return {column: numpy array} instead of a frame
+    keep = optional row_filter(column, ids): rows are filtered in the
+        workers, so only the kept ones are sent back and concatenated
+    '''
+    names, start = _header(path)
+    if usecols is not None:
+        usecols = [c for c in names if c in set(usecols)]
+    if dtype is not None:
+        dtype = {c: t for c, t in dtype.items() if usecols is None or c in usecols}
+    ranges = byte_ranges(path, start, chunk_bytes)
+    jobs = [(path, a, b, names, usecols, dtype, sep, keep) for a, b in ranges]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        parts = [_parse_range(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+            parts = list(pool.map(_parse_range, jobs))
+    return _assemble(parts, usecols if usecols is not None else names, dtype, as_columns)
+
+
+def _assemble(parts, columns, dtype, as_columns):
+    '''Concatenate parsed pieces in order, as a frame or a column store.'''
+    if not parts:
+        empty = pd.DataFrame({c: pd.Series(dtype=(dtype or {}).get(c, object)) for c in columns})
+        return {c: empty[c].to_numpy() for c in columns} if as_columns else empty
+    if as_columns:
+        return {c: np.concatenate([p[c].to_numpy() for p in parts]) for c in columns}
+    return pd.concat(parts, ignore_index=True)[columns]
+
+
+def open_stream(path):
+    '''Binary stream of the decompressed contents of `path`.'''
+    kind = compression(path)
+    if kind == 'gzip':
+        return gzip.open(path, 'rb')
+    if kind == 'zstd':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError('reading zstd-compressed exports requires the zstandard package') from e
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def line_blocks(stream, block_bytes=CHUNK_BYTES):
+    '''Yield blocks of roughly `block_bytes` that end on a line break.'''
+    rest = b''
+    while True:
+        data = stream.read(block_bytes)
+        if not data:
+            if rest:
+                yield rest
+            return
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            rest = data
+            continue
+        rest = data[cut:]
+        yield data[:cut]
+
+
+def _parse_block(job):
+    buf, names, usecols, dtype, sep, keep = job
+    return keep_rows(pd.read_csv(io.BytesIO(buf), sep=sep, header=None, names=names,
+                                 usecols=usecols, dtype=dtype), keep)
+
+
+def _put(out, item, stop):
+    '''Put `item` on `out` unless the consumer has stopped; False once it has.'''
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _produce(path, block_bytes, out, stop):
+    '''Decompress `path` into `out` as line-aligned blocks; None marks the end.'''
+    try:
+        with open_stream(path) as stream:
+            for block in line_blocks(stream, block_bytes):
+                if not _put(out, block, stop):
+                    return
+        _put(out, None, stop)
+    except BaseException as e:
+        _put(out, e, stop)
+
+
+def read_csv_stream(path, dtype=None, usecols=None, sep=SEP, workers=None,
+                    block_bytes=CHUNK_BYTES, as_columns=False, keep=None):
+    '''
+    Parse a (possibly compressed) csv from a decompression stream, with
+    decompression overlapping parsing.
+    workers = parser processes; 1 parses in this process
+    keep = optional row_filter(column, ids), as for read_csv_parallel
+    '''
+    workers = workers or os.cpu_count() or 1
+    blocks = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    producer = threading.Thread(target=_produce, args=(path, block_bytes, blocks, stop), daemon=True)
+    producer.start()
+
+    def items():
+        while True:
+            item = blocks.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    names = None
+    jobs = []
+    parts = []
+    pool = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for block in items():
+            if names is None:
+                cut = block.find(b'\n') + 1
+                names = block[:cut].decode('utf-8').rstrip('\r\n').split(sep)
+                if usecols is not None:
+                    usecols = [c for c in names if c in set(usecols)]
+                if dtype is not None:
+                    dtype = {c: t for c, t in dtype.items() if usecols is None or c in usecols}
+                block = block[cut:]
+                if not block:
+                    continue
+            job = (block, names, usecols, dtype, sep, keep)
+            if pool is None:
+                parts.append(_parse_block(job))
+            else:
+                jobs.append(pool.submit(_parse_block, job))
+                # bound memory: wait for the oldest block once enough are in flight
+                if len(jobs) - len(parts) > 2 * workers:
+                    parts.append(jobs[len(parts)].result())
+        parts.extend(f.result() for f in jobs[len(parts):])
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        # on an error the producer may be blocked on the full queue
+        stop.set()
+        while True:
+            try:
+                blocks.get_nowait()
+            except queue.Empty:
+                break
+        producer.join()
+    if names is None:
+        raise ValueError(f'{path} is empty')
+    return _assemble(parts, usecols if usecols is not None else names, dtype, as_columns)
@@ -0,0 +1,217 @@
+'''
+Next-basket reorder recommendations for every user.
+
+Each (user, product) pair in a user's history is scored with a logistic
+model over vectorized features built from order_products, the orders'
+order_number/days_since_prior_order and product-level reorder proportions.
+The model is fitted on a sample of users, using their last order as the
+label and the earlier orders as history. Scoring runs over user chunks in a
+process pool with a bounded number of chunks in flight, so memory stays
+proportional to the chunk size rather than the number of users.
+'''
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from instacart.timeline import user_timeline
+
+FEATURES = ['up_orders',             # orders of the user containing the product
+            'up_rate',               # up_orders / user's order count
+            'up_rate_since_first',   # up_orders / orders since first purchase
+            'up_orders_since_last',  # orders since the product was last bought
+            'up_days_since_last',    # days since the product was last bought
+            'user_orders',
+            'user_reorder_rate',
+            'user_mean_days',
+            'product_reorder_rate']
+
+
+def prepare(tables):
+    '''
+    Join order lines to their user timeline.
+    Returns (orders, lines, product_rate): orders and lines sorted by user,
+    product_rate a dense array of reorder proportions indexed by product_id.
+    '''
+    orders = user_timeline(tables['instacart_orders']).rename(columns={'day': 'cumdays'})
+    orders = orders[['order_id', 'user_id', 'order_number', 'days_since_prior_order', 'cumdays']]
+    op = tables['order_products'][['order_id', 'product_id', 'reordered']]
+    lines = op.merge(orders[['order_id', 'user_id', 'order_number', 'cumdays']], on='order_id')
+    lines = lines.sort_values('user_id', kind='stable').reset_index(drop=True)
+    return orders, lines, _product_rate(op)
+
+
+def _product_rate(lines):
+    '''Reorder proportion of every product_id over `lines`, as a dense array.'''
+    sums = np.bincount(lines['product_id'], weights=lines['reordered'])
+    counts = np.bincount(lines['product_id'], minlength=len(sums))
+    return np.where(counts > 0, sums / np.maximum(counts, 1), 0.0)
+
+
+def features(orders, lines, product_rate):
+    '''
+    Feature frame with one row per (user_id, product_id) in `lines`.
+    `orders` are the user's history orders; the next order is predicted.
+    '''
+    user = orders.groupby('user_id').agg(user_orders=('order_number', 'max'),
+                                         user_cumdays=('cumdays', 'max'),
+                                         user_mean_days=('days_since_prior_order', 'mean'))
+    user['user_reorder_rate'] = lines.groupby('user_id')['reordered'].mean()
+    up = lines.groupby(['user_id', 'product_id']).agg(up_orders=('order_number', 'size'),
+                                                      up_first=('order_number', 'min'),
+                                                      up_last=('order_number', 'max'),
+                                                      up_last_cumdays=('cumdays', 'max'))
+    up = up.reset_index().join(user, on='user_id')
+    up['up_rate'] = up['up_orders'] / up['user_orders']
+    up['up_rate_since_first'] = up['up_orders'] / (up['user_orders'] - up['up_first'] + 1)
+    up['up_orders_since_last'] = up['user_orders'] - up['up_last']
+    up['up_days_since_last'] = up['user_cumdays'] - up['up_last_cumdays']
+    up['user_mean_days'] = up['user_mean_days'].fillna(30.0)
+    up['user_reorder_rate'] = up['user_reorder_rate'].fillna(0.0)
+    pids = up['product_id'].to_numpy()
+    up['product_reorder_rate'] = np.where(pids < len(product_rate),
+                                          product_rate[np.minimum(pids, len(product_rate) - 1)], 0.0)
+    return up[['user_id', 'product_id'] + FEATURES]
+
+
+def _sample_users(user_ids, fraction, seed):
+    '''Deterministic hash-based user sample.'''
+    h = (user_ids.astype(np.uint64) * np.uint64(2654435761) + np.uint64(seed)) % np.uint64(2**32)
+    return h < np.uint64(fraction * 2**32)
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-np.clip(z, -30, 30)))
+
+
+def fit(orders, lines, sample_fraction=0.1, l2=1.0, iterations=25, seed=0):
+    '''
+    Fit logistic weights by Newton/IRLS on a user sample.
+    Each sampled user's last order is the label, earlier orders the history;
+    product reorder rates are taken over the earlier orders only, so the
+    labels do not leak into that feature.
+    Returns a model dict with feature means, scales and coefficients.
+    '''
+    n_orders = orders.groupby('user_id')['order_number'].transform('max')
+    last_number = orders.groupby('user_id')['order_number'].max()
+    prior = lines['order_number'].to_numpy() < last_number.reindex(lines['user_id'].to_numpy()).to_numpy()
+    product_rate = _product_rate(lines[prior])
+    orders = orders[n_orders >= 2]
+    keep = _sample_users(orders['user_id'].to_numpy(), sample_fraction, seed)
+    orders = orders[keep]
+    last = orders.groupby('user_id')['order_number'].transform('max') == orders['order_number']
+    history = orders[~last]
+    target = orders.loc[last, ['user_id', 'order_number']]
+    sample_lines = lines.merge(target, on='user_id', suffixes=('', '_last'))
+    in_last = sample_lines['order_number'] == sample_lines['order_number_last']
+    label_pairs = sample_lines.loc[in_last, ['user_id', 'product_id']].assign(label=1.0)
+    hist_lines = sample_lines.loc[~in_last, ['user_id', 'product_id', 'reordered',
+                                             'order_number', 'cumdays']]
+    feats = features(history, hist_lines, product_rate)
+    feats = feats.merge(label_pairs, on=['user_id', 'product_id'], how='left')
+    y = feats['label'].fillna(0.0).to_numpy()
+    X = feats[FEATURES].to_numpy(dtype=np.float64)
+    mean = X.mean(axis=0) if len(X) else np.zeros(len(FEATURES))
+    scale = X.std(axis=0) if len(X) else np.ones(len(FEATURES))
+    scale[scale == 0] = 1.0
+    X = np.column_stack([np.ones(len(X)), (X - mean) / scale])
+    w = np.zeros(X.shape[1])
+    penalty = np.full(X.shape[1], l2)
+    penalty[0] = 0.0
+    for _ in range(iterations):
+        p = _sigmoid(X @ w)
+        grad = X.T @ (y - p) - penalty * w
+        hess = (X * (p * (1 - p))[:, None]).T @ X + np.diag(penalty) + 1e-9 * np.eye(X.shape[1])
+        step = np.linalg.solve(hess, grad)
+        w += step
+        if np.abs(step).max() < 1e-6:
+            break
+    return {'features': list(FEATURES), 'mean': mean, 'scale': scale, 'coef': w}
+
+
+def score(feats, model):
+    '''Reorder probability for each row of a feature frame.'''
+    X = (feats[model['features']].to_numpy(dtype=np.float64) - model['mean']) / model['scale']
+    return _sigmoid(model['coef'][0] + X @ model['coef'][1:])
+
+
+def top_k(feats, scores, k):
+    '''Keep the k best-scoring products per user.'''
+    out = feats[['user_id', 'product_id']].assign(score=scores)
+    out = out.sort_values(['user_id', 'score'], ascending=[True, False], kind='stable')
+    out['rank'] = out.groupby('user_id').cumcount() + 1
+    return out[out['rank'] <= k].reset_index(drop=True)
+
+
+_WORKER = {}
+
+
+def _init_worker(product_rate, model, k):
+    _WORKER.update(product_rate=product_rate, model=model, k=k)
+
+
+def _score_chunk(orders, lines):
+    feats = features(orders, lines, _WORKER['product_rate'])
+    return top_k(feats, score(feats, _WORKER['model']), _WORKER['k'])
+
+
+def _chunks(orders, lines, chunk_users):
+    '''Yield (orders, lines) slices covering `chunk_users` users each.'''
+    order_users = orders['user_id'].to_numpy()
+    line_users = lines['user_id'].to_numpy()
+    users = np.unique(order_users)
+    for start in range(0, len(users), chunk_users):
+        lo = users[start]
+        hi = users[min(start + chunk_users, len(users)) - 1]
+        o = slice(np.searchsorted(order_users, lo, 'left'), np.searchsorted(order_users, hi, 'right'))
+        ln = slice(np.searchsorted(line_users, lo, 'left'), np.searchsorted(line_users, hi, 'right'))
+        yield orders.iloc[o], lines.iloc[ln]
+
+
+def recommend(tables, k=10, output=None, model=None, chunk_users=50_000, workers=None):
+    '''
+    Score every user's candidate products and keep the top k.
+    output = csv path written chunk by chunk; the frame is returned if None
+    model = from fit(); fitted on a 10% user sample if None
+    workers = process count (1 scores in-process)
+    '''
+    orders, lines, product_rate = prepare(tables)
+    if model is None:
+        model = fit(orders, lines)
+    workers = workers or os.cpu_count() or 1
+    results = []
+    header = True
+
+    def emit(frame):
+        nonlocal header
+        if output is None:
+            results.append(frame)
+        else:
+            frame.to_csv(output, mode='w' if header else 'a', header=header, index=False)
+            header = False
+
+    chunks = _chunks(orders, lines, chunk_users)
+    if workers == 1:
+        _init_worker(product_rate, model, k)
+        for o, ln in chunks:
+            emit(_score_chunk(o, ln))
+    else:
+        # keep at most 2 chunks per worker in flight to bound memory;
+        # chunks are written in completion order
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(product_rate, model, k)) as pool:
+            pending = set()
+            for o, ln in chunks:
+                pending.add(pool.submit(_score_chunk, o, ln))
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        emit(f.result())
+            for f in pending:
+                emit(f.result())
+    if output is None:
+        if not results:
+            return pd.DataFrame(columns=['user_id', 'product_id', 'score', 'rank'])
+        return pd.concat(results).sort_values(['user_id', 'rank']).reset_index(drop=True)
+    return output
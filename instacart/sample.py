@@ -0,0 +1,368 @@
+'''
+Stratified user samples for fast exploration.
+
+Users are grouped into strata by their number of orders (bucketed) and by the
+day of week and part of day they order most often. Strata too small to get
+at least two sampled users at the requested fraction are merged (first
+across parts of day, then days of week, then order-count buckets), so that
+every stratum has a within-stratum variance. The sample size
+``round(fraction * N)`` is allocated to the strata in proportion to their
+size by largest remainders, and within each stratum users are ranked by a
+seeded 64-bit hash of ``user_id`` and the first ``n_h`` are kept, so the
+same seed always selects the same users. The sample carries all orders and
+order lines of the selected users; ``load`` reads only the sampled order
+lines from the export.
+
+Estimates treat the user as the sampling unit. A total (orders per hour,
+order lines per product, ...) is the sum of per-user totals weighted by
+``N_h / n_h``, with the stratified variance
+``sum_h N_h^2 (1 - n_h / N_h) s_h^2 / n_h``; proportions use the linearized
+ratio estimator. Bounds are normal-approximation intervals.
+'''
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from instacart.clean import clean_order_products, clean_tables, day_of_week
+from instacart.data import read_table
+from instacart.plan import load_for, plan
+
+# lower edges of the order-count buckets
+ORDER_BINS = (1, 4, 8, 16, 32, 64)
+# lower edges of the parts of day, in hours
+DAYPARTS = {0: 'night', 6: 'morning', 12: 'afternoon', 18: 'evening'}
+
+# code of "any" in each part of a merged stratum
+_ANY_BIN, _ANY_DOW, _ANY_PART = len(ORDER_BINS), 7, len(DAYPARTS)
+# sampled users a stratum needs for its variance to be estimable
+MIN_PER_STRATUM = 2
+
+# columns a sample needs on top of those of the analyses it feeds
+COLUMNS = {'instacart_orders': ['order_id', 'user_id', 'order_dow', 'order_hour_of_day'],
+           'order_products': ['order_id']}
+
+_MASK = 2**64 - 1
+
+
+def _hash(user_ids, seed):
+    '''splitmix64 of user_id, offset by the seed.'''
+    z = np.asarray(user_ids).astype(np.uint64) + np.uint64((seed * 0x9E3779B97F4A7C15) & _MASK)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _preferred(user_codes, values, levels):
+    '''Most frequent value per user (the lowest one on ties).'''
+    counts = np.zeros((user_codes.max() + 1, levels), dtype=np.int32)
+    np.add.at(counts, (user_codes, values), 1)
+    return counts.argmax(axis=1)
+
+
+def _code(bucket, dow, daypart):
+    return (bucket * (_ANY_DOW + 1) + dow) * (_ANY_PART + 1) + daypart
+
+
+def _decode(code):
+    '''(bucket, dow, daypart) of stratum codes; the _ANY values mark merged parts.'''
+    rest, daypart = np.divmod(code, _ANY_PART + 1)
+    bucket, dow = np.divmod(rest, _ANY_DOW + 1)
+    return bucket, dow, daypart
+
+
+def merge_strata(stratum, fraction, min_n=MIN_PER_STRATUM):
+    '''
+    Stratum codes with the strata that would get fewer than `min_n` users at
+    `fraction` merged: across parts of day, then days of week, then order-count
+    buckets; whatever is still too small ends in one catch-all stratum.
+    '''
+    bucket, dow, daypart = _decode(np.asarray(stratum))
+    merged = np.full(len(bucket), _code(_ANY_BIN, _ANY_DOW, _ANY_PART))
+    pending = np.ones(len(bucket), dtype=bool)
+    for codes in (_code(bucket, dow, daypart), _code(bucket, dow, _ANY_PART),
+                  _code(bucket, _ANY_DOW, _ANY_PART)):
+        sizes = np.bincount(codes[pending], minlength=_code(_ANY_BIN, _ANY_DOW, _ANY_PART) + 1)
+        big = pending & (sizes[codes] * fraction >= min_n)
+        merged[big] = codes[big]
+        pending &= ~big
+    return merged
+
+
+def allocate(sizes, fraction, min_n=MIN_PER_STRATUM):
+    '''
+    Proportional sample size of every stratum: `fraction` of `sizes` rounded
+    by largest remainders so they add up to round(fraction * N), and at least
+    `min_n` (or the whole stratum when smaller).
+    '''
+    sizes = np.asarray(sizes, dtype=np.int64)
+    exact = sizes * fraction
+    quota = np.floor(exact).astype(np.int64)
+    extra = int(round(fraction * sizes.sum())) - int(quota.sum())
+    if extra > 0:
+        quota[np.argsort(quota - exact, kind='stable')[:extra]] += 1
+    return np.maximum(quota, np.minimum(sizes, min_n))
+
+
+def user_strata(df_instacart_orders):
+    '''
+    Stratum of every user: order-count bucket, preferred order_dow and
+    preferred part of day. Returns a frame indexed by user_id.
+    '''
+    orders = df_instacart_orders
+    codes, users = pd.factorize(orders['user_id'], sort=True)
+    n_orders = np.bincount(codes, minlength=len(users))
+    dow = _preferred(codes, orders['order_dow'].to_numpy().astype(np.intp), 7)
+    part = np.searchsorted(list(DAYPARTS), orders['order_hour_of_day'].to_numpy(), side='right') - 1
+    daypart = _preferred(codes, part, len(DAYPARTS))
+    bucket = np.searchsorted(ORDER_BINS, n_orders, side='right') - 1
+    stratum = _code(bucket, dow, daypart)
+    return pd.DataFrame({'orders': n_orders,
+                         'order_bin': np.asarray(ORDER_BINS)[bucket],
+                         'preferred_dow': dow,
+                         'preferred_daypart': np.asarray(list(DAYPARTS.values()))[daypart],
+                         'stratum': stratum.astype(np.int32)},
+                        index=pd.Index(users, name='user_id'))
+
+
+class UserSample:
+    '''
+    A stratified sample of users and the tables restricted to them.
+    users = sampled user_id -> stratum and weight (N_h / n_h)
+    strata = stratum -> population size N and sample size n
+    '''
+
+    def __init__(self, tables, users, strata, fraction, seed):
+        self.tables = tables
+        self.users = users
+        self.strata = strata
+        self.fraction = fraction
+        self.seed = seed
+
+    def __repr__(self):
+        return (f'UserSample(fraction={self.fraction}, seed={self.seed}, '
+                f'users={len(self.users)}/{int(self.strata["N"].sum())})')
+
+    def line_users(self):
+        '''user_id of every sampled order line.'''
+        orders = self.tables['instacart_orders']
+        op = self.tables['order_products']
+        idx = pd.Index(orders['order_id']).get_indexer(op['order_id'])
+        return orders['user_id'].to_numpy()[idx]
+
+    def _population(self, user_ids, keys, columns):
+        '''Per-user totals of `columns` by key, with the N and n of their stratum.'''
+        frame = pd.DataFrame({'user_id': np.asarray(user_ids), 'key': np.asarray(keys), **columns})
+        per_user = frame.groupby(['user_id', 'key'], sort=False).sum().reset_index()
+        stratum = self.users['stratum'].reindex(per_user['user_id'].to_numpy()).to_numpy()
+        per_user['stratum'] = stratum
+        sizes = self.strata.reindex(stratum)
+        per_user['N'] = sizes['N'].to_numpy()
+        per_user['n'] = sizes['n'].to_numpy()
+        return per_user
+
+    def total(self, user_ids, keys, values=None, alpha=0.05):
+        '''
+        Estimated population total of `values` (1 per row by default) by key,
+        from rows tagged with their user_id.
+        Returns a frame indexed by key with estimate, std_error, lower, upper.
+        '''
+        y = np.ones(len(keys)) if values is None else np.asarray(values, dtype=np.float64)
+        per_user = self._population(user_ids, keys, {'y': y})
+        per_user['yy'] = per_user['y'] ** 2
+        m = per_user.groupby(['key', 'stratum']).agg(y=('y', 'sum'), yy=('yy', 'sum'),
+                                                     N=('N', 'first'), n=('n', 'first'))
+        estimate = (m['y'] * m['N'] / m['n']).groupby(level='key').sum()
+        s2 = (m['yy'] - m['y'] ** 2 / m['n']) / np.maximum(m['n'] - 1, 1)
+        var = (m['N'] ** 2 * (1 - m['n'] / m['N']) / m['n'] * s2).groupby(level='key').sum()
+        return _bounds(estimate, var, alpha, low=0)
+
+    def ratio(self, user_ids, keys, numerator, denominator, alpha=0.05):
+        '''
+        Estimated population ratio sum(numerator) / sum(denominator) by key,
+        from rows tagged with their user_id.
+        Returns a frame indexed by key with estimate, std_error, lower, upper.
+        '''
+        per_user = self._population(user_ids, keys,
+                                    {'y': np.asarray(numerator, dtype=np.float64),
+                                     'x': np.asarray(denominator, dtype=np.float64)})
+        per_user['yy'] = per_user['y'] ** 2
+        per_user['xx'] = per_user['x'] ** 2
+        per_user['xy'] = per_user['x'] * per_user['y']
+        m = per_user.groupby(['key', 'stratum']).agg(y=('y', 'sum'), x=('x', 'sum'), yy=('yy', 'sum'),
+                                                     xx=('xx', 'sum'), xy=('xy', 'sum'),
+                                                     N=('N', 'first'), n=('n', 'first'))
+        w = m['N'] / m['n']
+        y_total = (m['y'] * w).groupby(level='key').sum()
+        x_total = (m['x'] * w).groupby(level='key').sum()
+        r = y_total / x_total
+        rk = r.reindex(m.index.get_level_values('key')).to_numpy()
+        # residuals y - r x of each user, summarised per stratum
+        z = m['y'] - rk * m['x']
+        zz = m['yy'] - 2 * rk * m['xy'] + rk ** 2 * m['xx']
+        s2 = (zz - z ** 2 / m['n']) / np.maximum(m['n'] - 1, 1)
+        var = (m['N'] ** 2 * (1 - m['n'] / m['N']) / m['n'] * s2).groupby(level='key').sum()
+        return _bounds(r, var / x_total ** 2, alpha)
+
+
+def _bounds(estimate, var, alpha, low=None, high=None):
+    z = NormalDist().inv_cdf(1 - alpha / 2)
+    std = np.sqrt(np.maximum(var, 0))
+    return pd.DataFrame({'estimate': estimate, 'std_error': std,
+                         'lower': (estimate - z * std).clip(low, high),
+                         'upper': (estimate + z * std).clip(low, high)})
+
+
+def draw(tables, fraction=0.01, seed=0):
+    '''
+    Stratified sample of `fraction` of the users of `tables` (cleaned or raw)
+    with all their orders and order lines; other tables are kept whole.
+    '''
+    if not 0 < fraction <= 1:
+        raise ValueError('fraction must be in (0, 1]')
+    orders = tables['instacart_orders']
+    strata = user_strata(orders)
+    strata['stratum'] = merge_strata(strata['stratum'].to_numpy(), fraction)
+    stratum = strata['stratum'].to_numpy()
+    users = strata.index.to_numpy()
+    order = np.lexsort((users, _hash(users, seed), stratum))
+    sorted_strata = stratum[order]
+    starts = np.flatnonzero(np.r_[True, sorted_strata[1:] != sorted_strata[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    quota = allocate(sizes, fraction)
+    rank = np.arange(len(order)) - np.repeat(starts, sizes)
+    chosen = order[rank < np.repeat(quota, sizes)]
+    sizes = pd.DataFrame({'N': sizes, 'n': quota}, index=pd.Index(sorted_strata[starts], name='stratum'))
+    picked = strata.iloc[np.sort(chosen)][['stratum']]
+    picked['weight'] = (sizes['N'] / sizes['n']).reindex(picked['stratum'].to_numpy()).to_numpy()
+    sampled = dict(tables)
+    sampled['instacart_orders'] = orders[orders['user_id'].isin(picked.index)]
+    if 'order_products' in tables:
+        op = tables['order_products']
+        sampled['order_products'] = op[op['order_id'].isin(sampled['instacart_orders']['order_id'])]
+    return UserSample(sampled, picked, sizes, fraction, seed)
+
+
+def load(analyses, fraction=0.01, seed=0, data_dir=None, workers=1):
+    '''
+    Draw a sample for `analyses` straight from the exports: the orders are
+    loaded and sampled first, then only the order lines of the sampled
+    orders are kept while order_products is parsed, and the tables are
+    cleaned after that.
+    '''
+    kwargs = {} if data_dir is None else {'data_dir': data_dir}
+    columns = plan(analyses, COLUMNS)
+    tables = clean_tables(load_for(analyses, workers=workers, extra=COLUMNS, skip=['order_products'], **kwargs))
+    sample = draw(tables, fraction, seed)
+    if 'order_products' in columns:
+        ids = sample.tables['instacart_orders']['order_id'].to_numpy()
+        op = read_table('order_products', usecols=columns['order_products'], workers=workers,
+                        keep=('order_id', ids), **kwargs)
+        sample.tables['order_products'] = clean_order_products(op)
+    return sample
+
+
+def _with_names(frame, df_products, value_name):
+    '''Key the estimate frame by product_id, rename the estimate and add names.'''
+    frame = frame.rename(columns={'estimate': value_name}).rename_axis('product_id').reset_index()
+    frame = frame.merge(df_products[['product_id', 'product_name']], on='product_id', how='left')
+    return frame[['product_id', 'product_name', value_name, 'std_error', 'lower', 'upper']]
+
+
+def _by_order(sample, column, alpha):
+    orders = sample.tables['instacart_orders']
+    est = sample.total(orders['user_id'], orders[column], alpha=alpha).sort_index()
+    return est.rename(columns={'estimate': 'orders'}).rename_axis(column).reset_index()
+
+
+def orders_by_hour(sample, n=None, alpha=0.05):
+    '''Estimated number of orders per order_hour_of_day.'''
+    return _by_order(sample, 'order_hour_of_day', alpha)
+
+
+def orders_by_dow(sample, n=None, alpha=0.05):
+    '''Estimated number of orders per order_dow.'''
+    return _by_order(sample, 'order_dow', alpha)
+
+
+def _top(sample, mask, n, alpha):
+    op = sample.tables['order_products']
+    users = sample.line_users()
+    if mask is not None:
+        users, op = users[mask], op[mask]
+    est = sample.total(users, op['product_id'], alpha=alpha)
+    est = est.sort_values('estimate', ascending=False, kind='stable').head(n)
+    return _with_names(est, sample.tables['products'], 'freq')
+
+
+def top_products(sample, n=20, alpha=0.05):
+    '''The `n` products estimated to appear on the most order lines.'''
+    return _top(sample, None, n, alpha)
+
+
+def top_reordered(sample, n=20, alpha=0.05):
+    '''The `n` products estimated to be reordered most frequently.'''
+    return _top(sample, sample.tables['order_products']['reordered'].to_numpy() == 1, n, alpha)
+
+
+def top_first_in_cart(sample, n=20, alpha=0.05):
+    '''The `n` products estimated to be put in the cart first most often.'''
+    return _top(sample, sample.tables['order_products']['add_to_cart_order'].to_numpy() == 1, n, alpha)
+
+
+def order_sizes(sample, n=None, alpha=0.05):
+    '''Estimated number of orders per basket size.'''
+    orders = sample.tables['instacart_orders']
+    sizes = sample.tables['order_products'].groupby('order_id').size()
+    users = orders.drop_duplicates('order_id').set_index('order_id')['user_id'].reindex(sizes.index)
+    est = sample.total(users.to_numpy(), sizes.to_numpy(), alpha=alpha).sort_index()
+    return est.rename(columns={'estimate': 'orders'}).rename_axis('items').reset_index()
+
+
+def product_reorder_proportions(sample, n=None, alpha=0.05):
+    '''Estimated share of each product's order lines that are reorders, in percent.'''
+    op = sample.tables['order_products']
+    est = sample.ratio(sample.line_users(), op['product_id'], op['reordered'], np.ones(len(op)), alpha)
+    est[['lower', 'upper']] = est[['lower', 'upper']].clip(0, 1)
+    return _with_names(est * 100, sample.tables['products'], 'proportion_product_reorders')
+
+
+def reorder_proportion_bins(sample, n=None, alpha=0.05, bin_size=5):
+    '''
+    Estimated number of users per `bin_size`-percent bin of the share of
+    their order lines that are reorders; the per-user shares themselves do
+    not extend from a sample to the population.
+    '''
+    op = sample.tables['order_products']
+    prop = op['reordered'].groupby(sample.line_users()).mean().mul(100)
+    bins = np.minimum(prop.to_numpy() // bin_size * bin_size, 100 - bin_size)
+    est = sample.total(prop.index.to_numpy(), bins, alpha=alpha).sort_index()
+    return est.rename(columns={'estimate': 'users'}).rename_axis('proportion_user_reorders').reset_index()
+
+
+# sampled counterparts of analysis.ANALYSES; user-reorders estimates users per
+# reorder-share bin instead of one row per user
+ESTIMATES = {'hour-of-day': orders_by_hour,
+             'day-of-week': orders_by_dow,
+             'top-products': top_products,
+             'top-reordered': top_reordered,
+             'first-in-cart': top_first_in_cart,
+             'order-sizes': order_sizes,
+             'product-reorders': product_reorder_proportions,
+             'user-reorders': reorder_proportion_bins}
+
+
+def estimate(name, sample, n=20, alpha=0.05):
+    '''Run the sampled version of analysis `name` over `sample`.'''
+    return ESTIMATES[name](sample, n, alpha)
+
+
+def describe(sample):
+    '''Population and sample size of every stratum with its labels.'''
+    bucket, dow, daypart = _decode(sample.strata.index.to_numpy())
+    return pd.DataFrame({'order_bin': pd.Series(np.r_[ORDER_BINS, -1][bucket]).replace(-1, 'any').to_numpy(),
+                         'day_of_week': pd.Series(dow).map(day_of_week).fillna('any').to_numpy(),
+                         'daypart': np.asarray([*DAYPARTS.values(), 'any'])[daypart],
+                         'users': sample.strata['N'].to_numpy(),
+                         'sampled': sample.strata['n'].to_numpy()},
+                        index=sample.strata.index)
@@ -0,0 +1,224 @@
+'''
+Product-name search.
+
+Names are normalized like ``normalize_names`` (lower case, hyphens dropped)
+and split into word tokens; hyphenated words are also indexed joined up, so
+"half-and-half" is found by "half and half" and by "halfandhalf". Products
+are numbered by popularity rank (most ordered first, as in
+``df_clean_grouped``) and every token maps to the sorted ranks of the
+products containing it, so intersecting the postings of the query terms
+yields matches already in popularity order and the first ``limit`` are the
+answer.
+
+The vocabulary is a sorted list: an exact token and a prefix range are both
+found by bisection. Fuzzy lookup (a misspelt term with no exact match) goes
+through a trigram index of the vocabulary, built on first use, and keeps the
+tokens within a small edit distance. The postings are stored as CSR arrays,
+so an index saved with ``save`` loads without re-tokenizing.
+'''
+import bisect
+import re
+
+import numpy as np
+import pandas as pd
+
+_WORD = re.compile(r'[^\W_]+')
+
+
+def tokens(name):
+    '''Normalized word tokens of a name or query.'''
+    return _WORD.findall(name.lower())
+
+
+def _compounds(name):
+    '''Hyphenated words of a name joined up ("half-and-half" -> "halfandhalf").'''
+    return [''.join(_WORD.findall(w)) for w in name.lower().split() if '-' in w]
+
+
+def _trigrams(token):
+    padded = f' {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _max_edits(token):
+    return 0 if len(token) <= 3 else 1 if len(token) <= 7 else 2
+
+
+def edit_distance(a, b, limit):
+    '''Levenshtein distance of a and b, or limit + 1 once it exceeds `limit`.'''
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def product_popularity(df_order_products):
+    '''Order lines per product_id, the freq of the notebook's df_clean_grouped.'''
+    return df_order_products['product_id'].value_counts()
+
+
+class ProductIndex:
+    '''
+    Inverted index from name tokens to products ranked by popularity.
+    product_ids, names, popularity = per rank (0 = most popular)
+    vocab, indptr, postings = CSR map from sorted tokens to sorted ranks
+    '''
+
+    def __init__(self, product_ids, names, popularity, vocab, indptr, postings):
+        self.product_ids = product_ids
+        self.names = names
+        self.popularity = popularity
+        self.vocab = vocab
+        self.indptr = indptr
+        self.postings = postings
+        self._grams = None
+
+    @classmethod
+    def build(cls, df_products, popularity=None):
+        '''
+        Index the product names of `df_products` (raw or cleaned).
+        popularity = order count per product_id (a Series, or df_clean_grouped
+            with its freq column); products without one rank last
+        '''
+        if isinstance(popularity, pd.DataFrame):
+            popularity = popularity['freq']
+            if isinstance(popularity.index, pd.MultiIndex):
+                popularity.index = popularity.index.get_level_values('product_id')
+        ids = df_products['product_id'].to_numpy()
+        counts = np.zeros(len(ids), dtype=np.int64)
+        if popularity is not None:
+            popularity = popularity.groupby(level=0).sum()
+            counts = popularity.reindex(ids).fillna(0).to_numpy(np.int64)
+        order = np.lexsort((ids, -counts))
+        names = df_products['product_name'].astype(object).to_numpy()[order]
+        named = pd.Series(names).dropna()
+        ranks = np.concatenate([np.repeat(named.index.to_numpy(), [len(tokens(n)) for n in named]),
+                                np.repeat(named.index.to_numpy(), [len(_compounds(n)) for n in named])])
+        words = [t for n in named for t in tokens(n)] + [t for n in named for t in _compounds(n)]
+        pairs = pd.DataFrame({'token': words, 'rank': ranks.astype(np.int32)}).drop_duplicates()
+        codes, vocab = pd.factorize(pairs['token'], sort=True)
+        by_token = np.lexsort((pairs['rank'].to_numpy(), codes))
+        indptr = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(vocab)))]
+        names = [None if n is None or n != n else n for n in names]
+        return cls(ids[order], names, counts[order], list(vocab),
+                   indptr, pairs['rank'].to_numpy()[by_token])
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def _find(self, token):
+        '''Vocabulary position of `token`, or -1.'''
+        i = bisect.bisect_left(self.vocab, token)
+        return i if i < len(self.vocab) and self.vocab[i] == token else -1
+
+    def _ranks(self, positions):
+        '''Sorted ranks of the products holding any token in `positions`.'''
+        parts = [self.postings[self.indptr[i]:self.indptr[i + 1]] for i in positions]
+        if not parts:
+            return np.array([], dtype=self.postings.dtype)
+        return parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts))
+
+    def exact(self, token):
+        '''Ranks of products with the token `token`.'''
+        i = self._find(token)
+        return self._ranks([i] if i >= 0 else [])
+
+    def prefix(self, text):
+        '''Ranks of products with a token starting with `text`.'''
+        lo = bisect.bisect_left(self.vocab, text)
+        hi = bisect.bisect_left(self.vocab, text + '\U0010ffff', lo)
+        return self._ranks(range(lo, hi))
+
+    def _trigram_index(self):
+        if self._grams is None:
+            grams = [(g, i) for i, t in enumerate(self.vocab) for g in _trigrams(t)]
+            frame = pd.DataFrame(grams, columns=['gram', 'token'])
+            codes, keys = pd.factorize(frame['gram'])
+            order = np.argsort(codes, kind='stable')
+            indptr = np.r_[0, np.cumsum(np.bincount(codes, minlength=len(keys)))]
+            tokens_ = frame['token'].to_numpy(np.int32)[order]
+            self._grams = {g: tokens_[indptr[k]:indptr[k + 1]] for k, g in enumerate(keys)}
+        return self._grams
+
+    def similar(self, token, max_edits=None):
+        '''Vocabulary tokens within `max_edits` edits of `token` (default by length).'''
+        max_edits = _max_edits(token) if max_edits is None else max_edits
+        if max_edits == 0:
+            return [token] if self._find(token) >= 0 else []
+        index = self._trigram_index()
+        grams = _trigrams(token)
+        hits = [index[g] for g in grams if g in index]
+        if not hits:
+            return []
+        candidates, shared = np.unique(np.concatenate(hits), return_counts=True)
+        # q-gram lemma: each edit destroys at most three trigrams
+        candidates = candidates[shared >= len(grams) - 3 * max_edits]
+        return [self.vocab[i] for i in candidates
+                if edit_distance(token, self.vocab[i], max_edits) <= max_edits]
+
+    def fuzzy(self, token, max_edits=None):
+        '''Ranks of products with a token within `max_edits` edits of `token`.'''
+        return self._ranks([self._find(t) for t in self.similar(token, max_edits)])
+
+    def search(self, query, limit=10, prefix=True, fuzzy=True):
+        '''
+        Products whose names contain every term of `query`, most popular first,
+        as (product_id, product_name, popularity) tuples.
+        prefix = the last term may be the start of a word (search as you type)
+        fuzzy = a term with no match is replaced by its near spellings
+        '''
+        terms = tokens(query)
+        if not terms:
+            return []
+        matches = []
+        for i, term in enumerate(terms):
+            ranks = self.prefix(term) if prefix and i == len(terms) - 1 else self.exact(term)
+            if not len(ranks) and fuzzy:
+                ranks = self.fuzzy(term)
+            if not len(ranks):
+                return []
+            matches.append(ranks)
+        matches.sort(key=len)
+        ranks = matches[0]
+        for other in matches[1:]:
+            ranks = ranks[np.isin(ranks, other, assume_unique=True)]
+            if not len(ranks):
+                return []
+        return [(int(self.product_ids[r]), self.names[r], int(self.popularity[r])) for r in ranks[:limit]]
+
+    def save(self, path):
+        '''Write the index to `path` (.npz format, whatever its name).'''
+        names, name_offsets = _pack(['' if n is None else n for n in self.names])
+        vocab, vocab_offsets = _pack(self.vocab)
+        # through a file object, so that numpy does not append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez(f, product_ids=self.product_ids, popularity=self.popularity,
+                     names=names, name_offsets=name_offsets, vocab=vocab, vocab_offsets=vocab_offsets,
+                     indptr=self.indptr, postings=self.postings)
+
+    @classmethod
+    def load(cls, path):
+        '''Read an index written by save.'''
+        data = np.load(path)
+        names = [n or None for n in _unpack(data['names'], data['name_offsets'])]
+        return cls(data['product_ids'], names, data['popularity'],
+                   _unpack(data['vocab'], data['vocab_offsets']), data['indptr'], data['postings'])
+
+
+def _pack(strings):
+    '''utf-8 bytes of `strings` back to back, and their offsets.'''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.r_[0, np.cumsum([len(b) for b in encoded], dtype=np.int64)]
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack(data, offsets):
+    raw = data.tobytes()
+    return [raw[a:b].decode('utf-8') for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
@@ -0,0 +1,288 @@
+'''
+Customer segments from behavioural features, by mini-batch k-means.
+
+The notebook's "segmentation" cuts the per-user reorder proportion into
+histogram bins. Here users are clustered on several features at once:
+
+    order_count           orders placed (log scale in the model)
+    reorder_rate          share of order lines that are reorders
+    mean_days_between     mean days_since_prior_order
+    basket_size           mean order lines per order (log scale in the model)
+    dow_cos, dow_sin      mean direction of the order days on the week circle
+    hour_cos, hour_sin    mean direction of the order hours on the day circle
+
+The direction features carry both the preferred day/hour (their angle) and
+how set the habit is (their length). Order lines are reduced to per-order
+counts as they stream in, so order_products is never held whole; user
+features are then built a chunk of users at a time from the orders. Fitting
+passes over the chunks (standardization statistics first, then mini-batch
+k-means epochs, Sculley 2010) and labelling is a last pass that writes each
+user's segment and accumulates the per-segment profiles, so the feature
+matrix of all users never exists at once.
+'''
+import math
+
+import numpy as np
+import pandas as pd
+
+from instacart.clean import day_of_week
+
+FEATURES = ['order_count', 'reorder_rate', 'mean_days_between', 'basket_size',
+            'dow_cos', 'dow_sin', 'hour_cos', 'hour_sin']
+# modelled on a log scale
+LOGGED = ['order_count', 'basket_size']
+
+ORDER_COLUMNS = ['order_id', 'user_id', 'order_dow', 'order_hour_of_day', 'days_since_prior_order']
+
+
+def order_lines(order_products):
+    '''
+    Lines and reordered lines per order_id, from a frame of order lines or
+    an iterable of chunks of them.
+    '''
+    if hasattr(order_products, 'columns'):
+        order_products = [order_products]
+    parts = [chunk.groupby('order_id').agg(lines=('reordered', 'size'), reordered=('reordered', 'sum'))
+             for chunk in order_products]
+    if not parts:
+        return pd.DataFrame({'lines': [], 'reordered': []}, index=pd.Index([], name='order_id'))
+    # an order's lines may span chunks
+    return pd.concat(parts).groupby(level=0).sum()
+
+
+def user_features(orders):
+    '''Feature frame indexed by user_id from orders with lines/reordered columns.'''
+    dow = orders['order_dow'].to_numpy(np.float64) * (2 * math.pi / 7)
+    hour = orders['order_hour_of_day'].to_numpy(np.float64) * (2 * math.pi / 24)
+    frame = pd.DataFrame({'user_id': orders['user_id'].to_numpy(),
+                          'lines': orders['lines'].to_numpy(np.float64),
+                          'reordered': orders['reordered'].to_numpy(np.float64),
+                          'days': orders['days_since_prior_order'].to_numpy(np.float64),
+                          'dow_cos': np.cos(dow), 'dow_sin': np.sin(dow),
+                          'hour_cos': np.cos(hour), 'hour_sin': np.sin(hour)})
+    g = frame.groupby('user_id', sort=True)
+    out = g.agg(order_count=('lines', 'size'), lines=('lines', 'sum'), reordered=('reordered', 'sum'),
+                mean_days_between=('days', 'mean'), dow_cos=('dow_cos', 'mean'), dow_sin=('dow_sin', 'mean'),
+                hour_cos=('hour_cos', 'mean'), hour_sin=('hour_sin', 'mean'))
+    out['reorder_rate'] = out['reordered'] / out['lines'].where(out['lines'] > 0)
+    out['basket_size'] = out['lines'] / out['order_count']
+    return out[FEATURES]
+
+
+def prepare_orders(tables, per_order=None):
+    '''
+    Orders sorted by user with their lines/reordered counts.
+    tables = instacart_orders, plus order_products (a frame or chunks) unless
+        `per_order` (from order_lines) is given
+    '''
+    if per_order is None:
+        per_order = order_lines(tables['order_products'])
+    orders = tables['instacart_orders'][ORDER_COLUMNS].drop_duplicates('order_id')
+    orders = orders.sort_values('user_id', kind='stable', ignore_index=True)
+    counts = per_order.reindex(orders['order_id'].to_numpy())
+    return orders.assign(lines=counts['lines'].fillna(0).to_numpy(),
+                         reordered=counts['reordered'].fillna(0).to_numpy())
+
+
+def feature_chunks(orders, chunk_users=500_000):
+    '''Yield feature frames of `chunk_users` users at a time from prepare_orders output.'''
+    users = orders['user_id'].to_numpy()
+    bounds = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])[::chunk_users]
+    for lo, hi in zip(bounds, np.r_[bounds[1:], len(users)]):
+        yield user_features(orders.iloc[lo:hi])
+
+
+class _Scaler:
+    '''Running mean and standard deviation of the modelled features.'''
+
+    def __init__(self):
+        self.count = np.zeros(len(FEATURES))
+        self.sum = np.zeros(len(FEATURES))
+        self.sumsq = np.zeros(len(FEATURES))
+
+    @staticmethod
+    def raw(features):
+        x = features[FEATURES].to_numpy(np.float64).copy()
+        for column in LOGGED:
+            i = FEATURES.index(column)
+            x[:, i] = np.log1p(x[:, i])
+        return x
+
+    def add(self, features):
+        x = self.raw(features)
+        seen = ~np.isnan(x)
+        self.count += seen.sum(axis=0)
+        self.sum += np.where(seen, x, 0).sum(axis=0)
+        self.sumsq += np.where(seen, x * x, 0).sum(axis=0)
+
+    @property
+    def mean(self):
+        return self.sum / np.maximum(self.count, 1)
+
+    @property
+    def std(self):
+        var = self.sumsq / np.maximum(self.count, 1) - self.mean ** 2
+        return np.sqrt(np.where(var > 0, var, 1.0))
+
+    def transform(self, features):
+        '''Standardized matrix; missing values sit at the mean.'''
+        z = (self.raw(features) - self.mean) / self.std
+        return np.nan_to_num(z, nan=0.0).astype(np.float64)
+
+
+def _distances(x, centers):
+    '''Squared distances of every row of x to every center.'''
+    return (x * x).sum(axis=1)[:, None] - 2 * x @ centers.T + (centers * centers).sum(axis=1)[None, :]
+
+
+def _kmeans_pp(x, k, rng):
+    '''k-means++ seeding over the rows of x.'''
+    centers = [x[rng.integers(len(x))]]
+    closest = ((x - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = closest.sum()
+        i = rng.choice(len(x), p=closest / total) if total > 0 else rng.integers(len(x))
+        centers.append(x[i])
+        closest = np.minimum(closest, ((x - x[i]) ** 2).sum(axis=1))
+    return np.array(centers)
+
+
+class Segmenter:
+    '''
+    Mini-batch k-means over standardized user features.
+    k = segments; batch_size = users per center update
+    epochs = passes over the chunks; init_size = users seeding k-means++
+    '''
+
+    def __init__(self, k=6, batch_size=4096, epochs=3, init_size=50_000, seed=0):
+        self.k = k
+        self.batch_size = batch_size
+        self.epochs = epochs
+        self.init_size = init_size
+        self.seed = seed
+        self.scaler = None
+        self.centers = None
+
+    def fit(self, chunks):
+        '''
+        Fit on feature chunks. chunks = callable returning a fresh iterable of
+        feature frames (e.g. lambda: feature_chunks(orders)), read once for
+        the scaler and once per epoch.
+        '''
+        rng = np.random.default_rng(self.seed)
+        self.scaler = _Scaler()
+        for features in chunks():
+            self.scaler.add(features)
+        counts = np.zeros(self.k)
+        for _ in range(self.epochs):
+            for features in chunks():
+                x = self.scaler.transform(features)
+                x = x[rng.permutation(len(x))]
+                if self.centers is None:
+                    if len(x) < self.k:
+                        continue
+                    self.centers = _kmeans_pp(x[:self.init_size], self.k, rng)
+                for start in range(0, len(x), self.batch_size):
+                    counts = self._update(x[start:start + self.batch_size], counts)
+        if self.centers is None:
+            raise ValueError(f'fewer users than the {self.k} segments')
+        # number segments by activity: 0 = fewest orders
+        self.centers = self.centers[np.argsort(self.centers[:, FEATURES.index('order_count')], kind='stable')]
+        return self
+
+    def _update(self, batch, counts):
+        '''One mini-batch step: each center moves toward its batch mean at rate n / total.'''
+        assign = np.argmin(_distances(batch, self.centers), axis=1)
+        n = np.bincount(assign, minlength=self.k).astype(np.float64)
+        sums = np.stack([np.bincount(assign, weights=batch[:, j], minlength=self.k)
+                         for j in range(batch.shape[1])], axis=1)
+        counts = counts + n
+        hit = n > 0
+        rate = np.zeros(self.k)
+        rate[hit] = n[hit] / counts[hit]
+        means = sums / np.maximum(n, 1)[:, None]
+        self.centers = self.centers + rate[:, None] * (means - self.centers) * hit[:, None]
+        return counts
+
+    def predict(self, features):
+        '''Segment of every row of a feature frame.'''
+        return np.argmin(_distances(self.scaler.transform(features), self.centers), axis=1)
+
+    def label(self, chunks, output=None):
+        '''
+        Label every user and profile the segments in one pass over the chunks.
+        output = csv path the user_id, segment rows are appended to, chunk by
+            chunk; the labels frame is returned instead if None
+        Returns (labels or output, profiles).
+        '''
+        n = np.zeros(self.k)
+        sums = np.zeros((self.k, len(FEATURES)))
+        seen = np.zeros((self.k, len(FEATURES)))
+        parts = []
+        header = True
+        for features in chunks():
+            segment = self.predict(features)
+            values = features[FEATURES].to_numpy(np.float64)
+            known = ~np.isnan(values)
+            n += np.bincount(segment, minlength=self.k)
+            for j in range(len(FEATURES)):
+                sums[:, j] += np.bincount(segment, weights=np.where(known[:, j], values[:, j], 0),
+                                          minlength=self.k)
+                seen[:, j] += np.bincount(segment, weights=known[:, j], minlength=self.k)
+            labels = pd.DataFrame({'user_id': features.index.to_numpy(), 'segment': segment})
+            if output is None:
+                parts.append(labels)
+            else:
+                labels.to_csv(output, mode='w' if header else 'a', header=header, index=False)
+                header = False
+        if output is None:
+            result = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(
+                {'user_id': [], 'segment': []})
+        else:
+            result = output
+        return result, profiles(n, sums / np.where(seen > 0, seen, np.nan))
+
+    def save(self, path):
+        '''Write the scaler and centers to `path` (.npz format, whatever its name).'''
+        # through a file object, so that numpy does not append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez(f, centers=self.centers, count=self.scaler.count, sum=self.scaler.sum,
+                     sumsq=self.scaler.sumsq, features=np.array(FEATURES))
+
+    @classmethod
+    def load(cls, path):
+        '''Read a model written by save.'''
+        data = np.load(path)
+        if list(data['features']) != FEATURES:
+            raise ValueError(f'{path} was fitted on other features')
+        model = cls(k=len(data['centers']))
+        model.centers = data['centers']
+        model.scaler = _Scaler()
+        model.scaler.count, model.scaler.sum, model.scaler.sumsq = data['count'], data['sum'], data['sumsq']
+        return model
+
+
+def profiles(n, means):
+    '''Per-segment frame of user counts, shares and mean features, with the preferred day and hour.'''
+    frame = pd.DataFrame(means, columns=FEATURES)
+    frame.insert(0, 'segment', np.arange(len(n)))
+    frame.insert(1, 'users', n.astype(np.int64))
+    frame.insert(2, 'share', n / n.sum() if n.sum() else n)
+    dow = np.round(np.arctan2(frame['dow_sin'], frame['dow_cos']) * 7 / (2 * math.pi)) % 7
+    frame['preferred_day'] = dow.astype('Int64').map(day_of_week)
+    hour = np.round(np.arctan2(frame['hour_sin'], frame['hour_cos']) * 24 / (2 * math.pi)) % 24
+    frame['preferred_hour'] = hour.astype('Int64')
+    # length of the mean direction: 1 = always the same hour, 0 = no habit
+    frame['hour_habit'] = np.hypot(frame['hour_cos'], frame['hour_sin'])
+    return frame
+
+
+def segment(tables, k=6, chunk_users=500_000, output=None, **kwargs):
+    '''Fit segments on `tables` and label every user; returns (labels or output, profiles, model).'''
+    orders = prepare_orders(tables)
+
+    def chunks():
+        return feature_chunks(orders, chunk_users)
+    model = Segmenter(k, **kwargs).fit(chunks)
+    labels, profile = model.label(chunks, output)
+    return labels, profile, model
@@ -0,0 +1,443 @@
+'''
+Local HTTP service over precomputed aggregates.
+
+``Aggregates`` reduces the tables once to a few small frames: order lines,
+reorders and first-in-cart counts per (product, dow, hour), orders per user,
+dow and hour, and order lines and reorders per user. Every endpoint filters
+and sums those frames, so a request never touches the order lines:
+
+    GET /top-products?n=20&by=lines|reordered|first_in_cart&department=&aisle=&dow=&hour=
+    GET /product-reorders?department=&aisle=&dow=&hour=&product_id=&min_lines=&n=
+    GET /hour-of-day?dow=&user_id=&department=&aisle=
+    GET /day-of-week?hour=&user_id=&department=&aisle=
+    GET /user-reorders?user_id=&bin_size=
+    GET /percentiles?measure=basket_size|days_since_prior_order&q=0.5,0.9,0.99&dow=&hour=&weeks_ago=&department=
+    GET /version
+
+``department`` and ``aisle`` take an id or a name. With a department or aisle
+filter the hour/dow endpoints count order lines instead of orders.
+Percentiles come from the quantile sketches of ``sketch.build_cubes``; their
+dow, hour and weeks_ago filters take ranges such as ``0-2`` or ``8-11,17``.
+weeks_ago combines with dow and hour or with department; a department with
+dow or hour is a 400 naming the combinations there are.
+
+The server runs on asyncio; misses are computed in a thread pool, and
+identical concurrent misses share one computation. Responses are cached as
+encoded JSON in an LRU keyed by path, parameters and data version. A watcher
+polls the source's version (the stat-based versions of the csv exports, or of
+a file written by ``publish``); when it changes, the new aggregates are built
+in the background and swapped in, and requests keep being served from the
+old ones meanwhile. A failed reload is logged on the ``instacart.service``
+logger and shown by ``/version`` until a later poll succeeds.
+'''
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import pickle
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from instacart.clean import clean_tables, decode_names
+from instacart.data import DATA_DIR, FILES, read_table
+from instacart.paths import file_version, table_path
+from instacart.sketch import MEASURES as SKETCHED
+from instacart.sketch import build_cubes, find_cube
+
+log = logging.getLogger(__name__)
+
+# columns the aggregates are built from
+COLUMNS = {'instacart_orders': ['order_id', 'user_id', 'order_number', 'order_dow', 'order_hour_of_day',
+                                 'days_since_prior_order'],
+           'order_products': ['order_id', 'product_id', 'add_to_cart_order', 'reordered'],
+           'products': ['product_id', 'product_name', 'aisle_id', 'department_id'],
+           'aisles': None,
+           'departments': None}
+
+MEASURES = ('lines', 'reordered', 'first_in_cart')
+
+
+class BadRequest(ValueError):
+    '''A request parameter that cannot be used.'''
+
+
+class Aggregates:
+    '''The tables reduced to what the endpoints read.'''
+
+    def __init__(self, products, cube, orders, users, quantiles=None):
+        self.products = products
+        self.cube = cube
+        self.orders = orders
+        self.users = users
+        self.quantiles = quantiles
+
+    @classmethod
+    def build(cls, tables):
+        '''Aggregate cleaned (or raw) tables.'''
+        tables = clean_tables(tables)
+        orders = tables['instacart_orders']
+        op = tables['order_products']
+        products = decode_names(tables['products'])[['product_id', 'product_name', 'aisle_id', 'department_id']]
+        products = (products.merge(tables['aisles'].astype({'aisle': object}), on='aisle_id', how='left')
+                            .merge(tables['departments'].astype({'department': object}),
+                                   on='department_id', how='left'))
+        idx = pd.Index(orders['order_id']).get_indexer(op['order_id'])
+        known = idx >= 0
+        lines = pd.DataFrame({'product_id': op['product_id'].to_numpy()[known],
+                              'user_id': orders['user_id'].to_numpy()[idx[known]],
+                              'order_dow': orders['order_dow'].to_numpy()[idx[known]],
+                              'order_hour_of_day': orders['order_hour_of_day'].to_numpy()[idx[known]],
+                              'lines': 1,
+                              'reordered': op['reordered'].to_numpy()[known],
+                              'first_in_cart': op['add_to_cart_order'].to_numpy()[known] == 1})
+        cube = (lines.groupby(['product_id', 'order_dow', 'order_hour_of_day'])[list(MEASURES)].sum()
+                     .astype(np.int32).reset_index())
+        users = lines.groupby('user_id')[['lines', 'reordered']].sum().astype(np.int32)
+        quantiles = build_cubes(tables) if {'order_number', 'days_since_prior_order'} <= set(orders.columns) else None
+        orders = (orders[['user_id', 'order_dow', 'order_hour_of_day']]
+                  .sort_values('user_id', kind='stable').reset_index(drop=True))
+        return cls(products.set_index('product_id'), cube, orders, users, quantiles)
+
+    def save(self, path):
+        '''Write the aggregates to `path`, replacing it atomically.'''
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        '''Read aggregates written by save.'''
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        return cls(**state)
+
+    # -- filters
+
+    def _product_ids(self, params):
+        '''product_ids allowed by the department/aisle parameters (None: all).'''
+        keep = None
+        for level, name_col in (('department', 'department'), ('aisle', 'aisle')):
+            value = params.get(level)
+            if value is None:
+                continue
+            column = self.products[f'{level}_id']
+            if value.isdigit():
+                mask = column == int(value)
+            else:
+                mask = self.products[name_col].str.lower() == value.lower()
+            if not mask.any():
+                raise BadRequest(f'unknown {level} {value!r}')
+            keep = mask if keep is None else keep & mask
+        return None if keep is None else self.products.index[keep]
+
+    def _cube(self, params):
+        cube = self.cube
+        for column, name in (('order_dow', 'dow'), ('order_hour_of_day', 'hour')):
+            if name in params:
+                cube = cube[cube[column] == _int(params, name)]
+        allowed = self._product_ids(params)
+        if allowed is not None:
+            cube = cube[cube['product_id'].isin(allowed)]
+        return cube
+
+    def _named(self, frame):
+        names = self.products[['product_name', 'aisle', 'department']]
+        return frame.join(names, on='product_id')
+
+    # -- endpoints
+
+    def top_products(self, params):
+        by = params.get('by', 'lines')
+        if by not in MEASURES:
+            raise BadRequest(f'by must be one of {MEASURES}')
+        n = _int(params, 'n', 20)
+        totals = self._cube(params).groupby('product_id')[by].sum()
+        top = totals[totals > 0].sort_values(ascending=False, kind='stable').head(n)
+        return self._named(top.rename('freq').reset_index())
+
+    def product_reorders(self, params):
+        sums = self._cube(params).groupby('product_id')[['lines', 'reordered']].sum()
+        if 'product_id' in params:
+            sums = sums[sums.index == _int(params, 'product_id')]
+        sums = sums[sums['lines'] >= _int(params, 'min_lines', 1)]
+        frame = sums.assign(proportion_product_reorders=sums['reordered'] / sums['lines'] * 100).reset_index()
+        if 'n' in params:
+            frame = frame.head(_int(params, 'n'))
+        return self._named(frame)
+
+    def _distribution(self, params, column, other, other_param):
+        if 'department' in params or 'aisle' in params:
+            if 'user_id' in params:
+                raise BadRequest('user_id cannot be combined with department or aisle')
+            counts = self._cube(params).groupby(column)['lines'].sum()
+            value = 'lines'
+        else:
+            orders = self.orders
+            if 'user_id' in params:
+                user = _int(params, 'user_id')
+                ids = orders['user_id'].to_numpy()
+                orders = orders.iloc[ids.searchsorted(user):ids.searchsorted(user, side='right')]
+            if other_param in params:
+                orders = orders[orders[other] == _int(params, other_param)]
+            counts = orders[column].value_counts()
+            value = 'orders'
+        levels = range(24) if column == 'order_hour_of_day' else range(7)
+        counts = counts.reindex(levels, fill_value=0)
+        return counts.rename(value).rename_axis(column).reset_index()
+
+    def hour_of_day(self, params):
+        return self._distribution(params, 'order_hour_of_day', 'order_dow', 'dow')
+
+    def day_of_week(self, params):
+        return self._distribution(params, 'order_dow', 'order_hour_of_day', 'hour')
+
+    def user_reorders(self, params):
+        users = self.users[self.users['lines'] > 0]
+        prop = users['reordered'] / users['lines'] * 100
+        if 'user_id' in params:
+            user = _int(params, 'user_id')
+            if user not in users.index:
+                raise BadRequest(f'unknown user_id {user}')
+            return pd.DataFrame({'user_id': [user], 'lines': [users.at[user, 'lines']],
+                                 'reordered': [users.at[user, 'reordered']],
+                                 'proportion_user_reorders': [prop[user]]})
+        bin_size = _int(params, 'bin_size', 5)
+        if not 0 < bin_size <= 100:
+            raise BadRequest('bin_size must be in 1..100')
+        bins = np.minimum(prop // bin_size * bin_size, 100 - bin_size)
+        counts = bins.value_counts().reindex(range(0, 100, bin_size), fill_value=0)
+        return counts.rename('users').rename_axis('proportion_user_reorders').reset_index()
+
+    def percentiles(self, params):
+        if self.quantiles is None:
+            raise BadRequest('these aggregates were built without quantile sketches')
+        measure = params.get('measure', 'basket_size')
+        if measure not in SKETCHED:
+            raise BadRequest(f'measure must be one of {SKETCHED}')
+        try:
+            qs = [float(q) for q in params.get('q', '0.5,0.9,0.99').split(',')]
+        except ValueError:
+            raise BadRequest('q must be comma-separated numbers') from None
+        if not all(0 <= q <= 1 for q in qs):
+            raise BadRequest('q must be in 0..1')
+        filters = {column: params[name] for name, column in (('dow', 'order_dow'),
+                                                             ('hour', 'order_hour_of_day'),
+                                                             ('weeks_ago', 'weeks_ago')) if name in params}
+        if 'department' in params:
+            value = params['department']
+            departments = self.products.drop_duplicates('department_id')
+            match = (departments['department_id'] == int(value) if value.isdigit()
+                     else departments['department'].str.lower() == value.lower())
+            if not match.any():
+                raise BadRequest(f'unknown department {value!r}')
+            filters['department_id'] = str(int(departments.loc[match, 'department_id'].iloc[0]))
+        try:
+            cube = find_cube(self.quantiles, filters)
+            return cube.quantiles(measure, qs, **filters)
+        except KeyError as e:
+            raise BadRequest(e.args[0]) from None
+        except ValueError:
+            raise BadRequest('dow, hour and weeks_ago take values or ranges such as 0-2,5') from None
+
+
+def _int(params, name, default=None):
+    value = params.get(name)
+    if value is None:
+        if default is None:
+            raise BadRequest(f'{name} is required')
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest(f'{name} must be an integer') from None
+
+
+ENDPOINTS = {'/top-products': Aggregates.top_products,
+             '/product-reorders': Aggregates.product_reorders,
+             '/hour-of-day': Aggregates.hour_of_day,
+             '/day-of-week': Aggregates.day_of_week,
+             '/user-reorders': Aggregates.user_reorders,
+             '/percentiles': Aggregates.percentiles}
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def data_dir_source(data_dir=DATA_DIR):
+    '''(version, load) of the csv exports in `data_dir`.'''
+    def version():
+        return hashlib.blake2b(''.join(file_version(table_path(name, data_dir))
+                                       for name in FILES).encode(), digest_size=16).hexdigest()
+
+    def load():
+        return Aggregates.build({name: read_table(name, data_dir, usecols=cols)
+                                 for name, cols in COLUMNS.items()})
+    return version, load
+
+
+def published_source(path):
+    '''(version, load) of an aggregates file written by Aggregates.save.'''
+    return (lambda: file_version(path)), (lambda: Aggregates.load(path))
+
+
+_STATUS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class Service:
+    '''
+    Async JSON service over Aggregates with response caching and hot reload.
+    source = (version, load) callables, see data_dir_source/published_source
+    poll_interval = seconds between version checks
+    cache_bytes = budget of the response cache
+    '''
+
+    def __init__(self, source, poll_interval=5.0, cache_bytes=64 * 2**20, workers=4):
+        self.version_of, self.load = source
+        self.poll_interval = poll_interval
+        self.cache_bytes = cache_bytes
+        self.aggregates = None
+        self.version = None
+        self.loaded_at = None
+        self.reloads = 0
+        self.reload_error = None
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+        self._inflight = {}
+        self._pool = ThreadPoolExecutor(workers)
+
+    async def reload(self):
+        '''Load the current version if it differs from the one being served.'''
+        loop = asyncio.get_running_loop()
+        version = await loop.run_in_executor(self._pool, self.version_of)
+        if version == self.version:
+            return False
+        aggregates = await loop.run_in_executor(self._pool, self.load)
+        # swap in one step; requests already running keep the old aggregates
+        self.aggregates, self.version, self.loaded_at = aggregates, version, time.time()
+        self.reloads += 1
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+                self.reload_error = None
+            except Exception as e:  # keep serving the old version
+                self.reload_error = repr(e)
+                log.warning('reload failed; still serving version %s', self.version, exc_info=True)
+
+    def _cached(self, key):
+        body = self._cache.get(key)
+        if body is not None:
+            self._cache.move_to_end(key)
+        return body
+
+    def _store(self, key, body):
+        if len(body) > self.cache_bytes:
+            return
+        self._cache[key] = body
+        self._cache_nbytes += len(body)
+        while self._cache_nbytes > self.cache_bytes:
+            _, old = self._cache.popitem(last=False)
+            self._cache_nbytes -= len(old)
+
+    @staticmethod
+    def _render(func, aggregates, params):
+        frame = func(aggregates, params)
+        return json.dumps(frame.to_dict(orient='records'), default=_json_default).encode()
+
+    async def respond(self, method, target):
+        '''(status, body, headers) for one request.'''
+        if method != 'GET':
+            return 405, b'{"error": "only GET is supported"}', {}
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        aggregates, version = self.aggregates, self.version
+        headers = {'X-Data-Version': version}
+        if url.path == '/version':
+            body = {'version': version, 'loaded_at': self.loaded_at, 'reloads': self.reloads,
+                    'reload_error': self.reload_error, 'cached_responses': len(self._cache)}
+            return 200, json.dumps(body).encode(), headers
+        func = ENDPOINTS.get(url.path)
+        if func is None:
+            return 404, json.dumps({'error': f'unknown path {url.path}',
+                                    'endpoints': sorted(ENDPOINTS)}).encode(), headers
+        key = (url.path, tuple(sorted(params.items())), version)
+        headers['ETag'] = '"{}"'.format(hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest())
+        body = self._cached(key)
+        if body is None:
+            future = self._inflight.get(key)
+            if future is None:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(self._pool, self._render, func, aggregates, params)
+                self._inflight[key] = future
+            try:
+                body = await asyncio.shield(future)
+            except BadRequest as e:
+                return 400, json.dumps({'error': str(e)}).encode(), headers
+            finally:
+                self._inflight.pop(key, None)
+            self._store(key, body)
+        return 200, body, headers
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request.strip():
+                    break
+                method, target, _ = request.decode('latin-1').split(' ', 2)
+                fields = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    fields[name.strip().lower()] = value.strip()
+                try:
+                    status, body, headers = await self.respond(method, target)
+                except Exception as e:
+                    status, body, headers = 500, json.dumps({'error': repr(e)}).encode(), {}
+                if status == 200 and headers.get('ETag') and fields.get('if-none-match') == headers['ETag']:
+                    status, body = 304, b''
+                head = [f'HTTP/1.1 {status} {_STATUS[status]}',
+                        'Content-Type: application/json',
+                        f'Content-Length: {len(body)}']
+                head += [f'{k}: {v}' for k, v in headers.items() if v is not None]
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+                await writer.drain()
+                if fields.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        '''Load the data, start the watcher and listen; returns the asyncio server.'''
+        await self.reload()
+        self._watcher = asyncio.create_task(self._watch())
+        return await asyncio.start_server(self._handle, host, port)
+
+
+def serve(source, host='127.0.0.1', port=8000, **kwargs):
+    '''Run a Service on `host`:`port` until interrupted.'''
+    async def main():
+        service = Service(source, **kwargs)
+        server = await service.start(host, port)
+        print('serving on {}:{}'.format(*server.sockets[0].getsockname()[:2]), flush=True)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
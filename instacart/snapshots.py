@@ -0,0 +1,175 @@
+'''
+Run the same analyses over many dataset snapshots and compare them.
+
+Each snapshot is a directory with its own ``instacart_orders.csv`` and
+``order_products.csv`` (regional or monthly exports, or another grocery
+service in the same layout). The small dimension tables (products, aisles,
+departments) are read once and placed in shared memory; worker processes
+attach to them instead of each loading or unpickling a copy. Snapshots run
+concurrently in a process pool, so the total time is close to that of the
+slowest one.
+'''
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from instacart.clean import clean_orders, clean_products
+from instacart.data import read_table
+
+
+def _share(values):
+    shm = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, values.dtype, buffer=shm.buf)[:] = values
+    return shm
+
+
+def _attach(name):
+    '''Attach to a block owned by another process, without registering it.'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # before Python 3.13 attaching registers the block with the resource
+    # tracker, which would then unlink it (or warn) on behalf of this process
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def share_frame(df):
+    '''
+    Copy a frame into shared memory, one block per column; string and
+    categorical columns are stored as codes, with their categories as one
+    UTF-8 buffer and an int64 offsets array in two more blocks.
+    Returns (blocks, spec); keep the blocks alive and unlink them when done.
+    '''
+    blocks, spec = [], []
+    for col in df.columns:
+        s = df[col]
+        categories = None
+        if s.dtype == object or isinstance(s.dtype, pd.CategoricalDtype):
+            cat = s.astype('category')
+            encoded = [str(c).encode() for c in cat.cat.categories]
+            data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+            offsets = np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64)
+            data_shm, offsets_shm = _share(data), _share(offsets)
+            blocks.extend([data_shm, offsets_shm])
+            categories = (data_shm.name, len(data), offsets_shm.name, len(offsets))
+            values = cat.cat.codes.to_numpy()
+        else:
+            values = s.to_numpy()
+        shm = _share(values)
+        blocks.append(shm)
+        spec.append((col, shm.name, values.dtype.str, values.shape, categories))
+    return blocks, spec
+
+
+def attach_frame(spec):
+    '''
+    Rebuild a frame from share_frame's spec without copying numeric columns;
+    categories are decoded from the shared string buffer.
+    '''
+    blocks, columns = [], {}
+    for col, name, dtype, shape, categories in spec:
+        shm = _attach(name)
+        blocks.append(shm)
+        values = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+        if categories is not None:
+            data_name, size, offsets_name, n = categories
+            data_shm, offsets_shm = _attach(data_name), _attach(offsets_name)
+            blocks.extend([data_shm, offsets_shm])
+            data = bytes(data_shm.buf[:size])
+            offsets = np.ndarray(n, np.int64, buffer=offsets_shm.buf)
+            strings = [data[lo:hi].decode() for lo, hi in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+            values = pd.Categorical.from_codes(values, categories=strings)
+        columns[col] = values
+    return blocks, pd.DataFrame(columns, copy=False)
+
+
+_DIMS = {}
+
+
+def _attach_dimensions(specs):
+    for name, spec in specs.items():
+        blocks, frame = attach_frame(spec)
+        _DIMS[name] = frame
+        _DIMS.setdefault('_blocks', []).extend(blocks)
+
+
+def analyze_snapshot(job):
+    '''Hour/dow distributions, top products and reorder rates of one snapshot.'''
+    name, data_dir, top_n = job
+    products = _DIMS['products']
+    departments = _DIMS['departments']
+    orders = clean_orders(read_table('instacart_orders', data_dir))
+    op = read_table('order_products', data_dir, usecols=['order_id', 'product_id', 'reordered'])
+    hours = orders['order_hour_of_day'].value_counts(normalize=True).sort_index()
+    dows = orders['order_dow'].value_counts(normalize=True).sort_index()
+    top = op['product_id'].value_counts().head(top_n)
+    lookup = products.set_index('product_id')
+    top_names = lookup['product_name'].reindex(top.index).astype(object).fillna('Unknown')
+    dept = lookup['department_id'].reindex(op['product_id'].to_numpy()).to_numpy()
+    dept_names = departments.set_index('department_id')['department'].astype(object)
+    dept_rate = op['reordered'].groupby(dept).mean()
+    dept_rate.index = dept_names.reindex(dept_rate.index).to_numpy()
+    return {'snapshot': name,
+            'orders': len(orders),
+            'order_lines': len(op),
+            'hour': hours,
+            'dow': dows,
+            'top_products': pd.DataFrame({'product_id': top.index, 'product_name': top_names.to_numpy(),
+                                          'freq': top.to_numpy()}),
+            'reorder_rate': float(op['reordered'].mean()) if len(op) else np.nan,
+            'department_reorder_rate': dept_rate}
+
+
+def compare(results):
+    '''Side-by-side frames from a list of analyze_snapshot results.'''
+    names = [r['snapshot'] for r in results]
+    hour = pd.concat([r['hour'] for r in results], axis=1, keys=names).fillna(0)
+    hour.index.name = 'order_hour_of_day'
+    dow = pd.concat([r['dow'] for r in results], axis=1, keys=names).fillna(0)
+    dow.index.name = 'order_dow'
+    top = pd.concat([r['top_products']['product_name'].rename(r['snapshot']) for r in results], axis=1)
+    top.index = pd.RangeIndex(1, len(top) + 1, name='rank')
+    summary = pd.DataFrame({'orders': [r['orders'] for r in results],
+                            'order_lines': [r['order_lines'] for r in results],
+                            'reorder_rate': [r['reorder_rate'] for r in results]}, index=names)
+    departments = pd.concat([r['department_reorder_rate'] for r in results], axis=1, keys=names)
+    return {'summary': summary, 'hour': hour, 'dow': dow,
+            'top_products': top, 'department_reorder_rate': departments}
+
+
+def run_snapshots(snapshots, dims_dir=None, top_n=20, workers=None):
+    '''
+    Analyze every snapshot concurrently and compare them.
+    snapshots = {name: data_dir}
+    dims_dir = directory with products/aisles/departments (default: first snapshot)
+    '''
+    if not snapshots:
+        raise ValueError('no snapshots given')
+    dims_dir = dims_dir or next(iter(snapshots.values()))
+    dims = {'products': clean_products(read_table('products', dims_dir))[['product_id', 'product_name',
+                                                                         'aisle_id', 'department_id']],
+            'aisles': read_table('aisles', dims_dir),
+            'departments': read_table('departments', dims_dir)}
+    all_blocks, specs = [], {}
+    try:
+        for name, frame in dims.items():
+            blocks, specs[name] = share_frame(frame)
+            all_blocks.extend(blocks)
+        jobs = [(name, path, top_n) for name, path in snapshots.items()]
+        workers = workers or min(len(jobs), os.cpu_count() or 1)
+        with ProcessPoolExecutor(workers, initializer=_attach_dimensions, initargs=(specs,)) as pool:
+            results = list(pool.map(analyze_snapshot, jobs))
+    finally:
+        for shm in all_blocks:
+            shm.close()
+            shm.unlink()
+    return compare(results)
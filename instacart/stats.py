@@ -0,0 +1,173 @@
+'''
+Uncertainty for the notebook's point estimates.
+
+Bootstrap confidence intervals for per-product and per-user reorder
+proportions, and permutation tests for differences between day-of-week
+distributions such as the Saturday vs Wednesday ``order_hour_of_day``
+histograms.
+
+Both are computed on sufficient statistics rather than by re-sampling rows:
+resampling a group's n order lines with replacement gives a
+Binomial(n, p) reorder count, and permuting the day labels of two samples of
+a discrete variable gives a multivariate hypergeometric split of the pooled
+counts. The draws are the same in distribution as the row-level procedures
+but cost O(groups x resamples) and O(levels x resamples). Work is split into
+batches, each with its own seed from one SeedSequence, and spread over a
+process pool; results do not depend on the number of workers.
+'''
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instacart.clean import day_of_week
+
+
+def _map(func, jobs, workers):
+    '''Run func over jobs in a process pool (in-process if workers == 1).'''
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(jobs) == 1:
+        return [func(job) for job in jobs]
+    with ProcessPoolExecutor(min(workers, len(jobs))) as pool:
+        return list(pool.map(func, jobs))
+
+
+def _seed_sequence(seed):
+    '''Accept an int seed or an already spawned SeedSequence.'''
+    return seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+
+def _bootstrap_batch(job):
+    n, k, n_resamples, alpha, seed, batch_resamples = job
+    rng = np.random.default_rng(seed)
+    p = k / n
+    draws = np.empty((len(n), n_resamples), dtype=np.float32)
+    for start in range(0, n_resamples, batch_resamples):
+        size = min(batch_resamples, n_resamples - start)
+        draws[:, start:start + size] = rng.binomial(n[:, None], p[:, None], size=(len(n), size)) / n[:, None]
+    lower, upper = np.quantile(draws, [alpha / 2, 1 - alpha / 2], axis=1)
+    return lower, upper, draws.std(axis=1)
+
+
+def bootstrap_proportions(keys, successes, n_resamples=10_000, alpha=0.05, seed=0,
+                          batch_groups=2_000, batch_resamples=1_000, workers=None):
+    '''
+    Percentile bootstrap intervals for the share of successes per key.
+    keys = group key per row, successes = 0/1 per row
+    Returns a frame indexed by key with n, proportion, std_error, lower, upper.
+    '''
+    codes, uniques = pd.factorize(keys, sort=True)
+    n = np.bincount(codes, minlength=len(uniques))
+    k = np.bincount(codes, weights=np.asarray(successes, dtype=np.float64), minlength=len(uniques))
+    seeds = _seed_sequence(seed).spawn(max(1, -(-len(n) // batch_groups)))
+    jobs = [(n[i:i + batch_groups], k[i:i + batch_groups], n_resamples, alpha, s, batch_resamples)
+            for i, s in zip(range(0, len(n), batch_groups), seeds)]
+    parts = _map(_bootstrap_batch, jobs, workers)
+    lower = np.concatenate([p[0] for p in parts]) if parts else np.array([])
+    upper = np.concatenate([p[1] for p in parts]) if parts else np.array([])
+    std = np.concatenate([p[2] for p in parts]) if parts else np.array([])
+    index = pd.Index(uniques, name=getattr(keys, 'name', None))
+    return pd.DataFrame({'n': n, 'proportion': k / np.maximum(n, 1), 'std_error': std,
+                         'lower': lower, 'upper': upper}, index=index)
+
+
+def product_reorder_ci(df_order_products, **kwargs):
+    '''Bootstrap intervals for each product's reorder proportion.'''
+    return bootstrap_proportions(df_order_products['product_id'], df_order_products['reordered'], **kwargs)
+
+
+def user_reorder_ci(df_order_products, df_instacart_orders, **kwargs):
+    '''Bootstrap intervals for each user's reorder proportion.'''
+    users = df_instacart_orders[['order_id', 'user_id']].drop_duplicates('order_id')
+    lines = df_order_products[['order_id', 'reordered']].merge(users, on='order_id')
+    return bootstrap_proportions(lines['user_id'], lines['reordered'], **kwargs)
+
+
+def _statistic(counts_a, counts_b, values, statistic):
+    '''Distance between two count histograms (rows are resamples).'''
+    n_a = counts_a.sum(axis=-1, keepdims=True)
+    n_b = counts_b.sum(axis=-1, keepdims=True)
+    if statistic == 'ks':
+        cdf_a = np.cumsum(counts_a, axis=-1) / n_a
+        cdf_b = np.cumsum(counts_b, axis=-1) / n_b
+        return np.abs(cdf_a - cdf_b).max(axis=-1)
+    if statistic == 'mean':
+        return np.abs((counts_a @ values) / n_a[..., 0] - (counts_b @ values) / n_b[..., 0])
+    if statistic == 'chi2':
+        total = counts_a + counts_b
+        n = n_a + n_b
+        exp_a = total * n_a / n
+        exp_b = total * n_b / n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            terms = (counts_a - exp_a) ** 2 / exp_a + (counts_b - exp_b) ** 2 / exp_b
+        return np.nansum(terms, axis=-1)
+    raise ValueError(f'unknown statistic {statistic!r}')
+
+
+def _permutation_batch(job):
+    counts_a, counts_b, values, statistic, observed, n_resamples, seed = job
+    rng = np.random.default_rng(seed)
+    pooled = counts_a + counts_b
+    perm_a = rng.multivariate_hypergeometric(pooled, int(counts_a.sum()), size=n_resamples)
+    stats = _statistic(perm_a.astype(np.float64), (pooled - perm_a).astype(np.float64), values, statistic)
+    return int((stats >= observed - 1e-12).sum())
+
+
+def _counts(a, b):
+    values = np.union1d(np.unique(a), np.unique(b))
+    counts_a = np.bincount(np.searchsorted(values, a), minlength=len(values)).astype(np.int64)
+    counts_b = np.bincount(np.searchsorted(values, b), minlength=len(values)).astype(np.int64)
+    return values, counts_a, counts_b
+
+
+def _permutation_jobs(a, b, statistic, n_resamples, seed, batch_resamples):
+    values, counts_a, counts_b = _counts(np.asarray(a), np.asarray(b))
+    observed = float(_statistic(counts_a[None, :].astype(np.float64), counts_b[None, :].astype(np.float64),
+                                values.astype(np.float64), statistic)[0])
+    sizes = [min(batch_resamples, n_resamples - s) for s in range(0, n_resamples, batch_resamples)]
+    seeds = _seed_sequence(seed).spawn(len(sizes))
+    jobs = [(counts_a, counts_b, values.astype(np.float64), statistic, observed, size, s)
+            for size, s in zip(sizes, seeds)]
+    return observed, jobs
+
+
+def permutation_test(a, b, statistic='ks', n_resamples=10_000, seed=0,
+                     batch_resamples=1_000, workers=None):
+    '''
+    Two-sample permutation test for a discrete variable such as order_hour_of_day.
+    statistic = 'ks' (max CDF gap), 'chi2' or 'mean' (absolute mean difference)
+    Returns {'statistic', 'p_value', 'n_a', 'n_b'}.
+    '''
+    observed, jobs = _permutation_jobs(a, b, statistic, n_resamples, seed, batch_resamples)
+    exceed = sum(_map(_permutation_batch, jobs, workers))
+    return {'statistic': observed,
+            'p_value': (exceed + 1) / (n_resamples + 1),
+            'n_a': len(a),
+            'n_b': len(b)}
+
+
+def dow_permutation_tests(df_instacart_orders, column='order_hour_of_day', statistic='ks',
+                          n_resamples=10_000, seed=0, batch_resamples=1_000, workers=None):
+    '''
+    Permutation tests of `column` between every pair of days of the week
+    (Saturday vs Wednesday included); all batches share one process pool.
+    '''
+    dow = df_instacart_orders['order_dow'].to_numpy()
+    values = df_instacart_orders[column].to_numpy()
+    days = sorted(np.unique(dow))
+    pairs = list(itertools.combinations(days, 2))
+    seeds = _seed_sequence(seed).spawn(len(pairs))
+    observed, all_jobs, owner = [], [], []
+    for i, ((d1, d2), s) in enumerate(zip(pairs, seeds)):
+        obs, jobs = _permutation_jobs(values[dow == d1], values[dow == d2], statistic,
+                                      n_resamples, s, batch_resamples)
+        observed.append(obs)
+        all_jobs.extend(jobs)
+        owner.extend([i] * len(jobs))
+    exceed = np.bincount(owner, weights=_map(_permutation_batch, all_jobs, workers), minlength=len(pairs))
+    return pd.DataFrame({'day_a': [day_of_week.get(d1, d1) for d1, _ in pairs],
+                         'day_b': [day_of_week.get(d2, d2) for _, d2 in pairs],
+                         'statistic': observed,
+                         'p_value': (exceed + 1) / (n_resamples + 1)})
@@ -0,0 +1,337 @@
+'''
+Live counters over an order feed.
+
+The feed is newline-delimited JSON, one event per order::
+
+    {"order_id": 1, "user_id": 7, "order_dow": 3, "order_hour_of_day": 10,
+     "days_since_prior_order": 7.0, "ts": 1700000000.0,
+     "lines": [{"product_id": 24852, "add_to_cart_order": 1, "reordered": 1}]}
+
+read from an append-only file (``follow``) or from producers connecting to a
+TCP port (``serve``). Events are deduplicated by ``order_id`` over a bounded
+window of recent ids and folded into fixed-size aggregates: counts per hour
+and day of week, Welford running mean/variance of ``days_since_prior_order``,
+reorder rates, and exponentially decayed top-K products (first in cart and
+reordered) kept by Space-Saving. Every update is O(1) per order line and
+memory does not grow with the feed, so a single process keeps up with
+thousands of orders per second; ``snapshot`` can be called at any time.
+
+Only the standard library is used here, so the live command starts fast;
+``replay`` (the stand-in producer) imports pandas to read the exports.
+'''
+import heapq
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+from collections import deque
+
+# dedupe window: how many recent order_ids are remembered
+DEDUPE_WINDOW = 1_000_000
+
+
+class RecentIds:
+    '''The last `capacity` distinct ids seen; add() is True for a new id.'''
+
+    def __init__(self, capacity=DEDUPE_WINDOW):
+        self.capacity = capacity
+        self._ids = set()
+        self._order = deque()
+
+    def add(self, key):
+        if key in self._ids:
+            return False
+        self._ids.add(key)
+        self._order.append(key)
+        if len(self._order) > self.capacity:
+            self._ids.discard(self._order.popleft())
+        return True
+
+    def __len__(self):
+        return len(self._order)
+
+
+class RunningMoments:
+    '''Welford running count, mean and variance.'''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self):
+        return self._m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    def as_dict(self):
+        return {'count': self.count,
+                'mean': self.mean if self.count else None,
+                'std': math.sqrt(self.variance) if self.count > 1 else None}
+
+
+class DecayedTopK:
+    '''
+    Space-Saving heavy hitters with exponentially decayed counts.
+    half_life = seconds after which an occurrence counts half
+    capacity = counters kept (default 50 * k); counts may be overestimated
+        by at most the reported error, which is at most the (decayed) total
+        divided by the capacity, so flat distributions need a larger one
+
+    Decay uses a fixed landmark (forward decay): an occurrence at time t adds
+    2 ** ((t - landmark) / half_life), so older counts never need touching.
+    Counters are rescaled when the weights grow large.
+    '''
+
+    def __init__(self, k=20, half_life=3600.0, capacity=None):
+        self.k = k
+        self.half_life = half_life
+        self.capacity = capacity or 50 * k
+        self.landmark = None
+        self._counts = {}
+        self._errors = {}
+        self._heap = []
+
+    def _weight(self, t):
+        if self.landmark is None:
+            self.landmark = t
+        exponent = (t - self.landmark) / self.half_life
+        if exponent > 500:
+            self._rescale(t)
+            exponent = 0.0
+        return 2.0 ** exponent
+
+    def _rescale(self, t):
+        factor = 2.0 ** (-(t - self.landmark) / self.half_life)
+        self.landmark = t
+        for item in self._counts:
+            self._counts[item] *= factor
+            self._errors[item] *= factor
+        self._rebuild()
+
+    def _rebuild(self):
+        self._heap = [(c, item) for item, c in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def add(self, item, t):
+        w = self._weight(t)
+        counts = self._counts
+        if item in counts:
+            counts[item] += w
+        elif len(counts) < self.capacity:
+            counts[item] = w
+            self._errors[item] = 0.0
+        else:
+            # the heap holds stale entries; the smallest live one is the minimum
+            while True:
+                c, victim = heapq.heappop(self._heap)
+                if counts.get(victim) == c:
+                    break
+            del counts[victim]
+            del self._errors[victim]
+            counts[item] = c + w
+            self._errors[item] = c
+        heapq.heappush(self._heap, (counts[item], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def top(self, t=None):
+        '''[(item, decayed count, error)] of the k largest counters at time t.'''
+        if self.landmark is None:
+            return []
+        t = time.time() if t is None else t
+        scale = 2.0 ** (-(t - self.landmark) / self.half_life)
+        best = heapq.nlargest(self.k, self._counts.items(), key=lambda kv: kv[1])
+        return [(item, c * scale, self._errors[item] * scale) for item, c in best]
+
+
+class LiveCounters:
+    '''Bounded online aggregates of the order feed, safe to share between threads.'''
+
+    def __init__(self, k=20, half_life=3600.0, dedupe_window=DEDUPE_WINDOW, capacity=None):
+        self._lock = threading.Lock()
+        self._seen = RecentIds(dedupe_window)
+        self.orders = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.hour = [0] * 24
+        self.dow = [0] * 7
+        self.days_since_prior = RunningMoments()
+        self.days_since_prior_by_dow = [RunningMoments() for _ in range(7)]
+        self.lines = 0
+        self.reordered = 0
+        self.lines_by_hour = [0] * 24
+        self.reordered_by_hour = [0] * 24
+        self.first_in_cart = DecayedTopK(k, half_life, capacity)
+        self.top_reordered = DecayedTopK(k, half_life, capacity)
+        self.last_event = None
+
+    def ingest(self, event):
+        '''Fold in one order event; False if its order_id was already seen.'''
+        # validate everything before touching the counters
+        t = event.get('ts')
+        t = time.time() if t is None else float(t)
+        order_id = event['order_id']
+        hour = int(event['order_hour_of_day'])
+        dow = int(event['order_dow'])
+        if not (0 <= hour < 24 and 0 <= dow < 7):
+            raise ValueError(f'order {order_id}: hour {hour} or dow {dow} out of range')
+        days = event.get('days_since_prior_order')
+        days = None if days is None else float(days)
+        lines = [(line['product_id'], line.get('add_to_cart_order'), line['reordered'])
+                 for line in event.get('lines', ())]
+        for product_id, _, reordered in lines:
+            if reordered not in (0, 1):
+                raise ValueError(f'order {order_id}: reordered of product {product_id} '
+                                 f'is {reordered!r}, not 0 or 1')
+        with self._lock:
+            if not self._seen.add(order_id):
+                self.duplicates += 1
+                return False
+            self.orders += 1
+            self.last_event = t
+            self.hour[hour] += 1
+            self.dow[dow] += 1
+            if days is not None:
+                self.days_since_prior.add(days)
+                self.days_since_prior_by_dow[dow].add(days)
+            for product_id, position, reordered in lines:
+                self.lines += 1
+                self.lines_by_hour[hour] += 1
+                if reordered:
+                    self.reordered += 1
+                    self.reordered_by_hour[hour] += 1
+                    self.top_reordered.add(product_id, t)
+                if position == 1:
+                    self.first_in_cart.add(product_id, t)
+        return True
+
+    def ingest_line(self, line):
+        '''Parse and fold in one feed line; malformed lines are counted and skipped.'''
+        if not line.strip():
+            return False
+        try:
+            return self.ingest(json.loads(line))
+        except (ValueError, KeyError, TypeError):
+            with self._lock:
+                self.errors += 1
+            return False
+
+    def snapshot(self, t=None):
+        '''The current aggregates as a JSON-serialisable dict.'''
+        with self._lock:
+            t = self.last_event if t is None else t
+            return {'orders': self.orders,
+                    'duplicates': self.duplicates,
+                    'errors': self.errors,
+                    'orders_by_hour': list(self.hour),
+                    'orders_by_dow': list(self.dow),
+                    'days_since_prior_order': self.days_since_prior.as_dict(),
+                    'days_since_prior_order_by_dow': [m.as_dict() for m in self.days_since_prior_by_dow],
+                    'reorder_rate': self.reordered / self.lines if self.lines else None,
+                    'reorder_rate_by_hour': [r / n if n else None
+                                             for r, n in zip(self.reordered_by_hour, self.lines_by_hour)],
+                    'top_first_in_cart': [{'product_id': p, 'count': c, 'error': e}
+                                          for p, c, e in self.first_in_cart.top(t)],
+                    'top_reordered': [{'product_id': p, 'count': c, 'error': e}
+                                      for p, c, e in self.top_reordered.top(t)]}
+
+
+def follow(path, poll_interval=0.2, stop=None, tail=True):
+    '''
+    Yield complete lines appended to `path`.
+    tail = keep waiting for new lines at the end of the file (False: stop at EOF)
+    stop = threading.Event that ends a tail
+    '''
+    with open(path, 'rb') as f:
+        partial = b''
+        while stop is None or not stop.is_set():
+            line = f.readline()
+            if line.endswith(b'\n'):
+                yield partial + line
+                partial = b''
+                continue
+            partial += line
+            if not tail:
+                if partial:
+                    yield partial
+                return
+            if os.path.getsize(path) < f.tell():
+                # truncated or replaced: start again from the top
+                f.seek(0)
+                partial = b''
+            time.sleep(poll_interval)
+
+
+class _FeedHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            self.server.counters.ingest_line(line)
+
+
+def serve(counters, host='127.0.0.1', port=0):
+    '''
+    Start a TCP server that feeds every line producers send into `counters`,
+    in a background thread. Returns the server; its address is
+    server.server_address and server.shutdown() stops it.
+    '''
+    server = socketserver.ThreadingTCPServer((host, port), _FeedHandler)
+    server.daemon_threads = True
+    server.counters = counters
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def order_events(tables):
+    '''Order events (dicts in feed format) from the static tables, in order_id order.'''
+    orders = tables['instacart_orders'].sort_values('order_id')
+    op = tables['order_products'].sort_values(['order_id', 'add_to_cart_order'])
+    op_ids = op['order_id'].to_numpy()
+    products = op['product_id'].to_numpy()
+    positions = op['add_to_cart_order'].to_numpy()
+    reordered = op['reordered'].to_numpy()
+    starts = op_ids.searchsorted(orders['order_id'].to_numpy(), side='left')
+    ends = op_ids.searchsorted(orders['order_id'].to_numpy(), side='right')
+    columns = zip(orders['order_id'], orders['user_id'], orders['order_dow'],
+                  orders['order_hour_of_day'], orders['days_since_prior_order'], starts, ends)
+    for order_id, user_id, dow, hour, days, a, b in columns:
+        yield {'order_id': int(order_id), 'user_id': int(user_id), 'order_dow': int(dow),
+               'order_hour_of_day': int(hour),
+               'days_since_prior_order': None if days != days else float(days),
+               'lines': [{'product_id': int(products[i]),
+                          'add_to_cart_order': None if positions[i] != positions[i] else int(positions[i]),
+                          'reordered': int(reordered[i])} for i in range(a, b)]}
+
+
+def replay(tables, write, rate=None, duplicates=0.01, limit=None, seed=0):
+    '''
+    Stand-in producer: send the orders of `tables` as feed lines to `write`
+    (a callable taking bytes), stamped with the current time.
+    rate = orders per second (None: as fast as possible)
+    duplicates = share of orders sent a second time, to exercise dedupe
+    '''
+    import random
+    rng = random.Random(seed)
+    start = time.monotonic()
+    sent = 0
+    for event in order_events(tables):
+        if limit is not None and sent >= limit:
+            break
+        event['ts'] = time.time()
+        line = (json.dumps(event) + '\n').encode()
+        write(line)
+        if rng.random() < duplicates:
+            write(line)
+        sent += 1
+        if rate:
+            delay = start + sent / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    return sent
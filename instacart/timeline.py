@@ -0,0 +1,124 @@
+'''
+User order timelines and per-product repurchase intervals.
+
+The notebook only plots ``days_since_prior_order`` as one global bar chart.
+Here each user's orders are placed on an absolute day axis (day 0 is the
+user's first order) with a segmented cumulative sum, and consecutive
+purchases of the same product by the same user give inter-purchase
+intervals. Everything is done on sorted numpy arrays: no groupby-apply and
+no Python loop over users or products.
+'''
+import numpy as np
+import pandas as pd
+
+
+def segment_starts(keys):
+    '''Boolean mask marking the first element of every run of equal sorted keys.'''
+    starts = np.ones(len(keys), dtype=bool)
+    if len(keys):
+        starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+
+def segmented_cumsum(values, starts):
+    '''Cumulative sum of `values` restarting at every True in `starts`.'''
+    total = np.cumsum(values)
+    idx = np.flatnonzero(starts)
+    offsets = (total - values)[idx]
+    lengths = np.diff(np.append(idx, len(values)))
+    return total - np.repeat(offsets, lengths)
+
+
+def user_timeline(df_instacart_orders):
+    '''
+    Orders sorted by (user_id, order_number) with an absolute `day`
+    column: days since the user's first order.
+    '''
+    orders = df_instacart_orders[['order_id', 'user_id', 'order_number',
+                                  'order_dow', 'order_hour_of_day', 'days_since_prior_order']]
+    orders = orders.drop_duplicates('order_id')
+    user = orders['user_id'].to_numpy()
+    number = orders['order_number'].to_numpy()
+    order = np.lexsort((number, user))
+    orders = orders.iloc[order].reset_index(drop=True)
+    days = np.nan_to_num(orders['days_since_prior_order'].to_numpy(dtype=np.float64)).astype(np.int64)
+    starts = segment_starts(orders['user_id'].to_numpy())
+    # the first order of a user has no prior order, whatever the column says
+    days[starts] = 0
+    orders['day'] = segmented_cumsum(days, starts).astype(np.int32)
+    return orders
+
+
+def repurchase_intervals(timeline, df_order_products):
+    '''
+    One row per repeat purchase: user_id, product_id, the absolute day and
+    order_number of the purchase, and the gap in days and in orders since
+    the same user last bought the same product.
+    '''
+    t_order = timeline['order_id'].to_numpy()
+    by_id = np.argsort(t_order, kind='stable')
+    line_order = df_order_products['order_id'].to_numpy()
+    if not len(t_order) or not len(line_order):
+        return pd.DataFrame({'user_id': timeline['user_id'].to_numpy()[:0],
+                             'product_id': df_order_products['product_id'].to_numpy()[:0],
+                             'day': timeline['day'].to_numpy()[:0],
+                             'order_number': timeline['order_number'].to_numpy()[:0],
+                             'interval_days': np.array([], dtype=np.int32),
+                             'interval_orders': np.array([], dtype=np.int32)})
+    pos = np.searchsorted(t_order, line_order, sorter=by_id)
+    pos = np.minimum(pos, len(by_id) - 1)
+    found = t_order[by_id[pos]] == line_order
+    rows = by_id[pos[found]]
+    user = timeline['user_id'].to_numpy()[rows]
+    day = timeline['day'].to_numpy()[rows]
+    number = timeline['order_number'].to_numpy()[rows]
+    product = df_order_products['product_id'].to_numpy()[found]
+    order = np.lexsort((number, product, user))
+    user, product, day, number = user[order], product[order], day[order], number[order]
+    same = np.zeros(len(user), dtype=bool)
+    same[1:] = (user[1:] == user[:-1]) & (product[1:] == product[:-1])
+    prev = np.flatnonzero(same) - 1
+    return pd.DataFrame({'user_id': user[same],
+                         'product_id': product[same],
+                         'day': day[same],
+                         'order_number': number[same],
+                         'interval_days': (day[same] - day[prev]).astype(np.int32),
+                         'interval_orders': (number[same] - number[prev]).astype(np.int32)})
+
+
+def _segment_quantile(values, starts_idx, lengths, q):
+    '''Linear-interpolated quantile `q` of each sorted segment.'''
+    pos = starts_idx + q * (lengths - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    frac = pos - lo
+    return values[lo] * (1 - frac) + values[hi] * frac
+
+
+def repurchase_cycles(intervals, by='product_id', column='interval_days',
+                      quantiles=(0.25, 0.5, 0.75)):
+    '''
+    Typical repurchase cycle per `by` key (product_id, user_id or a list
+    of both): count, mean and quantiles of `column`, the median being the
+    typical cycle. Computed by sorting once and reading segment positions.
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    keys = [intervals[c].to_numpy() for c in by]
+    values = intervals[column].to_numpy().astype(np.float64)
+    order = np.lexsort([values] + keys[::-1])
+    keys = [k[order] for k in keys]
+    values = values[order]
+    starts = np.zeros(len(values), dtype=bool)
+    if len(values):
+        starts[0] = True
+        for k in keys:
+            starts[1:] |= k[1:] != k[:-1]
+    idx = np.flatnonzero(starts)
+    lengths = np.diff(np.append(idx, len(values)))
+    sums = np.add.reduceat(values, idx) if len(idx) else np.array([])
+    result = {c: k[idx] for c, k in zip(by, keys)}
+    result['repurchases'] = lengths
+    result['mean_' + column] = sums / np.maximum(lengths, 1)
+    for q in quantiles:
+        result[f'p{int(round(q * 100))}_{column}'] = _segment_quantile(values, idx, lengths, q)
+    return pd.DataFrame(result)
@@ -0,0 +1,133 @@
+'''
+Next-item model: what gets added to the cart right after each product.
+
+Order lines are sorted by (order_id, add_to_cart_order) and compared with
+the same arrays shifted by one; every adjacent pair within an order is a
+product -> next-product transition. Counts are kept as a CSR matrix in
+plain numpy arrays (scipy is optional, see ``to_scipy``). Construction can
+be sharded by order_id over a process pool; shard results are merged by
+summing counts of equal (product, next product) keys.
+'''
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instacart.cart import RECORDED_POSITIONS
+
+
+def transition_counts(order_id, product_id, position):
+    '''
+    Count adjacent add-to-cart pairs.
+    Returns (keys, counts) with key = product * 2**32 + next_product, sorted.
+    Lines without a recorded position (baskets over 64 items) are skipped.
+    '''
+    position = np.asarray(position, dtype=np.float64)
+    ok = ~np.isnan(position) & (position <= RECORDED_POSITIONS)
+    order_id = np.asarray(order_id)[ok]
+    product_id = np.asarray(product_id)[ok].astype(np.int64)
+    position = position[ok]
+    order = np.lexsort((position, order_id))
+    order_id, product_id, position = order_id[order], product_id[order], position[order]
+    adjacent = (order_id[1:] == order_id[:-1]) & (position[1:] == position[:-1] + 1)
+    keys = (product_id[:-1][adjacent] << 32) | product_id[1:][adjacent]
+    return np.unique(keys, return_counts=True)
+
+
+def _merge_counts(parts):
+    keys = np.concatenate([k for k, _ in parts])
+    counts = np.concatenate([c for _, c in parts])
+    order = np.argsort(keys, kind='stable')
+    keys, counts = keys[order], counts[order]
+    if not len(keys):
+        return keys, counts
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(counts, starts)
+
+
+def _shard_counts(args):
+    return transition_counts(*args)
+
+
+class TransitionMatrix:
+    '''Sparse product -> next-product transition counts in CSR layout.'''
+
+    def __init__(self, indptr, indices, counts):
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.n_products = len(indptr) - 1
+        self.row_totals = np.diff(np.r_[0, np.cumsum(counts)][indptr])
+
+    @classmethod
+    def from_counts(cls, keys, counts, n_products=None):
+        '''Build from sorted keys and counts as returned by transition_counts.'''
+        src = (keys >> 32).astype(np.int64)
+        dst = (keys & 0xFFFFFFFF).astype(np.int32)
+        if n_products is None:
+            n_products = int(max(src.max(), dst.max())) + 1 if len(keys) else 0
+        indptr = np.searchsorted(src, np.arange(n_products + 1)).astype(np.int64)
+        return cls(indptr, dst, counts.astype(np.int64))
+
+    @classmethod
+    def from_order_products(cls, df_order_products, shards=1, workers=None):
+        '''
+        Build from order lines.
+        shards = number of order_id shards, counted in separate processes if > 1
+        '''
+        order_id = df_order_products['order_id'].to_numpy()
+        product_id = df_order_products['product_id'].to_numpy()
+        position = df_order_products['add_to_cart_order'].to_numpy(dtype=np.float64)
+        n_products = int(product_id.max()) + 1 if len(product_id) else 0
+        if shards <= 1:
+            keys, counts = transition_counts(order_id, product_id, position)
+        else:
+            shard = order_id % shards
+            jobs = [(order_id[shard == s], product_id[shard == s], position[shard == s])
+                    for s in range(shards)]
+            with ProcessPoolExecutor(workers or shards) as pool:
+                parts = list(pool.map(_shard_counts, jobs))
+            keys, counts = _merge_counts(parts)
+        return cls.from_counts(keys, counts, n_products)
+
+    def merge(self, other):
+        '''Sum with a matrix built from other orders.'''
+        n = max(self.n_products, other.n_products)
+        return TransitionMatrix.from_counts(*_merge_counts([self._keys(), other._keys()]), n)
+
+    def _keys(self):
+        src = np.repeat(np.arange(self.n_products, dtype=np.int64), np.diff(self.indptr))
+        return (src << 32) | self.indices.astype(np.int64), self.counts
+
+    def next_items(self, product_id, k=10):
+        '''The k most frequent next products after `product_id`, with probabilities.'''
+        if product_id >= self.n_products:
+            return pd.DataFrame({'product_id': [], 'count': [], 'probability': []})
+        lo, hi = self.indptr[product_id], self.indptr[product_id + 1]
+        idx, cnt = self.indices[lo:hi], self.counts[lo:hi]
+        if len(cnt) > k:
+            top = np.argpartition(-cnt, k - 1)[:k]
+            idx, cnt = idx[top], cnt[top]
+        order = np.lexsort((idx, -cnt))
+        total = self.row_totals[product_id]
+        return pd.DataFrame({'product_id': idx[order],
+                             'count': cnt[order],
+                             'probability': cnt[order] / total if total else cnt[order] * 0.0})
+
+    def to_scipy(self):
+        '''Return a scipy.sparse.csr_matrix (requires scipy).'''
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.counts, self.indices, self.indptr),
+                          shape=(self.n_products, self.n_products))
+
+    def save(self, path):
+        '''Write the CSR arrays to `path` (.npz format, whatever its name).'''
+        # through a file object, so that numpy does not append .npz to the path
+        with open(path, 'wb') as f:
+            np.savez(f, indptr=self.indptr, indices=self.indices, counts=self.counts)
+
+    @classmethod
+    def load(cls, path):
+        '''Read a matrix written by save.'''
+        data = np.load(path)
+        return cls(data['indptr'], data['indices'], data['counts'])
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def synthetic_orders(users, min_orders=2, max_orders=12, start_id=1, seed=0):
+    '''
+    Orders for the ids in `users`: min_orders-max_orders each, 1-30 days
+    apart, at a random dow and hour.
+    '''
+    rng = np.random.default_rng(seed)
+    users = np.asarray(users)
+    counts = rng.integers(min_orders, max_orders + 1, len(users))
+    user_id = np.repeat(users, counts)
+    number = np.arange(len(user_id)) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+    days = rng.integers(1, 31, len(user_id)).astype(np.float64)
+    days[number == 1] = np.nan
+    return pd.DataFrame({'order_id': np.arange(start_id, start_id + len(user_id)),
+                         'user_id': user_id,
+                         'order_number': number,
+                         'order_dow': rng.integers(0, 7, len(user_id)),
+                         'order_hour_of_day': rng.integers(0, 24, len(user_id)),
+                         'days_since_prior_order': days})
+
+
+def synthetic_tables(orders, products=50, departments=5, max_lines=15, seed=0):
+    '''
+    Tables around `orders`: 1-max_lines order lines per order over
+    `products` products spread over `departments` departments.
+    '''
+    rng = np.random.default_rng(seed)
+    lines = rng.integers(1, max_lines + 1, len(orders))
+    op = pd.DataFrame({'order_id': np.repeat(orders['order_id'].to_numpy(), lines),
+                       'product_id': rng.integers(1, products + 1, lines.sum()),
+                       'add_to_cart_order': np.arange(lines.sum()) - np.repeat(np.cumsum(lines) - lines, lines) + 1,
+                       'reordered': rng.integers(0, 2, lines.sum())})
+    ids = np.arange(1, products + 1)
+    catalogue = pd.DataFrame({'product_id': ids,
+                              'product_name': [f'p{i}' for i in ids],
+                              'aisle_id': ids % 10 + 1,
+                              'department_id': ids % departments + 1})
+    names = pd.DataFrame({'department_id': np.arange(1, departments + 1),
+                          'department': [f'd{i}' for i in range(1, departments + 1)]})
+    return {'instacart_orders': orders, 'order_products': op, 'products': catalogue, 'departments': names}
+
+
+@pytest.fixture
+def make_orders():
+    return synthetic_orders
+
+
+@pytest.fixture
+def make_tables():
+    return synthetic_tables
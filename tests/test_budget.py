@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from instacart.budget import groupby_agg, merge_groupby
+
+AGGS = {'share': ('reordered', 'mean'), 'lines': ('reordered', 'size'), 'products': ('product_id', 'nunique')}
+
+
+def test_groupby_agg_matches_pandas(make_orders, make_tables, tmp_path):
+    lines = make_tables(make_orders(np.arange(1, 201)))['order_products']
+    expected = lines.groupby('order_id').agg(**AGGS)
+    # in memory, over the budget, and in chunks
+    pd.testing.assert_frame_equal(groupby_agg(lines, 'order_id', AGGS, budget=2**30), expected)
+    spilled = groupby_agg(lines, 'order_id', AGGS, budget=4096, spill_dir=tmp_path, partitions=8)
+    pd.testing.assert_frame_equal(spilled, expected)
+    chunks = (lines.iloc[i:i + 1000] for i in range(0, len(lines), 1000))
+    pd.testing.assert_frame_equal(groupby_agg(chunks, 'order_id', AGGS, spill_dir=tmp_path), expected)
+
+
+def test_merge_groupby_matches_pandas(make_orders, make_tables, tmp_path):
+    tables = make_tables(make_orders(np.arange(1, 201)))
+    lines, orders = tables['order_products'], tables['instacart_orders'][['order_id', 'user_id']]
+    expected = lines.merge(orders, on='order_id').groupby('user_id').agg(**AGGS)
+    spilled = merge_groupby(lines, orders, 'order_id', 'user_id', AGGS, budget=4096, spill_dir=tmp_path, partitions=8)
+    pd.testing.assert_frame_equal(spilled, expected)
+
+
+def test_empty_input_gives_an_empty_aggregate(tmp_path):
+    for result in (groupby_agg(iter([]), 'order_id', AGGS, spill_dir=tmp_path),
+                   merge_groupby(iter([]), iter([]), 'order_id', 'user_id', AGGS, spill_dir=tmp_path)):
+        assert result.empty
+        assert list(result.columns) == list(AGGS)
+    lines = pd.DataFrame({'order_id': pd.Series(dtype='int32'), 'product_id': pd.Series(dtype='int32'),
+                          'reordered': pd.Series(dtype='int8')})
+    # an empty chunk still spills, and keeps its dtypes
+    pd.testing.assert_frame_equal(groupby_agg(iter([lines]), 'order_id', AGGS, spill_dir=tmp_path),
+                                  lines.groupby('order_id').agg(**AGGS))
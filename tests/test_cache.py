@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from instacart.cache import QueryCache
+from instacart.data import read_table, source_version
+
+
+@pytest.fixture
+def orders(make_orders, tmp_path):
+    make_orders(np.arange(1, 51)).to_csv(tmp_path / 'instacart_orders.csv', sep=';', index=False)
+    return read_table('instacart_orders', tmp_path)
+
+
+def test_repeat_query_hits_and_returns_a_copy(orders):
+    cache = QueryCache()
+    first = cache.value_counts(orders, 'order_dow')
+    first.iloc[0] = -1
+    again = cache.value_counts(orders, 'order_dow')
+    assert cache.hits == 1 and cache.misses == 1
+    assert (again >= 0).all()
+
+
+def test_frame_edited_after_loading_misses(orders):
+    cache = QueryCache(hash_contents=True)
+    before = cache.value_counts(orders, 'order_dow')
+    orders.loc[orders['order_dow'] == 0, 'order_dow'] = 1
+    assert source_version(orders) is None
+    after = cache.value_counts(orders, 'order_dow')
+    assert cache.misses == 2 and cache.hits == 0
+    assert 0 not in after.index and after[1] == before[0] + before[1]
+
+
+def test_edited_frame_needs_a_version_without_hashing(orders):
+    cache = QueryCache()
+    cache.value_counts(orders, 'order_dow')
+    orders['order_dow'] = orders['order_dow'] + 1
+    with pytest.raises(ValueError, match='changed since'):
+        cache.value_counts(orders, 'order_dow')
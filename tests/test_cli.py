@@ -0,0 +1,25 @@
+import json
+
+import numpy as np
+import pytest
+
+from instacart.cli import main
+from instacart.stream import replay
+
+
+def test_live_once_reads_the_feed_file(make_orders, make_tables, tmp_path, capsys):
+    tables = make_tables(make_orders(np.arange(1, 21)))
+    feed = tmp_path / 'feed.jsonl'
+    with open(feed, 'wb') as f:
+        sent = replay(tables, f.write, duplicates=0)
+    assert main(['live', '--once', '--file', str(feed), '-k', '3']) == 0
+    snapshot = json.loads(capsys.readouterr().out)
+    assert snapshot['orders'] == sent == len(tables['instacart_orders'])
+    assert len(snapshot['top_reordered']) == 3
+
+
+def test_live_once_needs_a_file(capsys):
+    with pytest.raises(SystemExit) as exit_:
+        main(['live', '--once', '--listen', '127.0.0.1:0'])
+    assert exit_.value.code == 2
+    assert '--once' in capsys.readouterr().err
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from instacart.cohort import CohortRetention
+
+
+def test_update_keeps_cohort_labels(make_orders):
+    orders = make_orders(np.arange(1, 201))
+    # the first batch holds every user's orders but the last two
+    cut = orders.groupby('user_id')['order_number'].transform('max') - 2
+    first, rest = orders[orders['order_number'] <= cut], orders[orders['order_number'] > cut]
+    model = CohortRetention.build(first)
+    before = model.users['cohort'].copy()
+    reference = model.reference
+
+    newcomers = make_orders(np.arange(201, 251), start_id=len(orders) + 1, seed=1)
+    model.update(pd.concat([rest, newcomers]))
+
+    assert model.reference == reference
+    pd.testing.assert_series_equal(model.users['cohort'].loc[before.index], before)
+    assert (model.users['orders'].loc[orders['user_id'].unique()].to_numpy()
+            == orders.groupby('user_id')['order_number'].max().to_numpy()).all()
+    # newcomers are dated before the latest returning order, not piled up on it
+    assert model.end > reference
+    last = model.users['last_date'].loc[newcomers['user_id'].unique()]
+    assert (last <= model.end).all() and (last < model.end).any()
+    assert not model.users['observed'].any()
+
+
+def test_dated_orders_use_their_dates(make_orders):
+    orders = make_orders(np.arange(1, 51))
+    orders['date'] = 100 + orders.groupby('user_id')['days_since_prior_order'].cumsum().fillna(0).astype(int)
+    model = CohortRetention.build(orders, period_days=7)
+    assert model.reference == orders['date'].max()
+    first = orders[orders['order_number'] == 1].set_index('user_id')['date']
+    expected = -((model.reference - first) // 7)
+    assert (model.users['cohort'].loc[first.index].to_numpy() == expected.to_numpy()).all()
+
+
+def test_replayed_batch_is_ignored(make_orders):
+    orders = make_orders(np.arange(1, 51))
+    model = CohortRetention.build(orders)
+    users, days = model.users.copy(), model.days.copy()
+    model.update(orders)
+    pd.testing.assert_frame_equal(model.users, users)
+    pd.testing.assert_series_equal(model.days, days)
+
+
+def test_early_churn_is_not_retained(make_orders):
+    orders = make_orders(np.arange(1, 3), min_orders=3, max_orders=3)
+    # both users start on day 0; user 1 stops on day 20, user 2 orders until day 400
+    orders['date'] = np.where(orders['user_id'] == 1, 10, 200) * (orders['order_number'] - 1)
+    model = CohortRetention.build(orders, period_days=30)
+    active = model.activity()
+    cohort = model.users.loc[1, 'cohort']
+    assert model.users.loc[2, 'cohort'] == cohort
+    assert active.loc[cohort, 0] == 2
+    # day 20 may fall in the period after the first on the cohort grid, not later
+    assert (active.loc[cohort, 2:] == 1).all()
+    # both users reached their third order all the same
+    assert model.retention().loc[cohort, 3] == 2
+
+
+def test_reconstructed_dates_are_censored(make_orders):
+    model = CohortRetention.build(make_orders(np.arange(1, 51)))
+    with pytest.raises(ValueError, match='date column'):
+        model.activity()
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+from instacart.forecast import order_dates
+
+
+def test_last_orders_spread_before_the_snapshot(make_orders):
+    dated = order_dates(make_orders(np.arange(1, 1001)))
+    last = dated.groupby('user_id')['date'].max()
+    assert (last <= 0).all()
+    # not every user's last order piles up on the snapshot date
+    assert (last == 0).mean() < 0.2
+    assert last.min() > -60
+    pd.testing.assert_frame_equal(dated, order_dates(make_orders(np.arange(1, 1001))))
+
+
+def test_dated_orders_use_their_dates(make_orders):
+    orders = make_orders(np.arange(1, 51))
+    orders['date'] = 1000 + 3 * orders['order_id']
+    dated = order_dates(orders)
+    expected = orders.set_index('order_id')['date'].reindex(dated['order_id']).to_numpy() - orders['date'].max()
+    assert (dated['date'].to_numpy() == expected).all()
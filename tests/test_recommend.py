@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+
+from instacart.recommend import fit, prepare, recommend
+
+
+def test_worker_processes_give_the_same_recommendations(make_orders, make_tables):
+    tables = make_tables(make_orders(np.arange(1, 201)))
+    model = fit(*prepare(tables)[:2], sample_fraction=0.5)
+    alone = recommend(tables, k=5, model=model, chunk_users=30, workers=1)
+    pooled = recommend(tables, k=5, model=model, chunk_users=30, workers=2)
+    pd.testing.assert_frame_equal(alone, pooled)
+    assert (alone.groupby('user_id').size() <= 5).all()
+
+
+def test_staple_bought_in_every_order_ranks_first(make_orders):
+    orders = make_orders(np.arange(1, 301), min_orders=4)
+    rng = np.random.default_rng(1)
+    # every order holds product 1 next to two products drawn from 2-50
+    order_id = np.repeat(orders['order_id'].to_numpy(), 3)
+    product = rng.integers(2, 51, len(order_id))
+    product[::3] = 1
+    lines = pd.DataFrame({'order_id': order_id, 'product_id': product})
+    first = orders.set_index('order_id')['order_number'].reindex(order_id).to_numpy() == 1
+    lines['reordered'] = (~first & (product == 1)).astype(np.int8)
+    ranked = recommend({'instacart_orders': orders, 'order_products': lines}, k=3, workers=1)
+    top = ranked[ranked['rank'] == 1]
+    assert len(top) == 300
+    assert (top['product_id'] == 1).all()
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from instacart import sample
+
+
+@pytest.fixture
+def tables(make_orders, make_tables):
+    '''20,000 users with 1-60 orders each.'''
+    return make_tables(make_orders(np.arange(1, 20_001), min_orders=1, max_orders=60))
+
+
+def test_realized_fraction_matches_request(tables):
+    for fraction in (0.001, 0.01, 0.05):
+        drawn = sample.draw(tables, fraction)
+        # at most a couple of users over round(fraction * N) for the two-user floor
+        assert abs(len(drawn.users) - fraction * 20_000) <= 2
+        assert drawn.strata['n'].sum() == len(drawn.users)
+
+
+def test_every_stratum_has_a_variance(tables):
+    drawn = sample.draw(tables, 0.01)
+    assert (drawn.strata['n'] >= 2).all()
+    for name in ('top-products', 'order-sizes', 'hour-of-day'):
+        est = sample.estimate(name, drawn, n=10)
+        positive = est.iloc[:, 1] > 0 if name != 'top-products' else est['freq'] > 0
+        assert (est.loc[positive, 'std_error'] > 0).all(), name
+        assert (est.loc[positive, 'lower'] < est.loc[positive, 'upper']).all(), name
+
+
+def test_allocation_is_proportional():
+    sizes = np.array([1000, 333, 667, 50, 3])
+    # 205.3 users: the floors give 204, the largest remainder (66.7) the last one,
+    # and the smallest stratum is raised to two users
+    assert list(sample.allocate(sizes, 0.1)) == [100, 33, 67, 5, 2]
+
+
+def test_reorder_bins_estimate_the_user_count(tables):
+    drawn = sample.draw(tables, 0.05)
+    bins = sample.reorder_proportion_bins(drawn, bin_size=10)
+    assert list(bins.columns[:2]) == ['proportion_user_reorders', 'users']
+    assert set(bins['proportion_user_reorders']) <= set(range(0, 100, 10))
+    # every user has order lines, so the bins add up to about all 20,000
+    assert abs(bins['users'].sum() - 20_000) < 0.05 * 20_000
@@ -0,0 +1,31 @@
+import asyncio
+import json
+import logging
+
+from instacart.service import Service
+
+
+def test_failed_reload_is_logged_and_reported(caplog):
+    versions = iter(['v1', 'v2', 'v2', 'v2', 'v2'])
+
+    def load():
+        if service.version == 'v1':
+            raise OSError('half-written export')
+        return object()
+
+    service = Service((lambda: next(versions, 'v2'), load), poll_interval=0.01)
+
+    async def run():
+        await service.reload()
+        watcher = asyncio.create_task(service._watch())
+        await asyncio.sleep(0.05)
+        watcher.cancel()
+        return await service.respond('GET', '/version')
+
+    with caplog.at_level(logging.WARNING, logger='instacart.service'):
+        status, body, _ = asyncio.run(run())
+    assert status == 200
+    report = json.loads(body)
+    assert report['version'] == 'v1'
+    assert 'half-written export' in report['reload_error']
+    assert any('reload failed' in r.getMessage() for r in caplog.records)
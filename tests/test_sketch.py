@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from instacart.sketch import build_cubes, find_cube, order_measures
+
+
+def test_week_range_combines_with_other_filters(make_orders, make_tables):
+    tables = make_tables(make_orders(np.arange(1, 301)))
+    cubes = build_cubes(tables)
+    measures = order_measures(tables)
+    filters = {'weeks_ago': '0-3', 'order_dow': '1-2', 'order_hour_of_day': '8-17'}
+    cube = find_cube(cubes, filters)
+    assert set(cube.columns) == set(filters)
+    selected = measures[measures['weeks_ago'].between(0, 3) & measures['order_dow'].between(1, 2)
+                        & measures['order_hour_of_day'].between(8, 17)]
+    assert cube.select('basket_size', **filters).n == len(selected)
+
+    lines = tables['order_products'].merge(tables['products'], on='product_id')
+    in_dept = lines.loc[lines['department_id'] == 3, 'order_id'].unique()
+    dept = find_cube(cubes, {'weeks_ago': '0-3', 'department_id': '3'})
+    expected = measures['order_id'].isin(in_dept) & measures['weeks_ago'].between(0, 3)
+    assert dept.select('basket_size', weeks_ago='0-3', department_id='3').n == expected.sum()
+
+
+def test_unfiltered_quantiles_count_every_order_once(make_orders, make_tables):
+    orders = make_orders(np.arange(1, 1001))
+    # baskets with a long tail, so that repeated orders would shift the quantiles
+    tables = make_tables(orders, max_lines=80)
+    # half the users have a segment
+    segments = pd.Series(np.arange(500) % 3, index=np.arange(1, 501))
+    cubes = build_cubes(tables, segments)
+    measures = order_measures(tables)
+    qs = [0.5, 0.9, 0.99]
+    result = find_cube(cubes, {}).quantiles('basket_size', qs)
+    assert (result['n'] == len(orders)).all()
+    exact = np.quantile(measures['basket_size'], qs)
+    # within the sketch's rank error of the exact quantiles
+    ranks = [np.mean(measures['basket_size'] <= v) for v in result['basket_size']]
+    assert np.allclose(ranks, qs, atol=result['rank_error'].iloc[0] + 0.01)
+    assert np.allclose(result['basket_size'], exact, rtol=0.1)
+
+
+def test_smallest_cube_is_used_and_unsupported_filters_fail(make_orders, make_tables):
+    cubes = build_cubes(make_tables(make_orders(np.arange(1, 301))))
+    assert find_cube(cubes, {'order_dow': '1'}).columns == ('order_dow', 'order_hour_of_day')
+    assert find_cube(cubes, {'department_id': '3'}).columns == ('department_id',)
+    with pytest.raises(KeyError, match='department_id and order_dow'):
+        find_cube(cubes, {'order_dow': '1', 'department_id': '3'})